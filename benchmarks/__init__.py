@@ -0,0 +1,9 @@
+"""
+Benchmarks for weeelab, on synthetic logs. Run them from the repository root:
+
+	python -m benchmarks.generate DIRECTORY    # just write some logs, to look at or to try weeelab on
+	python -m benchmarks.run                   # time login, logout, -p, rotation... on logs of different sizes
+	python -m benchmarks.stress                # many processes logging in and out at once, then check the log
+
+LDAP is replaced by benchmarks.stub_ldap, nothing goes over the network.
+"""
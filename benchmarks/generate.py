@@ -0,0 +1,128 @@
+"""
+Write synthetic weeelab logs, in the same fixed-width format as the real ones
+"""
+
+import argparse
+import os
+import random
+from calendar import monthrange
+from datetime import datetime, timedelta
+from time import strftime
+from typing import Optional
+
+MESSAGES = (
+	"Riparato alimentatore",
+	"Catalogato hard disk su T.A.R.A.L.L.O.",
+	"Test RAM, tutte ok",
+	"Installato Xubuntu su 3 PC",
+	"Sistemato cavi",
+	"Riunione",
+	"Smontato computer rotto, recuperati pezzi",
+)
+
+
+def username(number: int) -> str:
+	"""
+	Name of a generated user, benchmarks.stub_ldap knows them all
+
+	:param number: 0 to users - 1
+	"""
+	return f"user{number:04d}"
+
+
+def timestamp(moment: datetime) -> str:
+	return moment.strftime("%d/%m/%Y %H:%M")
+
+
+def closed_line(login: datetime, logout: datetime, user: str, message: str) -> str:
+	minutes = int((logout - login).total_seconds()) // 60
+	return f"[{timestamp(login)}] [{timestamp(logout)}] [{minutes // 60:02d}:{minutes % 60:02d}] <{user}> :: {message}\n"
+
+
+def open_line(login: datetime, user: str) -> str:
+	return f"[{timestamp(login)}] [----------------] [INLAB] <{user}>\n"
+
+
+def month_lines(year: int, month: int, lines: int, users: int, open_sessions: int, rng: random.Random) -> list:
+	"""
+	Make up the log of a month: logins spread over the month, mostly in the afternoon, each lasting
+	from a few minutes to a few hours, some past midnight. Nobody is in lab twice at the same time.
+
+	:param lines: how many lines, open sessions included
+	:param users: how many different users
+	:param open_sessions: how many sessions are still open, at the end of the month
+	:param rng: random number generator, seed it to get the same log every time
+	:return: lines, sorted by login time
+	"""
+	days = monthrange(year, month)[1]
+	logins = sorted(
+		datetime(year, month, rng.randint(1, days), min(23, max(8, int(rng.gauss(15, 3)))), rng.randint(0, 59))
+		for _ in range(lines))
+	# username -> when they leave, sessions can't overlap
+	busy = {}
+	result = []
+	open_start = len(logins) - min(open_sessions, users, len(logins))
+	for i, login in enumerate(logins):
+		if i >= open_start:
+			# Nobody will leave anymore
+			user = next((username(n) for n in range(users) if busy.get(username(n), login) <= login), None)
+			if user is not None:
+				busy[user] = datetime.max
+				result.append(open_line(login, user))
+				continue
+		for _ in range(10):
+			user = username(rng.randrange(users))
+			if busy.get(user, login) <= login:
+				break
+		else:
+			user = min(busy, key=busy.get)
+		logout = login + timedelta(minutes=int(rng.expovariate(1 / 150)) + 5)
+		busy[user] = logout
+		result.append(closed_line(login, logout, user, rng.choice(MESSAGES)))
+	return result
+
+
+def generate(directory: str, lines: int, users: int, open_sessions: int, archives: int, seed: int = 0,
+	month: Optional[str] = None):
+	"""
+	Write log.txt and log.txt.month for the current month, and a plain text logYYYYMM.txt for each of the
+	months before
+
+	:param directory: where, like LOG_PATH
+	:param lines: lines in each log
+	:param users: how many different users
+	:param open_sessions: how many sessions are still open in log.txt
+	:param archives: how many months of archives
+	:param seed: for the random number generator
+	:param month: YYYYMM of log.txt, None for the current month
+	"""
+	rng = random.Random(seed)
+	month = month or strftime("%Y%m")
+	year, month_number = int(month[:4]), int(month[4:])
+	os.makedirs(directory, exist_ok=True)
+	for back in range(archives, -1, -1):
+		archive_year, archive_month = divmod(year * 12 + month_number - 1 - back, 12)
+		archive_month += 1
+		log = month_lines(archive_year, archive_month, lines, users, open_sessions if back == 0 else 0, rng)
+		filename = "log.txt" if back == 0 else f"log{archive_year}{archive_month:02d}.txt"
+		with open(os.path.join(directory, filename), "w") as log_file:
+			log_file.writelines(log)
+	with open(os.path.join(directory, "log.txt.month"), "w") as month_file:
+		month_file.write(month + "\n")
+
+
+def argparse_this():
+	parser = argparse.ArgumentParser(description="Write synthetic weeelab logs")
+	parser.add_argument('directory', type=str, help='where to write them')
+	parser.add_argument('--lines', type=int, default=3000, help='lines in each log (default 3000)')
+	parser.add_argument('--users', type=int, default=200, help='different users (default 200)')
+	parser.add_argument('--open', type=int, default=20, help='people still in lab (default 20)')
+	parser.add_argument('--archives', type=int, default=12, help='months of archives (default 12)')
+	parser.add_argument('--month', type=str, metavar='YYYYMM', help='month of log.txt (default this month)')
+	parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+	args = parser.parse_args()
+	generate(args.directory, args.lines, args.users, args.open, args.archives, args.seed, args.month)
+
+
+if __name__ == '__main__':
+	argparse_this()
@@ -0,0 +1,226 @@
+"""
+Time what weeelab does most often, on synthetic logs of increasing size, and save the results to compare
+them with another run
+"""
+
+import argparse
+import importlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from time import perf_counter, strftime
+from typing import Optional
+
+from benchmarks import stub_ldap
+from benchmarks.generate import generate, username
+
+RESULTS_VERSION = 1
+# Differences smaller than this are just noise, not regressions
+NOISE_MS = 0.1
+
+
+def load_weeelab(directory: str):
+	"""
+	Import weeelab.py, reading and writing logs in directory. LOG_PATH is read on import, so this has to
+	be done once and before anything else.
+	"""
+	os.environ["LOG_PATH"] = directory
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	return importlib.import_module("weeelab")
+
+
+def forget_everything(weeelab):
+	"""
+	Drop what weeelab keeps in memory about the log and users, as if it had just started
+	"""
+	weeelab.INLAB_INDEX_CACHE = None
+	weeelab.USER_CACHE = None
+	weeelab.DIRECTORY = None
+	weeelab.LDAP_CONNECTION = None
+
+
+def stats(samples: list) -> dict:
+	"""
+	:param samples: seconds
+	:return: milliseconds
+	"""
+	ordered = sorted(samples)
+	return {
+		"repeat": len(ordered),
+		"min_ms": ordered[0] * 1000,
+		"median_ms": ordered[len(ordered) // 2] * 1000,
+		"p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+		"mean_ms": sum(ordered) / len(ordered) * 1000,
+		"max_ms": ordered[-1] * 1000,
+	}
+
+
+def measure(action, repeat: int, setup=None) -> dict:
+	"""
+	Time action, repeat times. Output is thrown away.
+
+	:param action: called with the repetition number
+	:param setup: called before action with the repetition number, not timed
+	"""
+	samples = []
+	with redirect_stdout(io.StringIO()):
+		for i in range(repeat):
+			if setup is not None:
+				setup(i)
+			start = perf_counter()
+			action(i)
+			samples.append(perf_counter() - start)
+	return stats(samples)
+
+
+def benchmark_log(weeelab, directory: str, lines: int, users: int, open_sessions: int, archives: int, repeat: int) -> list:
+	"""
+	Generate a log of a given size and time every operation on it
+
+	:return: results, one dict per operation
+	"""
+	for filename in os.listdir(directory):
+		os.remove(os.path.join(directory, filename))
+	generate(directory, lines, users, open_sessions, archives)
+	forget_everything(weeelab)
+	log_filename = weeelab.LOG_FILENAME
+	index_filename = weeelab.inlab_index_filename()
+	in_lab = set(weeelab.load_inlab_index())
+	outside = [username(n) for n in range(users) if username(n) not in in_lab]
+	people = min(repeat, len(outside))
+
+	results = []
+
+	def add(operation: str, result: dict):
+		results.append(dict(operation=operation, lines=lines, users=users, open_sessions=open_sessions, **result))
+		print(f"{lines:>8} lines  {operation:<32} {result['median_ms']:10.3f} ms  (p95 {result['p95_ms']:.3f} ms)")
+
+	def drop_index(_):
+		if os.path.exists(index_filename):
+			os.remove(index_filename)
+		weeelab.INLAB_INDEX_CACHE = None
+
+	def forget_index(_):
+		weeelab.INLAB_INDEX_CACHE = None
+
+	add("is_logged_in (no index)", measure(lambda i: weeelab.is_logged_in(outside[i % len(outside)]), repeat, drop_index))
+	add("is_logged_in (index file)", measure(lambda i: weeelab.is_logged_in(outside[i % len(outside)]), repeat, forget_index))
+	add("is_logged_in (in memory)", measure(lambda i: weeelab.is_logged_in(outside[i % len(outside)]), repeat))
+	add("people_in_lab", measure(lambda i: weeelab.people_in_lab(), repeat, forget_index))
+	add("inlab", measure(lambda i: weeelab.inlab(), repeat, forget_index))
+	add("ldap_get_user", measure(lambda i: weeelab.ldap_get_user(username(i % users)), repeat))
+	if people > 0:
+		add("login", measure(lambda i: weeelab.login(outside[i], True), people, forget_index))
+		add("logout", measure(lambda i: weeelab.logout(outside[i], True, "Benchmark"), people, forget_index))
+
+		def login_first(i):
+			weeelab.login(outside[i], True)
+			weeelab.INLAB_INDEX_CACHE = None
+
+		now = strftime("%d/%m/%Y %H:%M")
+		add("write_logout", measure(lambda i: weeelab.write_logout(outside[i], now, "Benchmark"), people, login_first))
+
+	# Rotation: pretend log.txt is from last month, which has no archive yet
+	month_filename = weeelab.log_month_filename()
+	with open(month_filename, "r") as month_file:
+		month = month_file.read().strip()
+	year, month_number = divmod(int(month[:4]) * 12 + int(month[4:]) - 2, 12)
+	last_month = f"{year}{month_number + 1:02d}"
+	archive_filename = log_filename.rsplit('.', 1)[0] + last_month + ".txt"
+	if os.path.exists(archive_filename):
+		os.rename(archive_filename, archive_filename + ".bak")
+	shutil.copy(log_filename, log_filename + ".bak")
+
+	def restore_log(_):
+		for filename in (archive_filename + ".gz", archive_filename + ".gz.idx", weeelab.journal_filename()):
+			if os.path.exists(filename):
+				os.remove(filename)
+		shutil.copy(log_filename + ".bak", log_filename)
+		with open(month_filename, "w") as month_file:
+			month_file.write(last_month + "\n")
+		weeelab.INLAB_INDEX_CACHE = None
+
+	add("create_backup_if_necessary", measure(lambda i: weeelab.create_backup_if_necessary(), repeat, restore_log))
+	return results
+
+
+def compare(results: list, baseline: list, threshold: float) -> bool:
+	"""
+	Print how much faster or slower each operation is than in another run, by median
+
+	:param threshold: slower than this ratio (and by more than NOISE_MS) is a regression
+	:return: True if nothing regressed
+	"""
+	before = {(result["operation"], result["lines"]): result for result in baseline}
+	ok = True
+	print(f"\n{'lines':>8}  {'operation':<32} {'before':>10} {'after':>10}  ratio")
+	for result in results:
+		old = before.get((result["operation"], result["lines"]))
+		if old is None:
+			continue
+		ratio = result["median_ms"] / old["median_ms"] if old["median_ms"] > 0 else float("inf")
+		regression = ratio > threshold and result["median_ms"] - old["median_ms"] > NOISE_MS
+		ok = ok and not regression
+		print(f"{result['lines']:>8}  {result['operation']:<32} {old['median_ms']:8.3f}ms {result['median_ms']:8.3f}ms  "
+			f"{ratio:.2f}{'  REGRESSION' if regression else ''}")
+	return ok
+
+
+def git_commit() -> Optional[str]:
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+			capture_output=True, text=True, check=True).stdout.strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def argparse_this():
+	parser = argparse.ArgumentParser(description="Benchmark weeelab on synthetic logs")
+	parser.add_argument('--sizes', type=str, default="1000,10000,50000", help='lines in log.txt, comma separated (default 1000,10000,50000)')
+	parser.add_argument('--users', type=int, default=200, help='different users (default 200)')
+	parser.add_argument('--open', type=int, default=20, help='people still in lab (default 20)')
+	parser.add_argument('--archives', type=int, default=1, help='months of archives (default 1)')
+	parser.add_argument('--repeat', type=int, default=20, help='times each operation is run (default 20)')
+	parser.add_argument('--latency', type=float, default=0.002, help='seconds for each round trip to the stub LDAP (default 0.002)')
+	parser.add_argument('--output', type=str, default="benchmark.json", metavar='FILE', help='where to save results (default benchmark.json)')
+	parser.add_argument('--compare', type=str, metavar='FILE', help='results of another run, to compare with')
+	parser.add_argument('--threshold', type=float, default=1.25, help='with --compare, slower than this ratio is a regression (default 1.25)')
+	args = parser.parse_args()
+
+	directory = tempfile.mkdtemp(prefix="weeelab-benchmark-")
+	try:
+		weeelab = load_weeelab(directory)
+		stub_ldap.install(weeelab, args.users, args.latency)
+		results = []
+		for lines in (int(size) for size in args.sizes.split(",")):
+			results.extend(benchmark_log(weeelab, directory, lines, args.users, args.open, args.archives, args.repeat))
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+
+	with open(args.output, "w") as output_file:
+		json.dump({
+			"version": RESULTS_VERSION,
+			"date": strftime("%Y-%m-%dT%H:%M:%S"),
+			"commit": git_commit(),
+			"python": platform.python_version(),
+			"platform": platform.platform(),
+			"parameters": {name: value for name, value in vars(args).items() if name not in ("output", "compare", "threshold")},
+			"results": results,
+		}, output_file, indent=1)
+	print(f"Results saved to {args.output}")
+
+	if args.compare is not None:
+		with open(args.compare, "r") as baseline_file:
+			baseline = json.load(baseline_file)
+		if not compare(results, baseline["results"], args.threshold):
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	argparse_this()
@@ -0,0 +1,219 @@
+"""
+Many weeelabs logging people in and out of the same log file at the same time, like the terminals in the lab
+but faster. Afterwards, check that the log contains exactly what they did and report how fast it was and how
+long they waited for each other.
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from time import perf_counter
+
+from benchmarks import stub_ldap
+from benchmarks.generate import generate, username
+from benchmarks.run import load_weeelab
+
+# Users in the generated log are user0000 to user0199, these are the ones doing things during the test
+FIRST_USER = 1000
+
+
+def worker_users(worker: int, workers: int, users: int) -> list:
+	"""
+	Users of a worker: each worker has its own, so what it expects to find in the log doesn't depend on the others
+
+	:param users: users per worker
+	"""
+	return [username(FIRST_USER + worker + n * workers) for n in range(users)]
+
+
+def worker(directory: str, number: int, workers: int, users: int, operations: int, latency, seed: int, start, results):
+	"""
+	Log in and out random users, time each operation
+
+	:param latency: seconds per round trip to the stub LDAP, None to run with --no-ldap
+	:param start: multiprocessing.Event, to start all workers at the same time
+	:param results: multiprocessing.Queue, gets a dict at the end
+	"""
+	weeelab = load_weeelab(directory)
+	use_ldap = latency is not None
+	if use_ldap:
+		stub_ldap.install(weeelab, FIRST_USER + workers * users, latency)
+	rng = random.Random(seed * 1000 + number)
+	mine = worker_users(number, workers, users)
+	in_lab = set()
+	# username -> messages of its sessions, in order
+	sessions = {user: [] for user in mine}
+	timings = {"login": [], "logout": []}
+	lock_wait = []
+	failed = 0
+
+	start.wait()
+	begin = perf_counter()
+	with redirect_stdout(io.StringIO()):
+		for operation in range(operations):
+			user = rng.choice(mine)
+			wait_before = weeelab.LOCK_STATS["wait"]
+			op_start = perf_counter()
+			try:
+				if user in in_lab:
+					message = f"Stress test worker {number} operation {operation}"
+					ok = weeelab.logout(user, use_ldap, message)
+					kind = "logout"
+				else:
+					weeelab.login(user, use_ldap)
+					ok = True
+					kind = "login"
+			except (weeelab.LockTimeoutError, weeelab.LdapError, weeelab.UserNotFoundError):
+				failed += 1
+				continue
+			timings[kind].append(perf_counter() - op_start)
+			lock_wait.append(weeelab.LOCK_STATS["wait"] - wait_before)
+			if not ok:
+				failed += 1
+			elif kind == "login":
+				in_lab.add(user)
+				sessions[user].append(None)
+			else:
+				in_lab.remove(user)
+				sessions[user][-1] = message
+	results.put({
+		"worker": number,
+		"elapsed": perf_counter() - begin,
+		"timings": timings,
+		"lock_wait": lock_wait,
+		"lock_stats": dict(weeelab.LOCK_STATS),
+		"failed": failed,
+		"sessions": sessions,
+	})
+
+
+def check_log(weeelab, sessions: dict) -> list:
+	"""
+	Compare the log with what workers did: every session they started is there exactly once, in order, closed
+	with the right message if they closed it and still open if they didn't.
+
+	:param sessions: username -> messages of its sessions, None for the open one
+	:return: problems found, empty if everything is fine
+	"""
+	found = {user: [] for user in sessions}
+	problems = []
+	for line in weeelab.read_log_lines():
+		try:
+			user = weeelab.line_username(line)
+		except IndexError:
+			problems.append(f"Broken line: {line!r}")
+			continue
+		if user not in found:
+			continue
+		if weeelab.inlab_line(line):
+			found[user].append(None)
+		elif weeelab.line_message(line) is not None:
+			found[user].append(weeelab.line_message(line))
+		else:
+			problems.append(f"Line without a message: {line!r}")
+	for user, expected in sessions.items():
+		if found[user] != expected:
+			lost = [message for message in expected if message not in found[user]]
+			duplicated = {message for message in found[user] if found[user].count(message) > 1}
+			problems.append(f"{user}: expected {len(expected)} sessions, found {len(found[user])}"
+				f" (lost: {lost}, duplicated: {sorted(duplicated, key=str)})")
+	open_sessions = {user for user, messages in sessions.items() if messages and messages[-1] is None}
+	in_lab = set(weeelab.load_inlab_index()) & set(sessions)
+	if in_lab != open_sessions:
+		problems.append(f"Index of people in lab is wrong: {sorted(in_lab ^ open_sessions)}")
+	return problems
+
+
+def percentile(samples: list, fraction: float) -> float:
+	ordered = sorted(samples)
+	return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+def argparse_this():
+	parser = argparse.ArgumentParser(description="Log in and out from many processes at once on the same log")
+	parser.add_argument('--workers', type=int, default=8, help='processes (default 8)')
+	parser.add_argument('--users', type=int, default=5, help='users per process (default 5)')
+	parser.add_argument('--operations', type=int, default=200, help='logins and logouts per process (default 200)')
+	parser.add_argument('--lines', type=int, default=3000, help='lines already in log.txt (default 3000)')
+	parser.add_argument('--latency', type=float, help='use a stub LDAP with this many seconds per round trip (default --no-ldap)')
+	parser.add_argument('--seed', type=int, default=0, help='random seed (default 0)')
+	parser.add_argument('--output', type=str, metavar='FILE', help='save results to FILE, as JSON')
+	args = parser.parse_args()
+
+	directory = tempfile.mkdtemp(prefix="weeelab-stress-")
+	try:
+		generate(directory, args.lines, FIRST_USER, 0, 0, args.seed)
+		weeelab = load_weeelab(directory)
+		start = multiprocessing.Event()
+		results = multiprocessing.Queue()
+		processes = [
+			multiprocessing.Process(target=worker, args=(
+				directory, number, args.workers, args.users, args.operations, args.latency, args.seed, start, results))
+			for number in range(args.workers)]
+		for process in processes:
+			process.start()
+		begin = perf_counter()
+		start.set()
+		reports = [results.get() for _ in processes]
+		elapsed = perf_counter() - begin
+		for process in processes:
+			process.join()
+
+		sessions = {}
+		for report in reports:
+			sessions.update(report["sessions"])
+		with redirect_stdout(io.StringIO()):
+			problems = check_log(weeelab, sessions)
+	finally:
+		shutil.rmtree(directory, ignore_errors=True)
+
+	operations = {kind: [t for report in reports for t in report["timings"][kind]] for kind in ("login", "logout")}
+	every_operation = operations["login"] + operations["logout"]
+	lock_wait = [t for report in reports for t in report["lock_wait"]]
+	summary = {
+		"workers": args.workers,
+		"users": args.users * args.workers,
+		"operations": len(every_operation),
+		"failed": sum(report["failed"] for report in reports),
+		"elapsed": elapsed,
+		"throughput": len(every_operation) / elapsed,
+		"latency_ms": {
+			kind: {"p50": percentile(samples, .5) * 1000, "p99": percentile(samples, .99) * 1000}
+			for kind, samples in list(operations.items()) + [("all", every_operation)]},
+		"lock_wait_ms": {
+			"total": sum(lock_wait) * 1000,
+			"p50": percentile(lock_wait, .5) * 1000,
+			"p99": percentile(lock_wait, .99) * 1000,
+		},
+		"lock_contended": sum(report["lock_stats"]["contended"] for report in reports),
+		"lock_acquired": sum(report["lock_stats"]["acquired"] for report in reports),
+		"problems": problems,
+	}
+
+	print(f"{summary['operations']} operations by {args.workers} processes in {elapsed:.2f} s: {summary['throughput']:.0f} per second")
+	for kind, latency in summary["latency_ms"].items():
+		print(f"{kind:<8} p50 {latency['p50']:8.2f} ms  p99 {latency['p99']:8.2f} ms")
+	print(f"Waiting for the lock: {summary['lock_wait_ms']['total']:.0f} ms in total, p50 {summary['lock_wait_ms']['p50']:.2f} ms, "
+		f"p99 {summary['lock_wait_ms']['p99']:.2f} ms, {summary['lock_contended']} times out of {summary['lock_acquired']}")
+	if summary["failed"]:
+		print(f"{summary['failed']} operations failed")
+	if args.output is not None:
+		with open(args.output, "w") as output_file:
+			json.dump(summary, output_file, indent=1)
+	if problems:
+		print(f"{len(problems)} problems in the log:")
+		for problem in problems:
+			print(problem)
+		sys.exit(1)
+	print("Log is consistent: nothing lost, nothing duplicated, every session closed once.")
+
+
+if __name__ == '__main__':
+	argparse_this()
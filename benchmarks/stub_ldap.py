@@ -0,0 +1,83 @@
+"""
+A stand-in for python-ldap, that knows the users made up by benchmarks.generate and takes a fixed time to answer
+"""
+
+import re
+import types
+from time import sleep
+
+from benchmarks.generate import username
+
+
+class LDAPError(Exception):
+	pass
+
+
+class SERVER_DOWN(LDAPError):
+	pass
+
+
+class StubConnection:
+	def __init__(self, users: int, latency: float):
+		self.users = users
+		self.latency = latency
+		self.protocol_version = None
+
+	def start_tls_s(self):
+		sleep(self.latency)
+
+	def simple_bind_s(self, who: str, password: str):
+		sleep(self.latency)
+
+	def set_option(self, option: int, value):
+		pass
+
+	def unbind_s(self):
+		pass
+
+	def search_s(self, tree: str, scope: int, the_filter: str, attributes: tuple) -> list:
+		sleep(self.latency)
+		found = set()
+		for name, value in re.findall(r"\((uid|schacpersonaluniquecode)=([^)]*)\)", the_filter):
+			# user0042 or s100042, no need to look at every user
+			number = value[4:] if name == 'uid' else value[1:]
+			if number.isdigit():
+				number = int(number) - (0 if name == 'uid' else 100000)
+				if 0 <= number < self.users and user_entry(number)[name][0] == value.lower().encode():
+					found.add(number)
+		return [(f"uid={username(number)},ou=People,dc=example,dc=com", user_entry(number)) for number in sorted(found)]
+
+
+def user_entry(number: int) -> dict:
+	"""
+	Attributes of a generated user, as python-ldap returns them
+	"""
+	return {
+		'uid': [username(number).encode()],
+		'cn': [f"User {number}".encode()],
+		'givenname': [b"User"],
+		'signedsir': [b"true"],
+		'schacpersonaluniquecode': [f"s{100000 + number}".encode()],
+	}
+
+
+def install(weeelab, users: int, latency: float = 0.0):
+	"""
+	Make weeelab talk to the stub instead of importing python-ldap
+
+	:param weeelab: the weeelab module
+	:param users: how many users the stub knows, as in benchmarks.generate
+	:param latency: seconds taken by every round trip
+	"""
+	module = types.ModuleType("ldap")
+	module.VERSION3 = 3
+	module.SCOPE_SUBTREE = 2
+	module.OPT_NETWORK_TIMEOUT = 0x5005
+	module.OPT_TIMEOUT = 0x5002
+	module.LDAPError = LDAPError
+	module.SERVER_DOWN = SERVER_DOWN
+	module.initialize = lambda server: StubConnection(users, latency)
+	weeelab.ldap = module
+	weeelab.escape_filter_chars = lambda text: re.sub(r"([\\*()\0])", lambda m: f"\\{ord(m.group(1)):02x}", text)
+	weeelab.LDAP_SERVER = "ldaps://stub"
+	weeelab.LDAP_CONNECTION = None
@@ -20,27 +20,92 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
 import sys
+from time import sleep, monotonic, time, perf_counter, strftime
+
+# For --startup-timing, before importing anything else
+STARTUP_CLOCK = perf_counter()
+STARTUP_TIMES = []
+
+# Only what every action needs is imported here. The rest (ldap, readline, json, ...) is imported by
+# the functions that need it, so that read-only actions like -p start as fast as possible.
 import argparse
+import fcntl
+import signal
+import threading
+import io
+import atexit
 # For the copyright string in --help
 from argparse import RawDescriptionHelpFormatter
-from shutil import copy2
-# Allows using backspace and arrow keys in input
-# noinspection PyUnresolvedReferences
-import readline
 from getpass import getuser
-from datetime import datetime
-from time import sleep
 from typing import Optional
-from dotenv import load_dotenv
-from select import select
-import subprocess
-import os
+from contextlib import contextmanager, redirect_stdout, nullcontext
+
+# Imported by import_ldap()
+ldap = None
+escape_filter_chars = None
+
+
+@contextmanager
+def startup_timer(phase: str):
+	"""
+	Measure how long something takes, for --startup-timing and --trace
+
+	:param phase: what is being measured
+	"""
+	start = perf_counter()
+	try:
+		yield
+	finally:
+		STARTUP_TIMES.append((phase, perf_counter() - start))
+
+
+def import_ldap():
+	"""
+	Import python-ldap, which takes a while, the first time it's needed
+	"""
+	global ldap, escape_filter_chars
+	if ldap is None:
+		with startup_timer("import ldap"):
+			import ldap
+			from ldap.filter import escape_filter_chars
+
+
+def load_env():
+	"""
+	Load .env into the environment, without overriding variables that are already set. It's parsed here rather
+	than with python-dotenv, which alone takes longer to import than everything else.
+
+	Lines are KEY=VALUE, optionally preceded by "export". Values can be in single or double quotes, and # starts
+	a comment outside quotes. Variables in values aren't expanded.
+	"""
+	env_filename = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.env')
+	try:
+		with open(env_filename, "r") as env_file:
+			lines = env_file.read().splitlines()
+	except FileNotFoundError:
+		return
+	for line in lines:
+		line = line.strip()
+		if line.startswith("export "):
+			line = line[len("export "):].lstrip()
+		if line == "" or line.startswith("#") or "=" not in line:
+			continue
+		name, value = line.split("=", 1)
+		name = name.strip()
+		value = value.strip()
+		if value[:1] in ('"', "'") and value.find(value[0], 1) > 0:
+			quote = value[0]
+			value = value[1:value.index(quote, 1)]
+			if quote == '"':
+				value = value.replace("\\n", "\n")
+		else:
+			value = value.split(" #", 1)[0].rstrip()
+		os.environ.setdefault(name, value)
 
-if '--no-ldap' not in sys.argv:
-	from ldap.filter import escape_filter_chars
-	import ldap
 
-load_dotenv(os.path.join(os.path.dirname(os.path.realpath(__file__)), '.env'))
+STARTUP_TIMES.append(("imports", perf_counter() - STARTUP_CLOCK))
+with startup_timer(".env"):
+	load_env()
 
 COLOR_RED = "\033[1;31m"
 COLOR_NATIVE = "\033[m"
@@ -55,14 +120,129 @@ LDAP_SERVER = os.getenv("LDAP_SERVER")
 LDAP_BIND_DN = os.getenv("LDAP_BIND_DN")
 LDAP_PASSWORD = os.getenv("LDAP_PASSWORD")
 LDAP_TREE = os.getenv("LDAP_TREE")
+# Seconds to wait for the LDAP server to connect or answer, then users in cache are used
+LDAP_TIMEOUT = float(os.getenv("LDAP_TIMEOUT", "5"))
 LOG_PATH = os.getenv("LOG_PATH")
-LOG_FILENAME = LOG_PATH + "/log.txt"
+# This and the other files in LOG_PATH are set by set_log_path()
+LOG_FILENAME = None
+# "file" for log.txt, "sqlite" for SQLITE_PATH, see storage()
+STORAGE = os.getenv("STORAGE", "file")
+SQLITE_FILENAME = None
 FIRST_IN = os.getenv("FIRST_IN_SCRIPT_PATH")
 LAST_OUT = os.getenv("LAST_OUT_SCRIPT_PATH")
+# Seconds a hook waits before running: if the opposite one comes in the meantime, neither runs
+HOOK_WINDOW = float(os.getenv("HOOK_WINDOW", "60"))
+# Seconds before a hook is killed
+HOOK_TIMEOUT = float(os.getenv("HOOK_TIMEOUT", "300"))
+# Then log.txt.hooks.log is moved to log.txt.hooks.log.1
+HOOK_OUTPUT_MAX_SIZE = 1024 * 1024
+# Directories where log.txt and the archives are mirrored, separated by ":", see replicate()
+REPLICA_PATHS = [path for path in os.getenv("REPLICA_PATHS", "").split(os.pathsep) if path]
+# Seconds to wait after a change before replicating it, so changes that come in the meantime are copied together
+REPLICA_DELAY = float(os.getenv("REPLICA_DELAY", "10"))
+# Replicas are compared and copied in blocks of this size
+REPLICA_BLOCK_SIZE = 64 * 1024
+SOCKET_PATH = None
+# Seconds to wait for the daemon to answer: it may be waiting for locks and LDAP, too
+DAEMON_TIMEOUT = 60
+# Where --http listens if no address is given, HOST:PORT
+HTTP_ADDRESS = os.getenv("HTTP_ADDRESS", "127.0.0.1:8080")
+# Without inotify, --http checks if the log changed this often (seconds)
+HTTP_POLL_INTERVAL = 1
+# Default logout message for --close-lab
+CLOSE_LAB_MESSAGE = "Logged out at closing time"
+# Default logout message for --kiosk, when nobody can type one
+KIOSK_MESSAGE = "Logged out with the card reader"
+# What a client sends to the daemon
+FORWARDED_ARGS = ('login', 'logout', 'message', 'inlab', 'log', 'ldap')
+# Options of -l
+LOG_VIEWER_ARGS = ('user', 'since', 'until', 'grep', 'tail', 'follow', 'archives')
 
 FIRST_IN_HAPPENED = False
 LAST_OUT_HAPPENED = False
 SIR_HAPPENED = False
+# Set by log_lock() when something may have been written, for launch_replication()
+LOG_WRITTEN = False
+
+# Bound connection, reused for every lookup
+LDAP_CONNECTION = None
+# Thread connecting to LDAP while the user types, from ldap_connect_in_background()
+LDAP_CONNECTING = None
+# Users found in LDAP, to avoid asking again and to use when LDAP is down
+USER_CACHE_FILENAME = None
+# Seconds before a cached user is refreshed from LDAP
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", str(24 * 60 * 60)))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1000"))
+# (mtime, users, aliases) of the last cache file read
+USER_CACHE = None
+USER_CACHE_LOCK = threading.Lock()
+
+# Time spent in lab, per day and user, for every archived log
+REPORT_CACHE_FILENAME = None
+# Full-text index of logout messages, for --search
+SEARCH_INDEX_FILENAME = None
+# Only messages are searched, accents don't matter ("perche" finds "perché")
+SEARCH_INDEX_COLUMNS = "message, username UNINDEXED, login UNINDEXED, logout UNINDEXED, duration UNINDEXED, " \
+	"tokenize = 'unicode61 remove_diacritics 2'"
+
+# Local copy of the directory, made by --sync-directory
+DIRECTORY_FILENAME = None
+DIRECTORY_PAGE_SIZE = 500
+# (mtime, (users, names, matricole)) of the last directory file read
+DIRECTORY = None
+
+LDAP_USER_ATTRIBUTES = ('uid', 'cn', 'givenname', 'signedsir', 'weeelabnickname', 'schacpersonaluniquecode')
+LDAP_STATS = {"connects": 0, "reconnects": 0, "searches": 0, "round_trips": 0, "connect_time": 0.0, "search_time": 0.0}
+
+# (log signature, open sessions) from the last time the sidecar index was read or written
+INLAB_INDEX_CACHE = None
+
+# Made by storage()
+STORAGE_BACKEND = None
+
+# Seconds to wait for other weeelab processes to finish with the log file, 0 waits forever
+LOCK_TIMEOUT = float(os.getenv("LOCK_TIMEOUT", "30"))
+# Lock currently held by this thread, for nested log_lock() calls
+LOCK_STATE = threading.local()
+LOCK_STATS = {"acquired": 0, "contended": 0, "wait": 0.0}
+
+# One JSON line per run is appended here with --trace or WEEELAB_TRACE=1, see write_trace()
+TRACE_FILENAME = None
+# Then it's moved to trace.jsonl.1, replacing the previous one
+TRACE_MAX_SIZE = int(os.getenv("TRACE_MAX_SIZE", str(1024 * 1024)))
+# Set by main() when tracing: action, result
+TRACE = None
+
+
+def set_log_path(path: str, environment: bool = True):
+	"""
+	Set where the log file is, and the database, caches, indexes and everything else that goes with it
+
+	:param path: directory, LOG_PATH or the debug one
+	:param environment: if False, ignore variables like SQLITE_PATH that put some of them elsewhere, so that
+	nothing outside path is touched
+	"""
+	global LOG_FILENAME, SQLITE_FILENAME, SOCKET_PATH, USER_CACHE_FILENAME, REPORT_CACHE_FILENAME
+	global SEARCH_INDEX_FILENAME, DIRECTORY_FILENAME, TRACE_FILENAME
+
+	def in_path(variable: str, filename: str) -> str:
+		return os.getenv(variable, path + "/" + filename) if environment else path + "/" + filename
+
+	LOG_FILENAME = path + "/log.txt"
+	SQLITE_FILENAME = in_path("SQLITE_PATH", "weeelab.sqlite")
+	SOCKET_PATH = in_path("SOCKET_PATH", "weeelab.sock")
+	USER_CACHE_FILENAME = in_path("USER_CACHE_PATH", "users.json")
+	REPORT_CACHE_FILENAME = in_path("REPORT_CACHE_PATH", "report-cache.json")
+	SEARCH_INDEX_FILENAME = in_path("SEARCH_INDEX_PATH", "search.sqlite")
+	DIRECTORY_FILENAME = in_path("DIRECTORY_PATH", "directory.json")
+	TRACE_FILENAME = in_path("TRACE_PATH", "trace.jsonl")
+
+
+set_log_path(LOG_PATH)
+
+ACTIONS = ('login', 'logout', 'interactive_login', 'interactive_logout', 'inlab', 'log', 'admin', 'merge_journal',
+	'serve', 'sync_directory', 'report', 'occupancy', 'trace_summary', 'close_lab', 'kiosk', 'run_hooks', 'import_logs', 'export_log',
+	'http', 'search', 'export', 'replicate', 'verify_replicas')
 
 # BACKUP_PATH = "/home/" + HOST_USER + "/ownCloud/" + PROGRAM_NAME.capitalize() + "/"
 
@@ -70,19 +250,28 @@ SIR_HAPPENED = False
 # A perfect candidate for dataclasses... which may not be available on an old Python version.
 # So no dataclasses.
 class User:
-	def __init__(self, username: str, full_name: str, first_name: str, signed_sir: bool):
+	def __init__(self, username: str, full_name: str, first_name: str, signed_sir: bool, nicknames: tuple = (), matricole: tuple = ()):
 		self.username = username
 		self.full_name = full_name
 		self.first_name = first_name
 		self.signed_sir = signed_sir
+		# Other names this user goes by, used only to find it in the cache
+		self.nicknames = nicknames
+		self.matricole = matricole
 
 
 class LdapError(BaseException):
+	def __init__(self, reason: Optional[str] = None):
+		# What went wrong, if it hasn't been printed already
+		self.reason = reason
+
+
+class UserNotFoundError(BaseException):
 	def __init__(self):
 		pass
 
 
-class UserNotFoundError(BaseException):
+class LockTimeoutError(BaseException):
 	def __init__(self):
 		pass
 
@@ -126,6 +315,10 @@ def check_hour(input_hour: str) -> bool:
 
 
 def matricolize(username: str):
+	# Known usernames and nicknames are not a matricola, even if they are made of digits
+	directory = load_directory()
+	if directory is not None and username.lower() in directory[1]:
+		return None
 	if username.isdigit():
 		return f"s{username}"
 	if username[1:].isdigit():
@@ -134,372 +327,2415 @@ def matricolize(username: str):
 	return None
 
 
-def get_user(username: str) -> User:
-	found = False
-	ambiguous = False
-	matricolized = matricolize(username)
-	username = escape_filter_chars(username)
-	if matricolized is None:
-		filters = (
-			f"(&(objectClass=weeeOpenPerson)(uid={username})(!(nsaccountlock=true)))",
-			f"(&(objectClass=weeeOpenPerson)(weeelabnickname={username})(!(nsaccountlock=true)))"
-		)
-	else:
-		filters = (
-			f"(&(objectClass=weeeOpenPerson)(schacpersonaluniquecode={matricolized})(!(nsaccountlock=true)))",
-		)
-	del matricolized
+def ldap_connection(verbose: bool = True):
+	"""
+	Get a connection to the LDAP server, already bound. It is opened the first time and then reused
+	for every lookup, until the process exits or the server drops it.
+
+	:param verbose: print errors
+	:return: LDAPObject
+	"""
+	global LDAP_CONNECTION, LDAP_CONNECTING
+	if LDAP_CONNECTING is not None:
+		connecting = LDAP_CONNECTING
+		LDAP_CONNECTING = None
+		with startup_timer("ldap connect wait"):
+			connecting.join()
+		if LDAP_CONNECTION is None:
+			# Already told the user, asking them what to do is better than waiting for another timeout
+			raise LdapError
+
+	if LDAP_CONNECTION is not None:
+		return LDAP_CONNECTION
+
+	LDAP_CONNECTION = ldap_bind(verbose)
+	return LDAP_CONNECTION
+
+
+def ldap_bind(verbose: bool = True):
+	"""
+	Connect to the LDAP server and bind. Use ldap_connection() instead, this always opens a new connection.
+
+	:param verbose: print errors, otherwise they're in the reason of the LdapError
+	:return: LDAPObject
+	"""
+	import_ldap()
 
+	start = monotonic()
 	try:
 		# print(f"Asking {LDAP_SERVER} for info...")
 		conn = ldap.initialize(LDAP_SERVER)
 		conn.protocol_version = ldap.VERSION3
+		conn.set_option(ldap.OPT_NETWORK_TIMEOUT, LDAP_TIMEOUT)
+		conn.set_option(ldap.OPT_TIMEOUT, LDAP_TIMEOUT)
 		if LDAP_SERVER.startswith('ldap://'):
 			conn.start_tls_s()
+			LDAP_STATS["round_trips"] += 1
 		conn.simple_bind_s(LDAP_BIND_DN, LDAP_PASSWORD)
+		LDAP_STATS["round_trips"] += 1
 	except ldap.SERVER_DOWN:
-		print(f"Cannot connect to LDAP server {LDAP_SERVER}")
-		raise LdapError
-	if conn is None:
-		print(f"Error connecting to LDAP server :(")
-		raise LdapError
-
-	for the_filter in filters:
-		result = conn.search_s(LDAP_TREE, ldap.SCOPE_SUBTREE, the_filter, (
-			'uid',
-			'cn',
-			'givenname',
-			'signedsir'
-		))
-		if len(result) > 1:
-			ambiguous = True
-		if len(result) == 1:
-			attr = result[0][1]
-			if 'signedsir' in attr:
-				signed_sir = attr['signedsir'][0].decode().lower() == 'true'
-			else:
-				signed_sir = False
-			return User(attr['uid'][0].decode(), attr['cn'][0].decode(), attr['givenname'][0].decode(), signed_sir)
-	conn.unbind_s()
+		reason = f"Cannot connect to LDAP server {LDAP_SERVER}"
+	except ldap.LDAPError as e:
+		reason = f"Error connecting to LDAP server {LDAP_SERVER}: {e}"
+	else:
+		reason = None
+	finally:
+		LDAP_STATS["connect_time"] += monotonic() - start
+	if reason is not None:
+		if verbose:
+			print(reason)
+		raise LdapError(None if verbose else reason)
 
-	if ambiguous:
-		print(f"Multiple accounts found for that username/matricola/nickname, try with another one.")
-		raise UserNotFoundError
-	if not found:
-		print(f"Username not recognized. Maybe you misspelled it or you're an intruder.")
-		raise UserNotFoundError
+	LDAP_STATS["connects"] += 1
+	if LDAP_STATS["connects"] == 1:
+		atexit.register(ldap_disconnect)
+	return conn
 
 
-def is_logged_in(username: str) -> bool:
+def ldap_connect_in_background():
 	"""
-	Check if user is already logged in.
-
-	:param username: normalized username
-	:return:
+	Start connecting to LDAP in a thread, so that it's done by the time the user has finished typing.
+	The next ldap_connection() waits for it and takes the connection. If it fails, the error is printed
+	right away and that ldap_connection() raises LdapError without trying again.
 	"""
-	logged = False
-	with open(LOG_FILENAME, "r") as log_file:
-		for line in log_file:
-			if inlab_line(line) and user_in_line(line, username):
-				logged = True
-				break
-	return logged
+	global LDAP_CONNECTING
+	if LDAP_CONNECTION is not None or LDAP_CONNECTING is not None:
+		return
 
+	def connect():
+		global LDAP_CONNECTION
+		try:
+			LDAP_CONNECTION = ldap_bind(verbose=False)
+		except LdapError as e:
+			print(f"\n{e.reason}, you'll be asked what to do if weeelab doesn't know you already")
+			if "readline" in sys.modules:
+				# Show again what has been typed so far, under the message
+				sys.modules["readline"].redisplay()
 
-def people_in_lab() -> int:
-	count = 0
-	with open(LOG_FILENAME, "r") as log_file:
-		for line in log_file:
-			if inlab_line(line):
-				count += 1
-	return count
+	# Daemon: if the server doesn't answer and the user gives up, don't wait for it to exit
+	LDAP_CONNECTING = threading.Thread(target=connect, daemon=True)
+	LDAP_CONNECTING.start()
 
 
-def is_empty(input_file) -> bool:
+def ldap_disconnect():
 	"""
-	Check if inputFile is empty.
+	Unbind and close the LDAP connection, if there's one
+	"""
+	global LDAP_CONNECTION
+	if LDAP_CONNECTION is not None:
+		conn = LDAP_CONNECTION
+		LDAP_CONNECTION = None
+		try:
+			conn.unbind_s()
+		except ldap.LDAPError:
+			pass
 
-	:param input_file:
-	:return:
+
+def ldap_search(the_filter: str, attributes: tuple, verbose: bool = True) -> list:
 	"""
-	if str(input_file.read())[:1] == "":
-		input_file.close()
-		return True
+	Search in LDAP_TREE. If the server has closed the connection in the meantime (timeouts, restarts, etc...),
+	connect and bind again and retry, once.
+
+	:param the_filter: LDAP filter, already escaped
+	:param attributes: attributes to get
+	:param verbose: print errors
+	:return: list of (dn, attributes)
+	"""
+	global LDAP_CONNECTION
+	for attempt in range(2):
+		conn = ldap_connection(verbose)
+		start = monotonic()
+		try:
+			LDAP_STATS["round_trips"] += 1
+			return conn.search_s(LDAP_TREE, ldap.SCOPE_SUBTREE, the_filter, attributes)
+		except ldap.SERVER_DOWN:
+			# Nothing to unbind, it's dead
+			LDAP_CONNECTION = None
+			if attempt > 0:
+				if verbose:
+					print(f"Cannot connect to LDAP server {LDAP_SERVER}")
+				raise LdapError
+			LDAP_STATS["reconnects"] += 1
+		except ldap.LDAPError as e:
+			if verbose:
+				print(f"Error talking to LDAP server {LDAP_SERVER}: {e}")
+			ldap_disconnect()
+			raise LdapError
+		finally:
+			LDAP_STATS["search_time"] += monotonic() - start
+			LDAP_STATS["searches"] += 1
+
+
+def ldap_get_user(username: str, verbose: bool = True) -> User:
+	import_ldap()
+	round_trips = LDAP_STATS["round_trips"]
+	start = monotonic()
+	matricolized = matricolize(username)
+	if matricolized is None:
+		# One search instead of two, results are told apart below
+		escaped = escape_filter_chars(username)
+		the_filter = f"(&(objectClass=weeeOpenPerson)(|(uid={escaped})(weeelabnickname={escaped}))(!(nsaccountlock=true)))"
 	else:
-		input_file.seek(0)
-		return False
+		the_filter = f"(&(objectClass=weeeOpenPerson)(schacpersonaluniquecode={escape_filter_chars(matricolized)})(!(nsaccountlock=true)))"
 
+	result = ldap_search(the_filter, LDAP_USER_ATTRIBUTES, verbose)
 
-def ensure_log_file():
-	if not os.path.exists(LOG_FILENAME):
-		if os.path.isdir(os.path.dirname(LOG_FILENAME)):
-			print(f"Creating empty log.txt")
-			open(LOG_FILENAME, "a").close()
+	if DEBUG_MODE and verbose:
+		print(f"LDAP lookup took {(monotonic() - start) * 1000:.1f} ms and {LDAP_STATS['round_trips'] - round_trips} round trips")
+
+	if matricolized is None:
+		# uid has priority over nickname, like when these were two separate searches. Both are case-insensitive in LDAP.
+		def matches(attr, name):
+			return username.lower() in (value.decode().lower() for value in attr.get(name, ()))
+
+		by_uid = [entry for entry in result if matches(entry[1], 'uid')]
+		by_nickname = [entry for entry in result if matches(entry[1], 'weeelabnickname')]
+		if len(by_uid) == 1:
+			result = by_uid
+		elif len(by_nickname) == 1:
+			result = by_nickname
+		elif len(by_uid) == 0 and len(by_nickname) == 0:
+			result = []
+
+	if len(result) == 1:
+		return user_from_ldap(result[0][1])
+
+	if verbose:
+		if len(result) > 1:
+			print(f"Multiple accounts found for that username/matricola/nickname, try with another one.")
 		else:
-			print(f"Cannot find directory {os.path.dirname(LOG_FILENAME)}")
-			secure_exit(1)
+			print(f"Username not recognized. Maybe you misspelled it or you're an intruder.")
+	raise UserNotFoundError
 
 
-def store_log_to(filename, destination):
+def user_from_ldap(attr: dict) -> User:
 	"""
-	Copy a log file (or anything, really) to a directory, if DEBUG_MODE is False
+	Build a User from the attributes of an LDAP entry
 
-	:param filename: Path to source file
-	:param destination: Path to destination file or directory
+	:param attr: attributes, as returned by python-ldap
+	:return: the user
 	"""
-	if DEBUG_MODE:
-		print(f"DEBUG_MODE, skipped copying {os.path.basename(filename)} to {destination}")
+	if 'signedsir' in attr:
+		signed_sir = attr['signedsir'][0].decode().lower() == 'true'
 	else:
-		copy2(filename, destination)
+		signed_sir = False
+	return User(
+		attr['uid'][0].decode(), attr['cn'][0].decode(), attr['givenname'][0].decode(), signed_sir,
+		tuple(value.decode() for value in attr.get('weeelabnickname', ())),
+		tuple(value.decode() for value in attr.get('schacpersonaluniquecode', ())),
+	)
 
 
-def create_backup_if_necessary():
-	# Open master log file
-	with open(LOG_FILENAME, "r") as log_file:
-		if not is_empty(log_file):  # If current log file is not empty
-			last_month_year = str(log_file.read())[4:11]
-
-			curr_month = int(datetime.now().strftime("%m"))
-			curr_year = int(datetime.now().strftime("%Y"))
-			last_date = datetime.strptime(last_month_year, "%m/%Y")
-			last_month = int(last_date.strftime("%m"))
-			last_year = int(last_date.strftime("%Y"))
-
-			# If the inexorable passage of time has been perceived by this program, too...
-			if (curr_month > last_month) or (curr_year > last_year):
-				# log.txt -> log201901.txt, foo.txt -> foo201901.txt, etc...
-				stored_log_filename = LOG_FILENAME.rsplit('.', 1)[0] + last_date.strftime("%Y%m") + ".txt"
-				print(f"Backing up log file to {os.path.basename(stored_log_filename)}")
-				os.rename(LOG_FILENAME, stored_log_filename)
-				# store_log_to(stored_log_filename, BACKUP_PATH)
-				# print(f"Done!")
-
-				open(LOG_FILENAME, "a").close()
-				print(f"New log file was created.")
+def ldap_paged_search(the_filter: str, attributes: tuple) -> tuple:
+	"""
+	Search in LDAP_TREE, a page at a time, for searches that may return more entries than the server allows
 
+	:param the_filter: LDAP filter, already escaped
+	:param attributes: attributes to get
+	:return: (list of (dn, attributes), number of pages)
+	"""
+	import_ldap()
+	from ldap.controls import SimplePagedResultsControl
+
+	conn = ldap_connection()
+	control = SimplePagedResultsControl(True, size=DIRECTORY_PAGE_SIZE, cookie='')
+	results = []
+	pages = 0
+	while True:
+		try:
+			message_id = conn.search_ext(LDAP_TREE, ldap.SCOPE_SUBTREE, the_filter, attributes, serverctrls=[control])
+			_, data, _, server_controls = conn.result3(message_id)
+		except ldap.LDAPError as e:
+			print(f"Error talking to LDAP server {LDAP_SERVER}: {e}")
+			ldap_disconnect()
+			raise LdapError
+		LDAP_STATS["round_trips"] += 1
+		LDAP_STATS["searches"] += 1
+		pages += 1
+		results.extend(data)
+		cookies = [c.cookie for c in server_controls if c.controlType == SimplePagedResultsControl.controlType]
+		if not cookies or not cookies[0]:
+			return results, pages
+		control.cookie = cookies[0]
+
+
+def load_directory() -> Optional[tuple]:
+	"""
+	Read the local copy of the directory made by --sync-directory, if it changed since the last time
 
-def login(username: str, use_ldap: bool):
+	:return: (uid -> User, lowercase uid or nickname -> uid, lowercase matricola -> uid), None if there's no copy
 	"""
-	Log in. Add the line in the file. Do it.
+	global DIRECTORY
+	try:
+		mtime = os.stat(DIRECTORY_FILENAME).st_mtime_ns
+	except FileNotFoundError:
+		return None
+	if DIRECTORY is not None and DIRECTORY[0] == mtime:
+		return DIRECTORY[1]
+	import json
+	try:
+		with open(DIRECTORY_FILENAME, "r") as directory_file:
+			entries = json.load(directory_file)["users"]
+	except (OSError, ValueError, KeyError) as e:
+		print(f"Cannot read {DIRECTORY_FILENAME}, ignoring it: {e}")
+		return None
 
-	:param use_ldap: Connect to remote LDAP server or blindly trust the input
-	:param username: User-supplied username
+	users = {}
+	names = {}
+	matricole = {}
+	for uid, entry in entries.items():
+		users[uid] = User(uid, entry["full_name"], entry["first_name"], entry["signed_sir"], tuple(entry["nicknames"]), tuple(entry["matricole"]))
+		for nickname in entry["nicknames"]:
+			names[nickname.lower()] = uid
+		for matricola in entry["matricole"]:
+			matricole[matricola.lower()] = uid
+	# uids take precedence over nicknames
+	for uid in users:
+		names[uid.lower()] = uid
+	DIRECTORY = (mtime, (users, names, matricole))
+	return DIRECTORY[1]
+
+
+def directory_lookup(username: str) -> Optional[User]:
+	"""
+	Look for a user in the local copy of the directory
+
+	:param username: username, nickname or matricola
+	:return: the user, or None if it's not there
 	"""
+	directory = load_directory()
+	if directory is None:
+		return None
+	users, names, matricole = directory
+	uid = names.get(username.lower())
+	if uid is None:
+		matricolized = matricolize(username)
+		if matricolized is not None:
+			uid = matricole.get(matricolized.lower())
+	if uid is None:
+		return None
+	return users[uid]
 
-	lab_was_empty = people_in_lab() == 0
 
-	if use_ldap:
-		user = get_user(username)
-		username = user.username
-		pretty_name = user.full_name
-		check_sir(user)
-	else:
-		print(COLOR_RED)
-		print("WARNING: bypassing LDAP lookup, make sure that this is the correct username and not an alias")
-		print(COLOR_NATIVE)
-		pretty_name = username
+def sync_directory(full: bool = False):
+	"""
+	Download all the users from LDAP into the local copy of the directory. If there's already a copy, and
+	unless a full sync is requested, only entries modified since the last sync are downloaded: in that case
+	deleted users stay in the copy until the next full sync, locked ones are removed.
 
-	if is_logged_in(username):
-		print(f"{pretty_name}, you're already logged in.")
+	:param full: download everything, even if there's a copy already
+	"""
+	import json
+	import_ldap()
+	start = monotonic()
+	previous = None
+	if not full:
+		try:
+			with open(DIRECTORY_FILENAME, "r") as directory_file:
+				previous = json.load(directory_file)
+		except FileNotFoundError:
+			pass
+		except ValueError:
+			print(f"{DIRECTORY_FILENAME} is corrupted, doing a full sync")
+		if previous is not None and ("modified" not in previous or "users" not in previous):
+			print(f"{DIRECTORY_FILENAME} is corrupted, doing a full sync")
+			previous = None
+
+	attributes = LDAP_USER_ATTRIBUTES + ('modifyTimestamp', 'nsaccountlock')
+	if previous is None:
+		the_filter = "(&(objectClass=weeeOpenPerson)(!(nsaccountlock=true)))"
+		entries = {}
 	else:
-		curr_time = datetime.now().strftime("%d/%m/%Y %H:%M")
-		login_string = f"[{curr_time}] [----------------] [INLAB] <{username}>\n"
-		with open(LOG_FILENAME, "a") as log_file:
-			log_file.write(login_string)
+		# Locked accounts have a new modifyTimestamp, too: they're found here and removed below
+		since = escape_filter_chars(previous["modified"])
+		the_filter = f"(&(objectClass=weeeOpenPerson)(modifyTimestamp>={since}))"
+		entries = previous["users"]
+
+	result, pages = ldap_paged_search(the_filter, attributes)
+
+	modified = previous["modified"] if previous is not None else "19700101000000Z"
+	added = updated = removed = 0
+	for _, attr in result:
+		if 'uid' not in attr:
+			continue
+		uid = attr['uid'][0].decode()
+		if 'modifyTimestamp' in attr:
+			modified = max(modified, attr['modifyTimestamp'][0].decode())
+		if attr.get('nsaccountlock', [b'false'])[0].decode().lower() == 'true':
+			if entries.pop(uid, None) is not None:
+				removed += 1
+			continue
+		user = user_from_ldap(attr)
+		if uid in entries:
+			updated += 1
+		else:
+			added += 1
+		entries[uid] = {
+			"full_name": user.full_name,
+			"first_name": user.first_name,
+			"signed_sir": user.signed_sir,
+			"nicknames": list(user.nicknames),
+			"matricole": list(user.matricole),
+		}
 
-		# store_log_to(LOG_FILENAME, BACKUP_PATH)
+	temp_filename = f"{DIRECTORY_FILENAME}.{os.getpid()}.tmp"
+	with open(temp_filename, "w") as directory_file:
+		json.dump({"modified": modified, "users": entries}, directory_file)
+	os.replace(temp_filename, DIRECTORY_FILENAME)
 
-		if lab_was_empty:
-			global FIRST_IN_HAPPENED
-			FIRST_IN_HAPPENED = True
-		print(f"Login successful! Hello {pretty_name}!")
+	kind = "Full" if previous is None else "Incremental"
+	print(f"{kind} sync done in {monotonic() - start:.2f} s: {len(result)} entries in {pages} pages from LDAP, "
+		f"{added} added, {updated} updated, {removed} removed, {len(entries)} users in {os.path.basename(DIRECTORY_FILENAME)}")
 
 
-def logout(username: str, use_ldap: bool, message: Optional[str] = None):
+def get_user(username: str) -> User:
 	"""
-	Log out.
+	Find a user by username, nickname or matricola: in the local copy of the directory if there's one,
+	then in the cache, then in LDAP.
+	Stale cache entries are still used, while a background thread asks LDAP for fresh data, if weeelab doesn't
+	exit first. This way, users that have already been seen can log in even when LDAP is down.
 
-	:param message: Logout message, None to ask
-	:param use_ldap: Connect to remote LDAP server or blindly trust the input
-	:param username: User-supplied username
+	:param username: whatever the user typed or swiped
+	:return: the user
 	"""
+	user = directory_lookup(username)
+	if user is not None:
+		return user
 
-	last_person = people_in_lab() == 1
+	user, fresh = user_cache_lookup(username)
+	if user is None:
+		user = ldap_get_user(username)
+		user_cache_store(user)
+	elif not fresh:
+		# Daemon, so that it doesn't keep weeelab from exiting while LDAP is slow or down
+		threading.Thread(target=refresh_cached_user, args=(username,), daemon=True).start()
+	return user
 
-	if not use_ldap:
-		print(COLOR_RED)
-		print("WARNING: bypassing LDAP lookup, make sure that this is the correct username and not an alias")
-		print(COLOR_NATIVE)
 
-	if is_logged_in(username):
-		# Using username, and found
-		pretty_name = username
-	else:
-		# Not found, is it an alias?
-		if use_ldap:
-			# Grab the real username
-			user = get_user(username)
-			new_username = user.username
-			pretty_name = user.full_name
-			check_sir(user)
-			if username == new_username or not is_logged_in(new_username):
-				print(f"You aren't in lab! Did you forget to log in?")
-				return False
-			username = new_username
-		else:
-			# Cannot get it from LDAP
-			print(f"You aren't in lab! Did you use an alias or ID number? These do not work right now")
-			return False
+def refresh_cached_user(username: str):
+	"""
+	Get fresh data from LDAP for a user in cache, silently. Runs in a background thread.
+	"""
+	try:
+		user = ldap_get_user(username, verbose=False)
+	except LdapError:
+		return
+	except UserNotFoundError:
+		# Deleted or locked in the meantime
+		user_cache_forget(username)
+		return
+	user_cache_store(user)
 
-	curr_time = datetime.now().strftime("%d/%m/%Y %H:%M")
-	if message is None:
-		workdone = ask_work_done()
-	else:
-		workdone = message
 
-	if write_logout(username, curr_time, workdone):
-		if last_person:
-			global LAST_OUT_HAPPENED
-			LAST_OUT_HAPPENED = True
-		print(f"Logout successful! Bye {pretty_name}!")
-		return True
-	else:
-		print(f"Logout failed")
-		return False
+def user_cache_keys(username: str) -> list:
+	"""
+	Keys to find a user in the cache: the lowercase username/nickname, and the matricola if it looks like one
+	"""
+	keys = [username.lower()]
+	matricolized = matricolize(username)
+	if matricolized is not None:
+		keys.insert(0, matricolized.lower())
+	return keys
 
 
-def check_sir(user):
-	global SIR_HAPPENED
-	SIR_HAPPENED = not user.signed_sir
+def load_user_cache() -> dict:
+	"""
+	Read the user cache, if it changed since the last time
 
+	:return: uid -> dict with the User fields plus "fetched" and "used" timestamps
+	"""
+	global USER_CACHE
+	try:
+		mtime = os.stat(USER_CACHE_FILENAME).st_mtime_ns
+	except FileNotFoundError:
+		return {}
+	if USER_CACHE is not None and USER_CACHE[0] == mtime:
+		return USER_CACHE[1]
+	import json
+	try:
+		with open(USER_CACHE_FILENAME, "r") as cache_file:
+			users = json.load(cache_file)
+	except (OSError, ValueError):
+		users = {}
+
+	aliases = {}
+	for uid, entry in users.items():
+		for alias in entry["nicknames"] + entry["matricole"]:
+			aliases[alias.lower()] = uid
+	# uids take precedence over nicknames
+	for uid in users:
+		aliases[uid.lower()] = uid
+	USER_CACHE = (mtime, users, aliases)
+	return users
+
+
+def save_user_cache(users: dict):
+	"""
+	Replace the user cache, dropping the least recently used users if there are too many
+	"""
+	import json
 
-def ask_work_done():
+	global USER_CACHE
+	if len(users) > USER_CACHE_SIZE:
+		keep = sorted(users, key=lambda uid: users[uid]["used"], reverse=True)[:USER_CACHE_SIZE]
+		users = {uid: users[uid] for uid in keep}
+	temp_filename = f"{USER_CACHE_FILENAME}.{os.getpid()}.{threading.get_ident()}.tmp"
 	try:
-		ok = False
-		workdone = ""
-		while not ok:
-			workdone = input(f"What have you done?\n:: ").strip()
-			if len(workdone) > MAX_WORK_DONE:
-				print(f"I didn't ask you the story of your life! Type a shorter sentence!")
-			elif len(workdone) <= 0:
-				print(f"Come on, tell me something! How was your day?")
-			else:
-				ok = True
-	except KeyboardInterrupt:
-		print(f"Logout cancelled by keyboard interrupt")
-		secure_exit(5)
-		return None  # Just prevents PyCharm from complaining
-	return workdone
+		with open(temp_filename, "w") as cache_file:
+			json.dump(users, cache_file)
+		os.replace(temp_filename, USER_CACHE_FILENAME)
+	except OSError as e:
+		print(f"Cannot save user cache: {e}")
+	USER_CACHE = None
 
 
-def work_time(timein, timeout) -> str:
+def user_cache_lookup(username: str) -> tuple:
 	"""
-	Returns the time spent in lab formatted as HH:MM
+	Look for a user in the cache
+
+	:param username: username, nickname or matricola
+	:return: (User or None, True if it's fresh)
 	"""
-	li = (int(timein[:2]) * 60) + int(timein[3:5])
-	lo = (int(timeout[:2]) * 60) + int(timeout[3:5])
-	hours = int((lo - li) / 60)
-	minutes = int((lo - li) % 60)
-	return str(hours).zfill(2) + ":" + str(minutes).zfill(2)
+	with USER_CACHE_LOCK:
+		users = load_user_cache()
+		if not users:
+			return None, False
+		aliases = USER_CACHE[2]
+		for key in user_cache_keys(username):
+			if key in aliases:
+				uid = aliases[key]
+				break
+		else:
+			return None, False
+
+		entry = users[uid]
+		now = time()
+		# Don't write the cache on every hit just for the LRU, once in a while is enough
+		if now - entry["used"] > 3600:
+			entry["used"] = now
+			save_user_cache(users)
+	user = User(uid, entry["full_name"], entry["first_name"], entry["signed_sir"], tuple(entry["nicknames"]), tuple(entry["matricole"]))
+	return user, now - entry["fetched"] < USER_CACHE_TTL
+
+
+def user_cache_store(user: User):
+	with USER_CACHE_LOCK:
+		users = dict(load_user_cache())
+		now = time()
+		users[user.username] = {
+			"full_name": user.full_name,
+			"first_name": user.first_name,
+			"signed_sir": user.signed_sir,
+			"nicknames": list(user.nicknames),
+			"matricole": list(user.matricole),
+			"fetched": now,
+			"used": now,
+		}
+		save_user_cache(users)
+
+
+def user_cache_forget(username: str):
+	with USER_CACHE_LOCK:
+		users = dict(load_user_cache())
+		if users:
+			for key in user_cache_keys(username):
+				uid = USER_CACHE[2].get(key)
+				if uid is not None:
+					del users[uid]
+					save_user_cache(users)
+					break
 
 
-def inlab_line(line: str) -> bool:
-	# [02/05/2017 10:00] [----------------] [INLAB] :: <
-	return line[39:44] == "INLAB"
+def is_logged_in(username: str) -> bool:
+	"""
+	Check if user is already logged in.
+
+	:param username: normalized username
+	:return:
+	"""
+	return username in storage().in_lab()
 
 
-def user_in_line(line: str, username: str) -> bool:
-	username_in_line = line.split('<', 1)[1].split('>', 1)[0]
-	return username == username_in_line
+def people_in_lab() -> int:
+	return len(storage().in_lab())
 
 
-def write_logout(username, curr_time, workdone) -> bool:
+def inlab_index_filename() -> str:
+	# log.txt -> log.txt.inlab, follows LOG_FILENAME in debug mode too
+	return LOG_FILENAME + ".inlab"
+
+
+def log_signature() -> tuple:
 	"""
-	I don't even want to know. This thing works, it's ok, don't touch it
+	Size and modification time of the log file, to tell if the index still matches it
+
+	:return: (size, mtime_ns)
 	"""
-	found = False
+	stat = os.stat(LOG_FILENAME)
+	return stat.st_size, stat.st_mtime_ns
 
-	log_list = []
-	with open(LOG_FILENAME, "r") as log_file:
-		for line in log_file:
-			if inlab_line(line) and user_in_line(line, username):
-				found = True
-				login_time = line[12:17]
-				logout_time = curr_time[11:17]
-				line = line.replace("----------------", curr_time)
-				line = line.replace("INLAB", work_time(login_time, logout_time))
-				line = line.replace("\n", "")
-
-				line = line + " :: " + workdone + "\n"
-			log_list.append(line)  # Store everything in the list
-
-	if found:
-		# add .lock file during writing process if there isn't one, wait until it's removed, then re-add it
-		while True:
-			try:
-				with open(LOG_FILENAME+'.lock', 'x'):
-					break
-			except FileExistsError:
-				sleep(.5)
 
-		# Writing everything to log file
-		with open(LOG_FILENAME, "w") as log_file:
-			for line in log_list:
-				log_file.write(line)
+def index_identity(stat=None) -> tuple:
+	"""
+	Which version of the index file this is. The log signature alone is the same after two logouts in place
+	within the same clock tick, but every save replaces the index file, which gets a new inode.
 
-		# remove .lock file
-		os.remove(LOG_FILENAME+'.lock')
+	:param stat: of the index file, None to look at it now
+	:return: (inode, ctime_ns), or None if there's no index
+	"""
+	if stat is None:
+		try:
+			stat = os.stat(inlab_index_filename())
+		except FileNotFoundError:
+			return None
+	return stat.st_ino, stat.st_ctime_ns
 
-		# store_log_to(LOG_FILENAME, BACKUP_PATH)
 
-	return found
+def scan_inlab_sessions() -> dict:
+	"""
+	Find open sessions by reading the whole log file. Slow, used only to (re)build the index.
 
+	:return: username -> byte offset of its INLAB line
+	"""
+	sessions = {}
+	offset = 0
+	with startup_timer("log scan"), open(LOG_FILENAME, "rb") as log_file:
+		for raw_line in log_file:
+			# Byte and character offsets are the same up to the username, timestamps are ASCII
+			if raw_line[39:44] == b"INLAB":
+				username = line_username(raw_line.decode())
+				sessions.setdefault(username, offset)
+			offset += len(raw_line)
+	return sessions
+
+
+def save_inlab_index(sessions: dict):
+	"""
+	Atomically replace the index of open sessions. Call it right after writing to the log file.
 
-# logout by passing manually date and time
-def manual_logout():
-	sys.stdout.write(COLOR_RED)
-	username = input("ADMIN--> insert username: ")
+	:param sessions: username -> byte offset of its INLAB line
+	"""
+	global INLAB_INDEX_CACHE
+	signature = log_signature()
+	index_filename = inlab_index_filename()
+	temp_filename = f"{index_filename}.{os.getpid()}.tmp"
+	with open(temp_filename, "w") as index_file:
+		index_file.write(f"weeelab-inlab {signature[0]} {signature[1]}\n")
+		for username, offset in sorted(sessions.items(), key=lambda session: session[1]):
+			index_file.write(f"{offset} {username}\n")
+	os.replace(temp_filename, index_filename)
+	INLAB_INDEX_CACHE = ((signature, index_identity()), dict(sessions))
+
+
+def load_inlab_index() -> dict:
+	"""
+	Get open sessions from the sidecar index. If it's missing or doesn't match the log file anymore
+	(e.g. someone edited the log by hand), it is rebuilt from the log file.
 
-	date = input("ADMIN--> insert date (gg/mm/aaaa): ")
-	if not check_date(date):
-		return False
+	:return: username -> byte offset of its INLAB line, a copy that can be freely modified
+	"""
+	global INLAB_INDEX_CACHE
+	with log_lock(exclusive=False):
+		signature = log_signature()
+		if INLAB_INDEX_CACHE is not None and INLAB_INDEX_CACHE[0] == (signature, index_identity()):
+			return dict(INLAB_INDEX_CACHE[1])
+		return read_inlab_index(signature)
 
-	hour = input("ADMIN--> insert time (hh:mm): ")
-	if not check_hour(hour):
-		return False
 
-	curr_time = date + " " + hour
+def read_inlab_index(signature: tuple) -> dict:
+	global INLAB_INDEX_CACHE
+	sessions = None
+	try:
+		with open(inlab_index_filename(), "r") as index_file:
+			header = index_file.readline().split()
+			if len(header) == 3 and header[0] == "weeelab-inlab" and (int(header[1]), int(header[2])) == signature:
+				sessions = {}
+				for line in index_file:
+					offset, username = line.rstrip("\n").split(" ", 1)
+					sessions[username] = int(offset)
+				INLAB_INDEX_CACHE = ((signature, index_identity(os.fstat(index_file.fileno()))), dict(sessions))
+	except (FileNotFoundError, ValueError):
+		sessions = None
+
+	if sessions is None:
+		sessions = scan_inlab_sessions()
+		try:
+			save_inlab_index(sessions)
+		except OSError as e:
+			# Read-only log directory or something like that, the index is just an optimization
+			print(f"Cannot save index of open sessions: {e}")
+			INLAB_INDEX_CACHE = ((signature, index_identity()), dict(sessions))
+	return sessions
 
-	workdone = ask_work_done()
 
-	print("ADMIN--> you will update the log file with ")
-	print("            " + username + " " + curr_time)
-	answer = input("ADMIN--> are you sure? (y/n)")
-	if answer != "y":
-		return False
+def names_index_filename() -> str:
+	# log.txt -> log.txt.names
+	return LOG_FILENAME + ".names"
 
-	if write_logout(username, curr_time, workdone):
-		print("ADMIN--> Update succeeded")
+
+def load_names_index() -> list:
+	"""
+	Get every username that appears in the log or in the archives, for tab completion. They're kept in a sorted
+	index next to the log file, which also says how much of the log has been read: only lines added since then
+	are read to update it. If the index is missing, it's built from the log and every archive, once.
+
+	:return: sorted usernames
+	"""
+	stat = os.stat(LOG_FILENAME)
+	names = None
+	inode = None
+	offset = 0
+	try:
+		with open(names_index_filename(), "r") as index_file:
+			header = index_file.readline().split()
+			if len(header) == 3 and header[0] == "weeelab-names":
+				inode, offset = int(header[1]), int(header[2])
+				names = index_file.read().splitlines()
+	except (FileNotFoundError, ValueError):
+		names = None
+	if names is not None and inode == stat.st_ino and offset == stat.st_size:
+		return names
+
+	found = set()
+	if names is None:
+		offset = 0
+		for _, path in archive_files():
+			for line in read_archive_lines(path):
+				if '<' in line and '>' in line:
+					found.add(line_username(line))
+	elif inode != stat.st_ino or stat.st_size < offset:
+		# New month or rewritten, names in the old log file are in the index already
+		offset = 0
+	with open(LOG_FILENAME, "rb") as log_file:
+		log_file.seek(offset)
+		data = log_file.read(stat.st_size - offset)
+	# Only complete lines, the rest next time
+	data = data[:data.rfind(b"\n") + 1]
+	for raw_line in data.splitlines():
+		if b'<' in raw_line and b'>' in raw_line:
+			found.add(line_username(raw_line.decode()))
+	offset += len(data)
+
+	names = sorted(found.union(names or ()))
+	temp_filename = f"{names_index_filename()}.{os.getpid()}.tmp"
+	try:
+		with open(temp_filename, "w") as index_file:
+			index_file.write(f"weeelab-names {stat.st_ino} {offset}\n")
+			index_file.writelines(name + "\n" for name in names)
+		os.replace(temp_filename, names_index_filename())
+	except OSError as e:
+		# Read-only log directory or something like that, it will be read again next time
+		print(f"Cannot save index of usernames: {e}")
+	return names
+
+
+def lock_holder(fd: int) -> str:
+	"""
+	Tell who is holding the lock, as far as the lock file knows
+
+	:param fd: lock file descriptor
+	:return: something to append to a message, may be empty
+	"""
+	try:
+		pid = os.pread(fd, 32, 0).decode().strip()
+	except (OSError, UnicodeDecodeError):
+		pid = ""
+	if pid.isdigit():
+		return f" (PID {pid})"
+	return ""
+
+
+def acquire_flock(fd: int, operation: int, timeout: float, verbose: bool = True) -> float:
+	"""
+	Wait for an advisory lock without polling, up to timeout seconds
+
+	:param fd: lock file descriptor
+	:param operation: fcntl.LOCK_SH or fcntl.LOCK_EX
+	:param timeout: seconds, 0 or less waits forever
+	:param verbose: say that it's waiting
+	:return: seconds spent waiting
+	"""
+	try:
+		fcntl.flock(fd, operation | fcntl.LOCK_NB)
+		return 0.0
+	except BlockingIOError:
+		pass
+
+	LOCK_STATS["contended"] += 1
+	if verbose:
+		print(f"Log file is being used by another weeelab{lock_holder(fd)}, waiting...")
+	start = monotonic()
+
+	if threading.current_thread() is threading.main_thread():
+		# A blocking flock() interrupted by SIGALRM: no polling, and the kernel wakes us up as soon as it's free
+		def on_alarm(signum, frame):
+			raise LockTimeoutError
+
+		previous_handler = signal.signal(signal.SIGALRM, on_alarm)
+		if timeout > 0:
+			signal.setitimer(signal.ITIMER_REAL, timeout)
+		try:
+			fcntl.flock(fd, operation)
+		finally:
+			signal.setitimer(signal.ITIMER_REAL, 0)
+			signal.signal(signal.SIGALRM, previous_handler)
+	else:
+		# Signals only reach the main thread, fall back to polling
+		while True:
+			try:
+				fcntl.flock(fd, operation | fcntl.LOCK_NB)
+				break
+			except BlockingIOError:
+				if 0 < timeout < monotonic() - start:
+					raise LockTimeoutError
+				sleep(.01)
+
+	return monotonic() - start
+
+
+def log_lock_filename() -> str:
+	# log.txt -> log.txt.flock. Not .lock: older weeelabs create and delete that one, and wait while it exists.
+	return LOG_FILENAME + ".flock"
+
+
+@contextmanager
+def log_lock(exclusive: bool = True, timeout: Optional[float] = None, verbose: bool = True):
+	"""
+	Hold an advisory lock on the log file and everything around it (index, journal): shared for readers,
+	exclusive for writers.
+
+	The lock is held on the .flock file, which is never deleted. The kernel releases the lock when a process
+	dies, so a crash cannot leave a stale lock behind. Nested calls reuse the lock that is already held,
+	upgrading it to exclusive if needed.
+
+	:param exclusive: True for writers, False for readers
+	:param timeout: seconds to wait before giving up with LockTimeoutError, None for LOCK_TIMEOUT
+	:param verbose: say that it's waiting for another weeelab
+	"""
+	global LOG_WRITTEN
+	state = LOCK_STATE
+	if getattr(state, "depth", 0) > 0 and (state.exclusive or not exclusive):
+		state.depth += 1
+		try:
+			yield
+		finally:
+			state.depth -= 1
+		return
+
+	if timeout is None:
+		timeout = LOCK_TIMEOUT
+	upgrade = getattr(state, "depth", 0) > 0
+	if not upgrade:
+		state.fd = os.open(log_lock_filename(), os.O_RDWR | os.O_CREAT, 0o666)
+		state.depth = 0
+	try:
+		waited = acquire_flock(state.fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH, timeout, verbose)
+	except LockTimeoutError:
+		print(f"Gave up waiting for the lock on the log file after {timeout} seconds{lock_holder(state.fd)}")
+		if not upgrade:
+			os.close(state.fd)
+		raise
+	LOCK_STATS["acquired"] += 1
+	LOCK_STATS["wait"] += waited
+	if exclusive:
+		LOG_WRITTEN = True
+		os.ftruncate(state.fd, 0)
+		os.pwrite(state.fd, f"{os.getpid()}\n".encode(), 0)
+
+	state.exclusive = exclusive
+	state.depth += 1
+	try:
+		yield
+	finally:
+		state.depth -= 1
+		if exclusive:
+			os.ftruncate(state.fd, 0)
+		if upgrade:
+			fcntl.flock(state.fd, fcntl.LOCK_SH)
+			state.exclusive = False
+		else:
+			# Closing the file releases the lock
+			os.close(state.fd)
+			state.exclusive = False
+
+
+def is_empty(input_file) -> bool:
+	"""
+	Check if inputFile is empty.
+
+	:param input_file:
+	:return:
+	"""
+	if str(input_file.read())[:1] == "":
+		input_file.close()
+		return True
+	else:
+		input_file.seek(0)
+		return False
+
+
+def ensure_log_file():
+	if not os.path.exists(LOG_FILENAME):
+		if os.path.isdir(os.path.dirname(LOG_FILENAME)):
+			print(f"Creating empty log.txt")
+			open(LOG_FILENAME, "a").close()
+		else:
+			print(f"Cannot find directory {os.path.dirname(LOG_FILENAME)}")
+			secure_exit(1)
+
+
+def store_log_to(filename, destination):
+	"""
+	Copy a log file (or anything, really) to a directory, if DEBUG_MODE is False
+
+	:param filename: Path to source file
+	:param destination: Path to destination file or directory
+	"""
+	if DEBUG_MODE:
+		print(f"DEBUG_MODE, skipped copying {os.path.basename(filename)} to {destination}")
+	else:
+		from shutil import copy2
+		copy2(filename, destination)
+
+
+def create_backup_if_necessary():
+	if backup_needed():
+		with log_lock():
+			# Someone else may have done it while we were waiting
+			if backup_needed():
+				create_backup()
+
+
+def log_month_filename() -> str:
+	# log.txt -> log.txt.month, month of the current log file
+	return LOG_FILENAME + ".month"
+
+
+def log_month() -> Optional[str]:
+	"""
+	Find which month the current log file is for. It's written in a separate file when a new log is started,
+	since the first lines may be sessions started last month and still open. If that file is missing, it's the
+	month of the last line.
+
+	:return: YYYYMM, or None if the log file has no complete lines
+	"""
+	try:
+		with open(log_month_filename(), "r") as month_file:
+			month = month_file.read().strip()
+		if len(month) == 6 and month.isdigit():
+			return month
+	except FileNotFoundError:
+		pass
+	for _, last_line in read_lines_backwards(LOG_FILENAME):
+		# [dd/mm/YYYY HH:MM] -> YYYYmm, skipping blank or torn lines at the end
+		month = last_line[7:11] + last_line[4:6]
+		if last_line.startswith(b"[") and len(month) == 6 and month.isdigit():
+			return month.decode()
+	return None
+
+
+def backup_needed() -> bool:
+	"""
+	If the inexorable passage of time has been perceived by this program, too...
+	"""
+	month = log_month()
+	return month is not None and strftime("%Y%m") > month
+
+
+def create_backup():
+	"""
+	Move the log file of last month to its archive and start a new one. Caller must hold the lock.
+
+	Sessions that are still open are carried over to the new log file, so people can log out. The new log is
+	written to a temporary file and then replaces the old one, like the archive, so a crash leaves either the
+	old or the new version of both. If the archive is there already (e.g. a crash right after writing it),
+	lines are added to it, skipping those that are already there.
+	"""
+	month = log_month()
+	# log.txt -> log201901.txt.gz, foo.txt -> foo201901.txt.gz, etc...
+	stored_log_filename = LOG_FILENAME.rsplit('.', 1)[0] + month + ".txt.gz"
+
+	carried = []
+	archived = []
+	for line in read_log_lines():
+		if inlab_line(line):
+			carried.append(line)
+		else:
+			archived.append(line)
+
+	if archived:
+		print(f"Backing up log file to {os.path.basename(stored_log_filename)}")
+		plain_filename = stored_log_filename[:-len(".gz")]
+		previous = []
+		for path in (plain_filename, stored_log_filename):
+			if os.path.exists(path):
+				previous.extend(read_archive_lines(path))
+		if previous:
+			already_there = set(previous)
+			archived = previous + [line for line in archived if line not in already_there]
+		write_compressed_archive(stored_log_filename, archived)
+		# An uncompressed archive from older versions, never the log itself
+		if os.path.exists(plain_filename) and not os.path.samefile(plain_filename, LOG_FILENAME):
+			os.remove(plain_filename)
+		# store_log_to(stored_log_filename, BACKUP_PATH)
+		# print(f"Done!")
+
+	temp_filename = f"{LOG_FILENAME}.{os.getpid()}.tmp"
+	sessions = {}
+	with open(temp_filename, "wb") as temp_file:
+		for line in carried:
+			sessions.setdefault(line_username(line), temp_file.tell())
+			temp_file.write(line.encode())
+		temp_file.flush()
+		os.fsync(temp_file.fileno())
+	from shutil import copymode
+	copymode(LOG_FILENAME, temp_filename)
+	os.replace(temp_filename, LOG_FILENAME)
+	try:
+		os.remove(journal_filename())
+	except FileNotFoundError:
+		pass
+	save_inlab_index(sessions)
+	with open(log_month_filename(), "w") as month_file:
+		month_file.write(strftime("%Y%m") + "\n")
+
+	if carried:
+		print(f"New log file was created, open sessions carried over: {len(carried)}")
+	else:
+		print(f"New log file was created.")
+
+
+def write_compressed_archive(path: str, lines: list):
+	"""
+	Write the log of a month, compressed. Each day is a separate gzip member: the file is still a valid
+	gzip file for zcat & co., and the index in path.idx tells where each day starts, so a day can be
+	decompressed without touching the others.
+
+	:param path: archive file, .txt.gz
+	:param lines: log lines, in order
+	"""
+	import gzip
+	import json
+
+	index = {}
+	temp_filename = f"{path}.{os.getpid()}.tmp"
+	with open(temp_filename, "wb") as archive_file:
+		start = 0
+		while start < len(lines):
+			day = line_day(lines[start])
+			end = start + 1
+			while end < len(lines) and line_day(lines[end]) == day:
+				end += 1
+			member = gzip.compress("".join(lines[start:end]).encode(), mtime=0)
+			index.setdefault(day, []).append([archive_file.tell(), len(member)])
+			archive_file.write(member)
+			start = end
+		archive_file.flush()
+		os.fsync(archive_file.fileno())
+	with open(temp_filename + ".idx", "w") as index_file:
+		json.dump(index, index_file)
+	os.replace(temp_filename + ".idx", path + ".idx")
+	os.replace(temp_filename, path)
+
+
+def login(username: str, use_ldap: bool):
+	"""
+	Log in. Add the line in the file. Do it.
+
+	:param use_ldap: Connect to remote LDAP server or blindly trust the input
+	:param username: User-supplied username
+	"""
+
+	if use_ldap:
+		user = get_user(username)
+		username = user.username
+		pretty_name = user.full_name
+		check_sir(user)
+	else:
+		user, _ = user_cache_lookup(username)
+		if user is None:
+			print(COLOR_RED)
+			print("WARNING: bypassing LDAP lookup, make sure that this is the correct username and not an alias")
+			print(COLOR_NATIVE)
+			pretty_name = username
+		else:
+			print(f"LDAP lookup bypassed, {username} is {user.username} according to the cache")
+			username = user.username
+			pretty_name = user.full_name
+			check_sir(user)
+
+	curr_time = strftime("%d/%m/%Y %H:%M")
+	people = storage().start_session(username, curr_time)
+	if people is None:
+		print(f"{pretty_name}, you're already logged in.")
+		return
+
+	if people == 0:
+		global FIRST_IN_HAPPENED
+		FIRST_IN_HAPPENED = True
+	print(f"Login successful! Hello {pretty_name}!")
+
+
+def logout(username: str, use_ldap: bool, message: Optional[str] = None):
+	"""
+	Log out.
+
+	:param message: Logout message, None to ask
+	:param use_ldap: Connect to remote LDAP server or blindly trust the input
+	:param username: User-supplied username
+	"""
+
+	if not use_ldap:
+		print(COLOR_RED)
+		print("WARNING: bypassing LDAP lookup, make sure that this is the correct username and not an alias")
+		print(COLOR_NATIVE)
+
+	if is_logged_in(username):
+		# Using username, and found
+		pretty_name = username
+	else:
+		# Not found, is it an alias?
+		if use_ldap:
+			# Grab the real username
+			user = get_user(username)
+			new_username = user.username
+			pretty_name = user.full_name
+			check_sir(user)
+			if username == new_username or not is_logged_in(new_username):
+				print(f"You aren't in lab! Did you forget to log in?")
+				return False
+			username = new_username
+		else:
+			# Cannot get it from LDAP, maybe it's in cache
+			user, _ = user_cache_lookup(username)
+			if user is None or not is_logged_in(user.username):
+				print(f"You aren't in lab! Did you use an alias or ID number? These do not work right now")
+				return False
+			username = user.username
+			pretty_name = user.full_name
+
+	curr_time = strftime("%d/%m/%Y %H:%M")
+	if message is None:
+		workdone = ask_work_done()
+	else:
+		workdone = message
+
+	people = storage().end_session(username, curr_time, workdone)
+	if people is not None:
+		if people == 0:
+			global LAST_OUT_HAPPENED
+			LAST_OUT_HAPPENED = True
+		print(f"Logout successful! Bye {pretty_name}!")
+		return True
+	else:
+		print(f"Logout failed")
+		return False
+
+
+def check_sir(user):
+	global SIR_HAPPENED
+	SIR_HAPPENED = not user.signed_sir
+
+
+def ask_work_done():
+	try:
+		ok = False
+		workdone = ""
+		while not ok:
+			workdone = input(f"What have you done?\n:: ").strip()
+			if len(workdone) > MAX_WORK_DONE:
+				print(f"I didn't ask you the story of your life! Type a shorter sentence!")
+			elif len(workdone) <= 0:
+				print(f"Come on, tell me something! How was your day?")
+			else:
+				ok = True
+	except KeyboardInterrupt:
+		print(f"Logout cancelled by keyboard interrupt")
+		secure_exit(5)
+		return None  # Just prevents PyCharm from complaining
+	return workdone
+
+
+def session_duration(login: str, logout: str) -> str:
+	"""
+	Time spent in lab, from dates too: sessions may go past midnight, or last days. It always has the same width
+	as the INLAB placeholder, every reader expects exactly HH:MM, and someone that stayed more than 99 hours forgot
+	to log out anyway.
+
+	:param login: dd/mm/YYYY HH:MM
+	:param logout: dd/mm/YYYY HH:MM
+	:return: HH:MM, from 00:00 to 99:59
+	"""
+	minutes = min(max(timestamp_minutes(logout) - timestamp_minutes(login), 0), 100 * 60 - 1)
+	return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def inlab_line(line: str) -> bool:
+	# [02/05/2017 10:00] [----------------] [INLAB] :: <
+	return line[39:44] == "INLAB"
+
+
+def line_username(line: str) -> str:
+	# [login] [logout] [duration] <username> :: message, IndexError if there's no "<"
+	return line.split('<', 1)[1].split('>', 1)[0]
+
+
+def line_message(line: str) -> Optional[str]:
+	# None if there's no message: open sessions and logouts whose message is in the journal
+	return line.split(" :: ", 1)[1].rstrip("\n") if " :: " in line else None
+
+
+def user_in_line(line: str, username: str) -> bool:
+	return username == line_username(line)
+
+
+def close_line(line: str, curr_time: str, workdone: str, duration: Optional[str] = None) -> str:
+	"""
+	Turn an INLAB line into a complete logout line, in legacy format
+
+	:param line: INLAB line from the log
+	:param curr_time: logout date and time, dd/mm/YYYY HH:MM
+	:param workdone: logout message
+	:param duration: HH:MM, None to compute it from login and logout time
+	:return: the new line
+	"""
+	if duration is None:
+		duration = session_duration(line[1:17], curr_time)
+	line = line.replace("----------------", curr_time)
+	line = line.replace("INLAB", duration)
+	line = line.replace("\n", "")
+
+	return line + " :: " + workdone + "\n"
+
+
+def write_logout(username, curr_time, workdone) -> bool:
+	"""
+	Close the session of a user.
+
+	Logout time and duration have the same width as the placeholders in the INLAB line, so they are written
+	over them in place, and the message is appended to the journal. Nothing else in the log file moves.
+	If the new fields don't fit (e.g. a weird time from admin mode), the whole file is rewritten instead.
+	"""
+	with log_lock():
+		sessions = load_inlab_index()
+		if username not in sessions:
+			return False
+
+		duration = None
+		with open(LOG_FILENAME, "r+b") as log_file:
+			offset = sessions[username]
+			log_file.seek(offset)
+			line = log_file.readline().decode()
+			if inlab_line(line) and user_in_line(line, username):
+				if len(curr_time.encode()) == 16:
+					duration = session_duration(line[1:17], curr_time)
+					# Message first: if we crash before patching the line, it will just be ignored
+					append_journal(offset, username, workdone)
+					log_file.seek(offset + 20)
+					log_file.write(curr_time.encode())
+					log_file.seek(offset + 39)
+					log_file.write(duration.encode())
+					log_file.flush()
+					os.fsync(log_file.fileno())
+
+		if duration is None:
+			return rewrite_logout(username, curr_time, workdone)
+
+		sessions.pop(username)
+		save_inlab_index(sessions)
+
+		# store_log_to(LOG_FILENAME, BACKUP_PATH)
+
+	return True
+
+
+def rewrite_logout(username, curr_time, workdone) -> bool:
+	"""
+	Close the session of a user by rewriting the entire log file, the old way. Caller must hold the lock.
+	"""
+	found = False
+
+	def edit(line: str) -> str:
+		nonlocal found
+		if inlab_line(line) and user_in_line(line, username):
+			found = True
+			return close_line(line, curr_time, workdone)
+		return line
+
+	rewrite_log(edit)
+	return found
+
+
+def journal_filename() -> str:
+	return LOG_FILENAME + ".journal"
+
+
+def append_journal(offset: int, username: str, workdone: str):
+	"""
+	Add a logout message to the journal and make sure it's on disk. Caller must hold the lock.
+
+	The journal starts with the inode of the log file it belongs to: when the log is replaced by a rewrite,
+	entries left behind by a crash are recognized as stale and thrown away.
+
+	:param offset: byte offset of the line in the log file
+	:param username: owner of the line, checked again when merging
+	:param workdone: logout message
+	"""
+	header = f"weeelab-journal {os.stat(LOG_FILENAME).st_ino}\n"
+	try:
+		with open(journal_filename(), "r") as journal_file:
+			valid = journal_file.readline() == header
+	except FileNotFoundError:
+		valid = False
+
+	workdone = workdone.replace("\n", " ")
+	with open(journal_filename(), "a" if valid else "w") as journal_file:
+		if not valid:
+			journal_file.write(header)
+		journal_file.write(f"{offset} <{username}> {workdone}\n")
+		journal_file.flush()
+		os.fsync(journal_file.fileno())
+
+
+def load_journal(inode: Optional[int] = None) -> dict:
+	"""
+	Read logout messages from the journal
+
+	:param inode: of the log file the journal should belong to, None for the current one
+	:return: byte offset of the line -> (username, message), latest entry wins
+	"""
+	if inode is None:
+		inode = os.stat(LOG_FILENAME).st_ino
+	return read_journal_entries(inode)[0]
+
+
+def read_journal_entries(inode: int, start: int = 0) -> tuple:
+	"""
+	Read entries from the journal, all of them or only those added since last time
+
+	:param inode: of the log file the journal should belong to
+	:param start: where to continue from, as returned last time, 0 for the beginning
+	:return: (byte offset of the line -> (username, message), where to continue from next time). Nothing if the
+	journal belongs to another log file, next time from the beginning.
+	"""
+	entries = {}
+	try:
+		with open(journal_filename(), "rb") as journal_file:
+			if journal_file.readline().decode() != f"weeelab-journal {inode}\n":
+				# Left there by the previous log file, the next logout will start a new one
+				return entries, 0
+			if start > journal_file.tell():
+				journal_file.seek(start)
+			end = journal_file.tell()
+			for raw_line in journal_file:
+				if not raw_line.endswith(b"\n"):
+					# Torn write from a crash, that logout never happened
+					break
+				end += len(raw_line)
+				offset, rest = raw_line.decode().split(" ", 1)
+				username, message = rest[1:].split("> ", 1)
+				entries[int(offset)] = (username, message[:-1])
+	except FileNotFoundError:
+		return entries, 0
+	return entries, end
+
+
+def read_log_lines():
+	"""
+	Read the log file in legacy format, with messages from the journal merged back in. Caller must hold the lock.
+
+	:return: generator of lines, with trailing newline
+	"""
+	return snapshot_lines(log_snapshot())
+
+
+def log_snapshot() -> tuple:
+	"""
+	Open the log file as it is now, to read it with snapshot_lines() after the lock is released. Caller must hold
+	the lock.
+
+	:return: (open log file, its size, journal, size of the journal file)
+	"""
+	log_file = open(LOG_FILENAME, "rb")
+	return log_file, os.fstat(log_file.fileno()).st_size, load_journal(), journal_file_size()
+
+
+def snapshot_lines(snapshot: tuple, backwards: bool = False):
+	"""
+	Read the log file opened by log_snapshot(), one line at a time, with messages from the journal merged back in.
+	Lines added after the snapshot are not read. Lines closed after it are, since logouts are written in place:
+	their messages are then looked up in the journal again.
+
+	:param snapshot: from log_snapshot()
+	:param backwards: from the last line to the first one
+	:return: generator of lines, with trailing newline
+	"""
+	log_file, size, journal, journal_size = snapshot
+	inode = os.fstat(log_file.fileno()).st_ino
+	with log_file:
+		if backwards:
+			raw_lines = read_file_lines_backwards(log_file, size)
+		else:
+			raw_lines = read_file_lines(log_file, size)
+		for offset, raw_line in raw_lines:
+			line = raw_line.decode()
+			if offset not in journal and not inlab_line(line) and line.rstrip("\n").endswith(">"):
+				# Message not there yet, maybe logged out in the meantime
+				if journal_file_size() != journal_size:
+					journal_size = journal_file_size()
+					journal = load_journal(inode)
+			yield journal_merged_line(journal, offset, line)
+
+
+def journal_file_size() -> int:
+	try:
+		return os.stat(journal_filename()).st_size
+	except FileNotFoundError:
+		return 0
+
+
+def journal_merged_line(journal: dict, offset: int, line: str) -> str:
+	"""
+	Add the logout message to a line, if it's in the journal
+
+	:param journal: from load_journal()
+	:param offset: byte offset of the line in the log file
+	:param line: the line
+	:return: the line, in legacy format
+	"""
+	if offset in journal and not inlab_line(line) and line.rstrip("\n").endswith(">"):
+		username, message = journal[offset]
+		if user_in_line(line, username):
+			line = line.rstrip("\n") + " :: " + message + "\n"
+	return line
+
+
+def read_lines_backwards(path: str, block_size: int = 65536):
+	"""
+	Read a file from the end, a block at a time, without reading what comes before the lines that are needed
+
+	:param path: file to read
+	:param block_size: bytes to read at a time
+	:return: generator of (byte offset, line as bytes with trailing newline), last line first
+	"""
+	with open(path, "rb") as the_file:
+		yield from read_file_lines_backwards(the_file, the_file.seek(0, os.SEEK_END), block_size)
+
+
+def read_file_lines_backwards(the_file, position: int, block_size: int = 65536):
+	"""
+	Same as read_lines_backwards(), for a file that is already open
+
+	:param the_file: open in binary mode
+	:param position: where to start, usually the size of the file
+	"""
+	# Beginning of a line that starts in a block that hasn't been read yet
+	partial = b""
+	while position > 0:
+		size = min(block_size, position)
+		position -= size
+		the_file.seek(position)
+		partial = the_file.read(size) + partial
+		if position > 0:
+			cut = partial.find(b"\n") + 1
+			if cut == 0:
+				# A very long line, keep reading
+				continue
+		else:
+			cut = 0
+		complete = partial[cut:]
+		partial = partial[:cut]
+
+		end = position + cut + len(complete)
+		pieces = complete.split(b"\n")
+		if pieces[-1] == b"":
+			pieces.pop()
+			pieces = [piece + b"\n" for piece in pieces]
+		else:
+			# Last line of the file, without newline
+			pieces = [piece + b"\n" for piece in pieces[:-1]] + [pieces[-1]]
+		for piece in reversed(pieces):
+			end -= len(piece)
+			yield end, piece
+
+
+def read_file_lines(the_file, size: int):
+	"""
+	Read a file that is already open, from the beginning, without going past a given size
+
+	:param the_file: open in binary mode
+	:param size: where to stop, usually the size of the file when it was opened
+	:return: generator of (byte offset, line as bytes with trailing newline)
+	"""
+	the_file.seek(0)
+	offset = 0
+	while offset < size:
+		raw_line = the_file.readline(size - offset)
+		if raw_line == b"":
+			return
+		yield offset, raw_line
+		offset += len(raw_line)
+
+
+def rewrite_log(edit=None):
+	"""
+	Replace the log file with its legacy single-file version, merging the journal back in.
+	Everything goes to a temporary file first, so a crash leaves either the old or the new log.
+	Caller must hold the lock.
+
+	:param edit: optional function that receives each line and returns the line to write
+	"""
+	temp_filename = f"{LOG_FILENAME}.{os.getpid()}.tmp"
+	sessions = {}
+	with open(temp_filename, "wb") as temp_file:
+		for line in read_log_lines():
+			if edit is not None:
+				line = edit(line)
+			if inlab_line(line):
+				sessions.setdefault(line_username(line), temp_file.tell())
+			temp_file.write(line.encode())
+		temp_file.flush()
+		os.fsync(temp_file.fileno())
+	from shutil import copymode
+	copymode(LOG_FILENAME, temp_filename)
+	os.replace(temp_filename, LOG_FILENAME)
+	# New inode, the journal is stale anyway, but don't leave it around
+	try:
+		os.remove(journal_filename())
+	except FileNotFoundError:
+		pass
+	save_inlab_index(sessions)
+
+
+def merge_journal():
+	"""
+	Merge the journal back into the log file, leaving a log in the legacy single-file format
+	"""
+	with log_lock():
+		if os.path.exists(journal_filename()):
+			rewrite_log()
+			print(f"Journal merged into {os.path.basename(LOG_FILENAME)}")
+		else:
+			print(f"Nothing to merge")
+
+
+class FileStorage:
+	"""
+	Sessions in log.txt, one line each in legacy format, with the index of open sessions and the journal next to
+	it. Past months are in the archives.
+	"""
+
+	def in_lab(self) -> list:
+		"""
+		:return: usernames of people in lab, in order of login
+		"""
+		sessions = load_inlab_index()
+		return sorted(sessions, key=sessions.get)
+
+	def usernames(self) -> list:
+		"""
+		:return: everyone that has ever been in lab, sorted
+		"""
+		return load_names_index()
+
+	def start_session(self, username: str, curr_time: str) -> Optional[int]:
+		"""
+		Log in
+
+		:param curr_time: dd/mm/YYYY HH:MM
+		:return: how many people were in lab before, None if the user was already there
+		"""
+		with log_lock():
+			sessions = load_inlab_index()
+			if username in sessions:
+				return None
+			login_string = f"[{curr_time}] [----------------] [INLAB] <{username}>\n"
+			with open(LOG_FILENAME, "ab") as log_file:
+				people = len(sessions)
+				sessions[username] = log_file.tell()
+				log_file.write(login_string.encode())
+			save_inlab_index(sessions)
+			# store_log_to(LOG_FILENAME, BACKUP_PATH)
+		return people
+
+	def end_session(self, username: str, curr_time: str, workdone: str) -> Optional[int]:
+		"""
+		Log out
+
+		:param curr_time: dd/mm/YYYY HH:MM
+		:return: how many people are left in lab, None if the user wasn't there
+		"""
+		with log_lock():
+			if not write_logout(username, curr_time, workdone):
+				return None
+			return people_in_lab()
+
+	def close_sessions(self, edit, dry_run: bool = False):
+		"""
+		Close many sessions at once, rewriting the log file
+
+		:param edit: function that receives each line and returns it, closed with close_line() if needed
+		:param dry_run: only call edit, don't write anything
+		"""
+		with log_lock(exclusive=not dry_run):
+			if dry_run:
+				for line in read_log_lines():
+					edit(line)
+			else:
+				rewrite_log(edit)
+
+	def lines(self, since: Optional[str] = None, until: Optional[str] = None, archives: bool = True):
+		"""
+		Read sessions in legacy format, oldest first. Lines out of range may still be there, filter them if needed.
+
+		:param since: YYYY, YYYY-MM or YYYY-MM-DD, None for no limit
+		:param until: YYYY, YYYY-MM or YYYY-MM-DD, included, None for no limit
+		:param archives: past months too, not only this one
+		:return: generator of lines
+		"""
+		return forward_log_lines(archives, since, until)
+
+	def lines_backwards(self, since: Optional[str] = None, until: Optional[str] = None, archives: bool = True):
+		"""
+		Same as lines(), newest first
+		"""
+		return backward_log_lines(archives, since, until)
+
+	def position(self) -> tuple:
+		"""
+		Where the log ends now and where open sessions are, for follow()
+
+		:return: (inode, size, byte offsets of INLAB lines)
+		"""
+		with log_lock(exclusive=False):
+			stat = os.stat(LOG_FILENAME)
+			return stat.st_ino, stat.st_size, sorted(load_inlab_index().values())
+
+	def follow(self, matches, position: tuple):
+		follow_log(matches, position)
+
+	def summaries(self, since: Optional[str], until: Optional[str]) -> list:
+		return load_summaries(since, until)
+
+	def log_bytes(self, since: Optional[str], until: Optional[str]) -> bytes:
+		"""
+		Everything in range, as it is in the files, for --occupancy. Lines out of range may still be there.
+		"""
+		data = [read_archive_bytes(path, since, until) for month, path in archives_in_range(since, until)]
+		with log_lock(exclusive=False):
+			with open(LOG_FILENAME, "rb") as log_file:
+				data.append(log_file.read())
+		return b"\n".join(data)
+
+	def search(self, query: str, username: Optional[str], since: Optional[str], until: Optional[str], limit: int) -> list:
+		"""
+		Full-text search in logout messages, in the index next to the log, updated first
+
+		:return: see search_messages()
+		"""
+		db = open_search_index()
+		try:
+			update_search_index(db)
+			return search_messages(db, "messages", query, username, since, until, limit)
+		finally:
+			db.close()
+
+
+class SqliteStorage:
+	"""
+	Sessions in a SQLite database, in WAL mode so that readers never wait for writers. Every change is a
+	transaction, several weeelabs on the same database are fine. Sessions are kept forever, there are no
+	monthly archives.
+
+	Timestamps are YYYY-MM-DD HH:MM, so that they can be compared and sorted as strings.
+	"""
+
+	def __init__(self, path: str):
+		import sqlite3
+		self.path = path
+		# Transactions are started by hand, BEGIN IMMEDIATE for writes
+		self.db = sqlite3.connect(path, timeout=LOCK_TIMEOUT if LOCK_TIMEOUT > 0 else 3600, isolation_level=None,
+			check_same_thread=False)
+		self.db.execute("PRAGMA journal_mode=WAL")
+		self.db.executescript("""
+			CREATE TABLE IF NOT EXISTS sessions (
+				id INTEGER PRIMARY KEY,
+				username TEXT NOT NULL,
+				login TEXT NOT NULL,
+				logout TEXT,
+				duration TEXT,
+				message TEXT
+			);
+			CREATE INDEX IF NOT EXISTS sessions_login ON sessions (login);
+			CREATE INDEX IF NOT EXISTS sessions_user ON sessions (username, login);
+			-- Nobody can be in lab twice, even with two kiosks racing
+			CREATE UNIQUE INDEX IF NOT EXISTS sessions_open ON sessions (username) WHERE logout IS NULL;
+		""")
+
+	@staticmethod
+	def iso_time(timestamp: str) -> str:
+		# dd/mm/YYYY HH:MM -> YYYY-MM-DD HH:MM
+		return f"{timestamp[6:10]}-{timestamp[3:5]}-{timestamp[0:2]} {timestamp[11:16]}"
+
+	@staticmethod
+	def log_time(timestamp: str) -> str:
+		# YYYY-MM-DD HH:MM -> dd/mm/YYYY HH:MM
+		return f"{timestamp[8:10]}/{timestamp[5:7]}/{timestamp[0:4]} {timestamp[11:16]}"
+
+	@staticmethod
+	def line(username: str, login: str, logout: Optional[str], duration: Optional[str], message: Optional[str]) -> str:
+		"""
+		Make a line of the log file from a row
+		"""
+		if logout is None:
+			return f"[{SqliteStorage.log_time(login)}] [----------------] [INLAB] <{username}>\n"
+		line = f"[{SqliteStorage.log_time(login)}] [{SqliteStorage.log_time(logout)}] [{duration}] <{username}>"
+		return line + ("\n" if message is None else f" :: {message}\n")
+
+	def in_lab(self) -> list:
+		return [row[0] for row in self.db.execute("SELECT username FROM sessions WHERE logout IS NULL ORDER BY login, id")]
+
+	def usernames(self) -> list:
+		# From the index on (username, login), the table is not read
+		return [row[0] for row in self.db.execute("SELECT DISTINCT username FROM sessions ORDER BY username")]
+
+	def start_session(self, username: str, curr_time: str) -> Optional[int]:
+		import sqlite3
+		with self.transaction():
+			people = self.db.execute("SELECT COUNT(*) FROM sessions WHERE logout IS NULL").fetchone()[0]
+			try:
+				self.db.execute("INSERT INTO sessions (username, login) VALUES (?, ?)", (username, self.iso_time(curr_time)))
+			except sqlite3.IntegrityError:
+				return None
+		return people
+
+	def end_session(self, username: str, curr_time: str, workdone: str) -> Optional[int]:
+		with self.transaction():
+			row = self.db.execute("SELECT id, login FROM sessions WHERE username = ? AND logout IS NULL", (username,)).fetchone()
+			if row is None:
+				return None
+			session_id, login = row
+			self.db.execute("UPDATE sessions SET logout = ?, duration = ?, message = ? WHERE id = ?",
+				(self.iso_time(curr_time), session_duration(self.log_time(login), curr_time), workdone, session_id))
+			return self.db.execute("SELECT COUNT(*) FROM sessions WHERE logout IS NULL").fetchone()[0]
+
+	def close_sessions(self, edit, dry_run: bool = False):
+		"""
+		Same as FileStorage.close_sessions(), but edit only gets lines of open sessions
+		"""
+		with self.transaction():
+			rows = self.db.execute("SELECT id, username, login FROM sessions WHERE logout IS NULL ORDER BY login, id").fetchall()
+			for session_id, username, login in rows:
+				line = edit(self.line(username, login, None, None, None))
+				if dry_run or inlab_line(line):
+					continue
+				# [login] [logout] [duration] <username> :: message
+				duration = line[39:line.index("]", 39)]
+				message = line_message(line)
+				self.db.execute("UPDATE sessions SET logout = ?, duration = ?, message = ? WHERE id = ?",
+					(self.iso_time(line[20:36]), duration, message, session_id))
+
+	@contextmanager
+	def transaction(self):
+		# IMMEDIATE: take the write lock now, not when the first write comes, so reads in here are still valid then
+		self.db.execute("BEGIN IMMEDIATE")
+		try:
+			yield
+		except BaseException:
+			self.db.execute("ROLLBACK")
+			raise
+		self.db.execute("COMMIT")
+
+	def range_filter(self, since: Optional[str], until: Optional[str], archives: bool) -> tuple:
+		"""
+		:return: (WHERE clause, parameters)
+		"""
+		conditions = []
+		parameters = []
+		if since is not None:
+			conditions.append("login >= ?")
+			parameters.append(since)
+		if until is not None:
+			# "~" comes after digits, spaces and colons: 2020-03~ is after every time in March 2020
+			conditions.append("login < ?")
+			parameters.append(until + "~")
+		if not archives:
+			# Like log.txt: this month and whoever is still in lab
+			conditions.append("(login >= ? OR logout IS NULL)")
+			parameters.append(strftime("%Y-%m"))
+		return " AND ".join(conditions) or "1", parameters
+
+	def lines(self, since: Optional[str] = None, until: Optional[str] = None, archives: bool = True):
+		where, parameters = self.range_filter(since, until, archives)
+		for row in self.db.execute(f"SELECT username, login, logout, duration, message FROM sessions WHERE {where} ORDER BY login, id", parameters):
+			yield self.line(*row)
+
+	def lines_backwards(self, since: Optional[str] = None, until: Optional[str] = None, archives: bool = True):
+		where, parameters = self.range_filter(since, until, archives)
+		for row in self.db.execute(f"SELECT username, login, logout, duration, message FROM sessions WHERE {where} ORDER BY login DESC, id DESC", parameters):
+			yield self.line(*row)
+
+	def position(self) -> int:
+		return self.db.execute("SELECT COALESCE(MAX(id), 0) FROM sessions").fetchone()[0]
+
+	def follow(self, matches, position: int):
+		"""
+		Print new sessions as they start, like FileStorage.follow() but without logouts
+		"""
+		try:
+			while True:
+				sleep(1)
+				for row in self.db.execute("SELECT id, username, login, logout, duration, message FROM sessions WHERE id > ? ORDER BY id", (position,)):
+					position = row[0]
+					line = self.line(*row[1:])
+					if matches(line):
+						print(line, end='', flush=True)
+		except KeyboardInterrupt:
+			pass
+
+	def summaries(self, since: Optional[str], until: Optional[str]) -> list:
+		days = summarize_lines(self.lines(since, until))
+		return [(day, users) for day, users in days.items() if day_in_range(day, since, until)]
+
+	def log_bytes(self, since: Optional[str], until: Optional[str]) -> bytes:
+		return "".join(self.lines(since, until)).encode()
+
+	def search(self, query: str, username: Optional[str], since: Optional[str], until: Optional[str], limit: int) -> list:
+		"""
+		Full-text search in logout messages. The index is a table in the database, kept up to date by triggers
+		from the first search on.
+
+		:return: see search_messages()
+		"""
+		if self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'sessions_search'").fetchone() is None:
+			columns = "message, username, login, logout, duration"
+			values = "new.id, new.message, new.username, new.login, new.logout, new.duration"
+			with self.transaction():
+				self.db.execute(f"CREATE VIRTUAL TABLE sessions_search USING fts5({SEARCH_INDEX_COLUMNS})")
+				self.db.execute(f"""CREATE TRIGGER sessions_search_insert AFTER INSERT ON sessions WHEN new.message IS NOT NULL
+					BEGIN INSERT INTO sessions_search (rowid, {columns}) VALUES ({values}); END""")
+				self.db.execute(f"""CREATE TRIGGER sessions_search_update AFTER UPDATE ON sessions WHEN new.message IS NOT NULL
+					BEGIN
+						DELETE FROM sessions_search WHERE rowid = new.id;
+						INSERT INTO sessions_search (rowid, {columns}) VALUES ({values});
+					END""")
+				self.db.execute(f"INSERT INTO sessions_search (rowid, {columns}) SELECT id, {columns} FROM sessions WHERE message IS NOT NULL")
+		return search_messages(self.db, "sessions_search", query, username, since, until, limit)
+
+	def import_lines(self, lines) -> tuple:
+		"""
+		Add sessions from log lines, skipping those that are already there. Run it again and nothing changes.
+
+		:return: (imported, skipped)
+		"""
+		imported = 0
+		skipped = 0
+		# (username, login, logout) -> how many times it has been seen, the same line twice is two sessions
+		seen = {}
+		with self.transaction():
+			for line in lines:
+				if len(line) < 47:
+					continue
+				try:
+					username = line_username(line)
+					login = self.iso_time(line[1:17])
+				except IndexError:
+					continue
+				if inlab_line(line):
+					logout = duration = message = None
+				else:
+					logout = self.iso_time(line[20:36])
+					duration = line[39:line.index("]", 39)]
+					message = line_message(line)
+				key = (username, login, logout)
+				seen[key] = seen.get(key, 0) + 1
+				if self.db.execute("SELECT COUNT(*) FROM sessions WHERE username = ? AND login = ? AND logout IS ?",
+					key).fetchone()[0] >= seen[key]:
+					skipped += 1
+					continue
+				if logout is None and self.db.execute("SELECT 1 FROM sessions WHERE username = ? AND logout IS NULL",
+					(username,)).fetchone() is not None:
+					# Still in lab according to an older line, it's a broken log
+					skipped += 1
+					continue
+				self.db.execute("INSERT INTO sessions (username, login, logout, duration, message) VALUES (?, ?, ?, ?, ?)",
+					(username, login, logout, duration, message))
+				imported += 1
+		return imported, skipped
+
+
+def storage():
+	"""
+	Get where sessions are stored, according to STORAGE
+
+	:return: FileStorage or SqliteStorage
+	"""
+	global STORAGE_BACKEND
+	if STORAGE_BACKEND is None:
+		if STORAGE == "sqlite":
+			STORAGE_BACKEND = SqliteStorage(SQLITE_FILENAME)
+		else:
+			STORAGE_BACKEND = FileStorage()
+	return STORAGE_BACKEND
+
+
+def import_logs():
+	"""
+	Copy every session from log.txt and the archives to the SQLite database, to switch to STORAGE=sqlite
+	"""
+	with log_lock(exclusive=False):
+		imported, skipped = SqliteStorage(SQLITE_FILENAME).import_lines(FileStorage().lines())
+	print(f"Imported {imported} sessions into {SQLITE_FILENAME}, {skipped} were already there")
+
+
+def export_log(filename: str, since: Optional[str], until: Optional[str]):
+	"""
+	Write sessions to a file in the legacy log format, for whatever still reads it
+
+	:param filename: where, "-" for stdout
+	:param since: YYYY, YYYY-MM or YYYY-MM-DD, None for no limit
+	:param until: YYYY, YYYY-MM or YYYY-MM-DD, included, None for no limit
+	"""
+	lines = (line for line in storage().lines(since, until) if len(line) >= 47 and day_in_range(line_day(line), since, until))
+	if filename == "-":
+		sys.stdout.writelines(lines)
+		return
+	temp_filename = f"{filename}.{os.getpid()}.tmp"
+	with open(temp_filename, "w") as export_file:
+		export_file.writelines(lines)
+	os.replace(temp_filename, filename)
+
+
+def export_sessions(filename: str, export_format: Optional[str], username: Optional[str], since: Optional[str],
+	until: Optional[str]) -> bool:
+	"""
+	Write sessions to a file as CSV or JSON Lines, for spreadsheets and the like. Lines are read and written one
+	at a time, the whole log is never in memory. Sessions still open and broken lines are not exported, they're
+	listed on stderr.
+
+	:param filename: where, "-" for stdout, compressed with gzip if it ends with .gz
+	:param export_format: "csv" or "jsonl", None to guess from the file name
+	:param username: only this user
+	:param since: YYYY, YYYY-MM or YYYY-MM-DD, None for no limit
+	:param until: YYYY, YYYY-MM or YYYY-MM-DD, included, None for no limit
+	"""
+	import csv
+	import json
+
+	if export_format is None:
+		export_format = "jsonl" if filename.endswith((".jsonl", ".jsonl.gz")) else "csv"
+	skipped = {"open": 0, "malformed": 0}
+	fields = ("username", "login", "logout", "minutes", "message")
+	records = session_records(storage().lines(since, until), username, since, until, skipped)
+
+	def write(output) -> int:
+		exported = 0
+		if export_format == "csv":
+			writer = csv.writer(output)
+			writer.writerow(fields)
+			for record in records:
+				writer.writerow([record[field] for field in fields])
+				exported += 1
+		else:
+			for record in records:
+				output.write(json.dumps(record, ensure_ascii=False) + "\n")
+				exported += 1
+		return exported
+
+	if filename == "-":
+		count = write(sys.stdout)
+	else:
+		temp_filename = f"{filename}.{os.getpid()}.tmp"
+		if filename.endswith(".gz"):
+			import gzip
+			output_file = gzip.open(temp_filename, "wt", encoding="utf-8", newline="")
+		else:
+			output_file = open(temp_filename, "w", encoding="utf-8", newline="")
+		try:
+			with output_file:
+				count = write(output_file)
+		except BaseException:
+			os.remove(temp_filename)
+			raise
+		os.replace(temp_filename, filename)
+	print(f"Exported {count} sessions, {skipped['open']} still open and {skipped['malformed']} broken lines left out",
+		file=sys.stderr)
+	return True
+
+
+def session_records(lines, username: Optional[str], since: Optional[str], until: Optional[str], skipped: dict):
+	"""
+	Turn log lines into sessions, for --export. Sessions still open and lines that can't be parsed are printed
+	to stderr and counted in skipped instead.
+
+	:param skipped: "open" and "malformed" -> how many so far, updated while reading
+	:return: generator of dicts with username, login and logout (YYYY-MM-DD HH:MM), minutes and message
+	"""
+	for line in lines:
+		if not line.strip():
+			continue
+		session = session_json(line)
+		try:
+			if session is None:
+				raise ValueError
+			login = timestamp_minutes(line[1:17])
+			minutes = None if session["logout"] is None else timestamp_minutes(line[20:36]) - login
+			if minutes is not None and minutes < 0:
+				raise ValueError
+		except ValueError:
+			skipped["malformed"] += 1
+			print(f"Broken line, not exported: {line.rstrip()}", file=sys.stderr)
+			continue
+		if not day_in_range(session["login"][:10], since, until) or (username is not None and session["username"] != username):
+			continue
+		if minutes is None:
+			skipped["open"] += 1
+			print(f"Still open, not exported: {session['username']} since {session['login']}", file=sys.stderr)
+			continue
+		yield {
+			"username": session["username"],
+			"login": session["login"],
+			"logout": session["logout"],
+			"minutes": minutes,
+			"message": session["message"] or "",
+		}
+
+
+def open_search_index():
+	"""
+	Open the full-text index of logout messages in log.txt and the archives, creating it if needed
+
+	:return: sqlite3 connection
+	"""
+	import sqlite3
+	db = sqlite3.connect(SEARCH_INDEX_FILENAME, timeout=LOCK_TIMEOUT if LOCK_TIMEOUT > 0 else 3600, isolation_level=None)
+	db.execute("PRAGMA journal_mode=WAL")
+	db.executescript(f"""
+		CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5({SEARCH_INDEX_COLUMNS}, source UNINDEXED, position UNINDEXED);
+		-- Files already indexed: archives are indexed once, log.txt up to size
+		CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, inode INTEGER, size INTEGER);
+		-- Byte offsets of lines in log.txt that were still open, to index them when they're closed
+		CREATE TABLE IF NOT EXISTS pending (position INTEGER PRIMARY KEY);
+	""")
+	return db
+
+
+def update_search_index(db):
+	"""
+	Add what's new to the search index: archives that haven't been indexed yet, lines added to log.txt since the
+	last time and those that have been closed in the meantime. If log.txt has been replaced (new month, rewritten),
+	it's indexed again from the start.
+
+	:param db: from open_search_index()
+	"""
+	def rows(lines, source: str):
+		for position, line in lines:
+			session = session_json(line)
+			if session is not None and session["message"] is not None:
+				yield session["message"], session["username"], session["login"], session["logout"], session["duration"], source, position
+
+	def insert(lines, source: str):
+		db.executemany("INSERT INTO messages (message, username, login, logout, duration, source, position) VALUES (?, ?, ?, ?, ?, ?, ?)",
+			rows(lines, source))
+
+	log_source = os.path.basename(LOG_FILENAME)
+	db.execute("BEGIN IMMEDIATE")
+	try:
+		# Read in the transaction: another weeelab may have just indexed the same lines
+		indexed = {name: (inode, size) for name, inode, size in db.execute("SELECT name, inode, size FROM sources")}
+		archives = {os.path.basename(path): path for _, path in archive_files()}
+		for name in set(indexed) - set(archives) - {log_source}:
+			db.execute("DELETE FROM messages WHERE source = ?", (name,))
+			db.execute("DELETE FROM sources WHERE name = ?", (name,))
+		new_archives = []
+		for name, path in archives.items():
+			stat = os.stat(path)
+			if indexed.get(name) != (stat.st_ino, stat.st_size):
+				new_archives.append((name, path, stat))
+		if len(new_archives) > 1:
+			print(f"Indexing {len(new_archives)} archives, only this time...")
+		for name, path, stat in new_archives:
+			db.execute("DELETE FROM messages WHERE source = ?", (name,))
+			insert(((None, line) for line in read_archive_lines(path)), name)
+			db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)", (name, stat.st_ino, stat.st_size))
+
+		with log_lock(exclusive=False):
+			stat = os.stat(LOG_FILENAME)
+			inode, size = indexed.get(log_source, (None, 0))
+			if inode != stat.st_ino or stat.st_size < size:
+				db.execute("DELETE FROM messages WHERE source = ?", (log_source,))
+				db.execute("DELETE FROM pending")
+				size = 0
+			journal = load_journal()
+			closed = []
+			with open(LOG_FILENAME, "rb") as log_file:
+				for (position,) in db.execute("SELECT position FROM pending").fetchall():
+					log_file.seek(position)
+					line = journal_merged_line(journal, position, log_file.readline().decode())
+					if not inlab_line(line):
+						closed.append((position, line))
+						db.execute("DELETE FROM pending WHERE position = ?", (position,))
+				log_file.seek(size)
+				data = log_file.read(stat.st_size - size)
+		# Only complete lines, the rest next time
+		data = data[:data.rfind(b"\n") + 1]
+		position = size
+		for raw_line in data.splitlines(keepends=True):
+			line = journal_merged_line(journal, position, raw_line.decode())
+			if inlab_line(line):
+				db.execute("INSERT OR IGNORE INTO pending VALUES (?)", (position,))
+			else:
+				closed.append((position, line))
+			position += len(raw_line)
+		insert(closed, log_source)
+		db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)", (log_source, stat.st_ino, position))
+	except BaseException:
+		db.execute("ROLLBACK")
+		raise
+	db.execute("COMMIT")
+
+
+def search_messages(db, table: str, query: str, username: Optional[str], since: Optional[str], until: Optional[str],
+	limit: int) -> list:
+	"""
+	Run a full-text search on an index of logout messages, best matches first
+
+	:param table: FTS5 table with SEARCH_INDEX_COLUMNS
+	:param query: FTS5 query, or just words
+	:param since: YYYY, YYYY-MM or YYYY-MM-DD, None for no limit
+	:param until: YYYY, YYYY-MM or YYYY-MM-DD, included, None for no limit
+	:return: list of (username, login, logout, duration, message), timestamps are YYYY-MM-DD HH:MM and matches
+	in the message are between \x01 and \x02
+	"""
+	import sqlite3
+	conditions = [f"{table} MATCH ?"]
+	parameters = []
+	if username is not None:
+		conditions.append("username = ?")
+		parameters.append(username)
+	if since is not None:
+		conditions.append("login >= ?")
+		parameters.append(since)
+	if until is not None:
+		# 2020-01 includes 2020-01-31 23:59, "~" comes after every digit
+		conditions.append("login < ?")
+		parameters.append(until + "~")
+	sql = f"""SELECT username, login, logout, duration, highlight({table}, 0, char(1), char(2)) FROM {table}
+		WHERE {" AND ".join(conditions)} ORDER BY rank, login DESC LIMIT ?"""
+	try:
+		return db.execute(sql, [query] + parameters + [limit]).fetchall()
+	except sqlite3.OperationalError:
+		# Something like T440-batch or 3.5 is not a valid query, search for the words as they are
+		pass
+	words = " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+	return db.execute(sql, [words] + parameters + [limit]).fetchall()
+
+
+def search(query: str, username: Optional[str], since: Optional[str], until: Optional[str], limit: int) -> bool:
+	"""
+	Print logout messages matching a query, best matches first, as log lines
+
+	:param query: words to look for, or an FTS5 query (OR, NOT, "phrases", prefix*)
+	:param username: only this user
+	:param since: only sessions from this day, month or year on (YYYY[-MM[-DD]])
+	:param until: only sessions up to this day, month or year, included
+	:param limit: at most this many results
+	"""
+	import sqlite3
+	try:
+		results = storage().search(query, username, since, until, limit)
+	except sqlite3.OperationalError as e:
+		if "fts5" in str(e):
+			print(f"Cannot search, SQLite has no full-text search here: {e}")
+		else:
+			print(f"Cannot search: {e}")
+		return False
+	if sys.stdout.isatty():
+		start, end = COLOR_RED, COLOR_NATIVE
+	else:
+		start, end = "", ""
+	for username, login, logout, duration, message in results:
+		message = message.replace("\x01", start).replace("\x02", end)
+		print(f"[{SqliteStorage.log_time(login)}] [{SqliteStorage.log_time(logout)}] [{duration}] <{username}> :: {message}")
+	if not results:
+		print("Nothing found.")
+	return True
+
+
+# logout by passing manually date and time
+def manual_logout():
+	# Allows using backspace and arrow keys in input
+	# noinspection PyUnresolvedReferences
+	import readline
+
+	sys.stdout.write(COLOR_RED)
+	# Only people in lab can be logged out
+	with name_completion(sorted(storage().in_lab())):
+		username = input("ADMIN--> insert username: ")
+
+	date = input("ADMIN--> insert date (gg/mm/aaaa): ")
+	if not check_date(date):
+		return False
+
+	hour = input("ADMIN--> insert time (hh:mm): ")
+	if not check_hour(hour):
+		return False
+
+	curr_time = date + " " + hour
+
+	workdone = ask_work_done()
+
+	print("ADMIN--> you will update the log file with ")
+	print("            " + username + " " + curr_time)
+	answer = input("ADMIN--> are you sure? (y/n)")
+	if answer != "y":
+		return False
+
+	if storage().end_session(username, curr_time, workdone) is not None:
+		print("ADMIN--> Update succeeded")
 	else:
 		print("ADMIN--> Update failed (not logged in?)")
 
 
-def logfile():
-	print(f"Reading log file...\n")
-	with open(LOG_FILENAME, "r") as log_file:
-		for line in log_file:
-			print(line, end='')
+def close_lab(usernames: list, at: Optional[str], message: Optional[str], dry_run: bool, last_out: bool) -> bool:
+	"""
+	Log out everyone still in lab, or some of them, at the same time and with the same message, rewriting
+	the log file once. Meant for closing time, e.g. from cron.
+
+	:param usernames: only these users, empty for everyone
+	:param at: logout date and time, dd/mm/YYYY HH:MM, None for now
+	:param message: logout message, None for CLOSE_LAB_MESSAGE
+	:param dry_run: only show who would be logged out
+	:param last_out: launch the "last out" script, if the lab is empty afterwards
+	:return: True if every requested user has been logged out
+	"""
+	curr_time = at or strftime("%d/%m/%Y %H:%M")
+	workdone = message or CLOSE_LAB_MESSAGE
+	closed = []
+	result = True
+
+	with log_lock(exclusive=not dry_run):
+		sessions = storage().in_lab()
+		wanted = set(usernames) if usernames else set(sessions)
+		for username in sorted(wanted - set(sessions)):
+			print(f"{username} is not in lab")
+			result = False
+
+		def edit(line: str) -> str:
+			nonlocal result
+			if not inlab_line(line):
+				return line
+			username = line_username(line)
+			if username not in wanted or username in closed:
+				return line
+			# From dates too, there may be people logged in since days
+			minutes = timestamp_minutes(curr_time) - timestamp_minutes(line[1:17])
+			if minutes < 0:
+				print(f"{username} logged in at {line[1:17]}, after {curr_time}, skipped")
+				result = False
+				return line
+			closed.append(username)
+			duration = f"{minutes // 60:02d}:{minutes % 60:02d}"
+			print(f"{'Would log out' if dry_run else 'Logging out'} {username}, in lab since {line[1:17]} ({duration})")
+			return close_line(line, curr_time, workdone)
+
+		if len(wanted & set(sessions)) == 0:
+			print(f"Nobody to log out.")
+		else:
+			storage().close_sessions(edit, dry_run)
+		empty = len(sessions) == len(closed)
+
+	if closed and not dry_run:
+		print(f"Logged out {len(closed)} {'person' if len(closed) == 1 else 'people'} at {curr_time}")
+		if last_out and empty:
+			global LAST_OUT_HAPPENED
+			LAST_OUT_HAPPENED = True
+	return result
+
+
+def logfile(username: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None,
+	pattern: Optional[str] = None, tail: Optional[int] = None, follow: bool = False, archives: bool = False):
+	"""
+	Print the log, or some of it
+
+	:param username: only lines of this user
+	:param since: only lines from this day, month or year on (YYYY[-MM[-DD]])
+	:param until: only lines up to this day, month or year, included
+	:param pattern: only lines matching this regex, case-insensitive
+	:param tail: only the last N matching lines
+	:param follow: keep printing lines as they are added, until ctrl+C
+	:param archives: look in logs of past months too
+	"""
+	print(f"Reading log file...\n")
+	matches = line_filter(username, since, until, pattern)
+	with log_lock(exclusive=False):
+		end = storage().position()
+		# log.txt is opened right away, reading and printing come after the lock is released: the output may
+		# be a pager that nobody is reading, and other weeelabs would wait for it
+		if tail is None:
+			lines = storage().lines(since, until, archives)
+		else:
+			lines = storage().lines_backwards(since, until, archives)
+	if tail is None:
+		for line in lines:
+			if matches(line):
+				print(line, end='')
+	elif tail > 0:
+		last = []
+		for line in lines:
+			if matches(line):
+				last.append(line)
+				if len(last) >= tail:
+					break
+		for line in reversed(last):
+			print(line, end='')
+
+	if follow:
+		storage().follow(matches, end)
+
+
+def line_filter(username: Optional[str], since: Optional[str], until: Optional[str], pattern: Optional[str]):
+	"""
+	Make a function that tells if a line should be printed by logfile()
+
+	:return: function that takes a line and returns a bool
+	"""
+	if username is None and since is None and until is None and pattern is None:
+		return lambda line: True
+	regex = None
+	if pattern is not None:
+		import re
+		regex = re.compile(pattern, re.IGNORECASE)
+
+	def matches(line: str) -> bool:
+		if len(line) < 47:
+			# Not a log line
+			return False
+		if (since is not None or until is not None) and not day_in_range(line_day(line), since, until):
+			return False
+		if username is not None and not user_in_line(line, username):
+			return False
+		if regex is not None and regex.search(line) is None:
+			return False
+		return True
+
+	return matches
+
+
+def forward_log_lines(archives: bool, since: Optional[str], until: Optional[str]):
+	"""
+	Read the log, oldest line first, stopping after the last day in range. log.txt is opened right away, under the
+	lock, and read up to where it ended then, so the lock is not needed while reading. Archives never change.
+
+	:param archives: start from logs of past months in range
+	:return: generator of lines
+	"""
+	with log_lock(exclusive=False):
+		current = log_snapshot()
+
+	def lines():
+		if archives:
+			for month, path in archives_in_range(since, until):
+				yield from read_archive_lines(path, since, until)
+		yield from snapshot_lines(current)
+
+	def in_range():
+		for line in lines():
+			# Lines are in order of login, everything after this is out of range
+			if until is not None and len(line) >= 47 and line_day(line)[:len(until)] > until:
+				return
+			yield line
+
+	return in_range()
+
+
+def backward_log_lines(archives: bool, since: Optional[str], until: Optional[str]):
+	"""
+	Read the log, newest line first, stopping before the first day in range. Same as forward_log_lines(),
+	log.txt is opened right away.
+
+	:param archives: continue with logs of past months in range
+	:return: generator of lines
+	"""
+	with log_lock(exclusive=False):
+		current = log_snapshot()
+
+	def lines():
+		yield from snapshot_lines(current, backwards=True)
+		if archives:
+			for month, path in reversed(archives_in_range(since, until)):
+				yield from read_archive_lines_backwards(path, since, until)
+
+	def in_range():
+		for line in lines():
+			if since is not None and len(line) >= 47 and line_day(line)[:len(since)] < since:
+				return
+			yield line
+
+	return in_range()
+
+
+def follow_log(matches, position: tuple):
+	"""
+	Print lines added to the log file, like tail -f, and sessions again when they're closed: logouts are written
+	in place, over the INLAB line
+
+	:param matches: filter, from line_filter()
+	:param position: from FileStorage.position(), when the log file was last read
+	"""
+	inode, offset, open_sessions = position
+	signature = None
+	try:
+		while True:
+			sleep(1)
+			with log_lock(exclusive=False):
+				stat = os.stat(LOG_FILENAME)
+				try:
+					journal_size = os.path.getsize(journal_filename())
+				except FileNotFoundError:
+					journal_size = None
+				if (stat.st_ino, stat.st_size, stat.st_mtime_ns, journal_size) == signature:
+					continue
+				signature = stat.st_ino, stat.st_size, stat.st_mtime_ns, journal_size
+				if stat.st_ino != inode or stat.st_size < offset:
+					# New month or rewritten
+					inode = stat.st_ino
+					offset = 0
+					open_sessions = []
+				closed = []
+				with open(LOG_FILENAME, "rb") as log_file:
+					for line_offset in open_sessions:
+						log_file.seek(line_offset)
+						raw_line = log_file.readline()
+						if raw_line[39:44] != b"INLAB":
+							closed.append((line_offset, raw_line))
+					log_file.seek(offset)
+					added = log_file.read(stat.st_size - offset)
+				journal = load_journal()
+			# Only complete lines, the rest next time
+			added = added[:added.rfind(b"\n") + 1]
+			lines = []
+			for line_offset, raw_line in closed:
+				open_sessions.remove(line_offset)
+				lines.append(journal_merged_line(journal, line_offset, raw_line.decode()))
+			for raw_line in added.split(b"\n")[:-1]:
+				raw_line += b"\n"
+				if raw_line[39:44] == b"INLAB":
+					open_sessions.append(offset)
+				lines.append(journal_merged_line(journal, offset, raw_line.decode()))
+				offset += len(raw_line)
+			for line in lines:
+				if matches(line):
+					print(line, end='', flush=True)
+	except KeyboardInterrupt:
+		pass
 
 
 def inlab():
-	count = 0
-	print(f"Reading log file...\n")
-	with open(LOG_FILENAME, "r") as log_file:
-		for line in log_file:
-			if inlab_line(line):
-				count += 1
-				username = line[47:line.rfind(">")]
-				print("> " + username)
+	sessions = storage().in_lab()
+	count = len(sessions)
+	for username in sessions:
+		print("> " + username)
 
 	if count == 0:
 		print(f"Nobody is in lab right now.")
@@ -509,13 +2745,11 @@ def inlab():
 		print(f"There are {count} students in lab right now.")
 
 
-# Returns total work time in minutes
+# Returns total work time in minutes, in every log file ever
 def tot_work_time(username):
 	time_spent = 0
-	with open(LOG_FILENAME, "r") as log_file:
-		for line in log_file:
-			if user_in_line(username, line) and not inlab_line(line):
-				time_spent += ((int(line[39:41]) * 60) + int(line[42:44]))
+	for _, users in storage().summaries(None, None):
+		time_spent += users.get(username, (0, 0))[0]
 	return time_spent
 
 
@@ -524,7 +2758,581 @@ def time_conv(minutes):
 	return str(int(minutes / 60)) + " h " + str(int(minutes % 60)) + " m"
 
 
+def archive_files() -> list:
+	"""
+	Find the logs of past months, made by create_backup_if_necessary()
+
+	:return: sorted list of (YYYY-MM, path)
+	"""
+	directory = os.path.dirname(LOG_FILENAME) or "."
+	# log.txt -> log201901.txt or log201901.txt.gz
+	prefix = os.path.basename(LOG_FILENAME).rsplit('.', 1)[0]
+	archives = []
+	for filename in os.listdir(directory):
+		month = filename[len(prefix):len(prefix) + 6]
+		if filename.startswith(prefix) and month.isdigit() and filename[len(prefix) + 6:] in (".txt", ".txt.gz"):
+			archives.append((f"{month[:4]}-{month[4:]}", os.path.join(directory, filename)))
+	archives.sort()
+	return archives
+
+
+def archive_members(path: str, since: Optional[str], until: Optional[str]) -> Optional[list]:
+	"""
+	Find which parts of a compressed archive contain the days in range
+
+	:param path: archive file, .txt.gz
+	:return: sorted list of (offset, length) of gzip members, None if there's no index
+	"""
+	import json
+	try:
+		with open(path + ".idx", "r") as index_file:
+			index = json.load(index_file)
+	except (OSError, ValueError):
+		return None
+	return sorted(tuple(member) for day, members in index.items() if day_in_range(day, since, until) for member in members)
+
+
+def read_archive_member(archive_file, offset: int, length: int) -> str:
+	import zlib
+	archive_file.seek(offset)
+	# 16 + MAX_WBITS: with gzip header
+	return zlib.decompress(archive_file.read(length), 16 + zlib.MAX_WBITS).decode()
+
+
+def read_archive_lines(path: str, since: Optional[str] = None, until: Optional[str] = None):
+	"""
+	Read a log of a past month. Compressed archives are decompressed only for the days in range, if there's
+	an index. Lines out of range may still be there, filter them if needed.
+
+	:param path: archive file
+	:param since: YYYY, YYYY-MM or YYYY-MM-DD, None for no limit
+	:param until: YYYY, YYYY-MM or YYYY-MM-DD, included, None for no limit
+	:return: generator of lines, with trailing newline
+	"""
+	if not path.endswith(".gz"):
+		with open(path, "r") as archive_file:
+			yield from archive_file
+		return
+
+	members = None if since is None and until is None else archive_members(path, since, until)
+	if members is None:
+		import gzip
+		with gzip.open(path, "rt") as archive_file:
+			yield from archive_file
+		return
+	with open(path, "rb") as archive_file:
+		for offset, length in members:
+			yield from read_archive_member(archive_file, offset, length).splitlines(keepends=True)
+
+
+def read_archive_lines_backwards(path: str, since: Optional[str] = None, until: Optional[str] = None):
+	"""
+	Same as read_archive_lines(), from the last line to the first one. Compressed archives are decompressed
+	a day at a time, if there's an index.
+	"""
+	if not path.endswith(".gz"):
+		for _, raw_line in read_lines_backwards(path):
+			yield raw_line.decode()
+		return
+
+	members = archive_members(path, since, until)
+	if members is None:
+		yield from reversed(list(read_archive_lines(path)))
+		return
+	with open(path, "rb") as archive_file:
+		for offset, length in reversed(members):
+			yield from reversed(read_archive_member(archive_file, offset, length).splitlines(keepends=True))
+
+
+def timestamp_minutes(timestamp: str) -> int:
+	"""
+	Convert a timestamp from the log to minutes since a fixed point in time, to subtract them
+
+	:param timestamp: dd/mm/YYYY HH:MM
+	:return: minutes
+	"""
+	from datetime import date
+	day = date(int(timestamp[6:10]), int(timestamp[3:5]), int(timestamp[0:2])).toordinal()
+	return day * 1440 + int(timestamp[11:13]) * 60 + int(timestamp[14:16])
+
+
+def line_day(line: str) -> str:
+	"""
+	Day of the login in a log line
+
+	:return: YYYY-MM-DD
+	"""
+	return f"{line[7:11]}-{line[4:6]}-{line[1:3]}"
+
+
+def summarize_lines(lines) -> dict:
+	"""
+	Add up time spent in lab, per day and user. Sessions count on the day they started, still open
+	sessions don't count at all. Durations are computed from dates and times, not taken from the log,
+	so sessions that end past midnight are right.
+
+	:param lines: log lines
+	:return: YYYY-MM-DD -> username -> [minutes, sessions]
+	"""
+	days = {}
+	for line in lines:
+		if len(line) < 47 or inlab_line(line):
+			continue
+		try:
+			minutes = timestamp_minutes(line[20:36]) - timestamp_minutes(line[1:17])
+			username = line_username(line)
+		except (ValueError, IndexError):
+			# Hand-edited or broken line
+			continue
+		user = days.setdefault(line_day(line), {}).setdefault(username, [0, 0])
+		user[0] += minutes
+		user[1] += 1
+	return days
+
+
+def summarize_archive(path: str) -> dict:
+	return summarize_lines(read_archive_lines(path))
+
+
+def load_summaries(since: Optional[str], until: Optional[str]) -> list:
+	"""
+	Get time spent in lab per day and user from every log, current one included.
+
+	Archives never change, so their summaries are cached in REPORT_CACHE_FILENAME, keyed by size and mtime.
+	Archives that aren't in the cache are read in parallel.
+
+	:param since: YYYY, YYYY-MM or YYYY-MM-DD, None for no limit
+	:param until: YYYY, YYYY-MM or YYYY-MM-DD, included, None for no limit
+	:return: list of (YYYY-MM-DD, username -> [minutes, sessions]), for each day in range
+	"""
+	import json
+
+	try:
+		with open(REPORT_CACHE_FILENAME, "r") as cache_file:
+			cache = json.load(cache_file)
+	except (OSError, ValueError):
+		cache = {}
+
+	wanted = []
+	missing = []
+	for month, path in archives_in_range(since, until):
+		stat = os.stat(path)
+		entry = cache.get(os.path.basename(path))
+		if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+			missing.append((path, stat))
+		wanted.append(os.path.basename(path))
+
+	if missing:
+		if len(missing) > 1:
+			from concurrent.futures import ProcessPoolExecutor
+			with ProcessPoolExecutor() as executor:
+				summaries = list(executor.map(summarize_archive, [path for path, _ in missing]))
+		else:
+			summaries = [summarize_archive(missing[0][0])]
+		for (path, stat), summary in zip(missing, summaries):
+			cache[os.path.basename(path)] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "days": summary}
+		# Archives that have been compressed or deleted
+		existing = {os.path.basename(path) for _, path in archive_files()}
+		cache = {name: entry for name, entry in cache.items() if name in existing}
+		temp_filename = f"{REPORT_CACHE_FILENAME}.{os.getpid()}.tmp"
+		try:
+			with open(temp_filename, "w") as cache_file:
+				json.dump(cache, cache_file)
+			os.replace(temp_filename, REPORT_CACHE_FILENAME)
+		except OSError as e:
+			print(f"Cannot save report cache: {e}")
+
+	all_days = [cache[name]["days"] for name in wanted]
+	with log_lock(exclusive=False):
+		all_days.append(summarize_lines(read_log_lines()))
+
+	return [(day, users) for days in all_days for day, users in days.items() if day_in_range(day, since, until)]
+
+
+def day_in_range(day: str, since: Optional[str], until: Optional[str]) -> bool:
+	"""
+	Check if a day is in a range. Limits can be a year, a month or a day, they're compared as prefixes.
+
+	:param day: YYYY-MM-DD
+	:param since: YYYY, YYYY-MM or YYYY-MM-DD, None for no limit
+	:param until: YYYY, YYYY-MM or YYYY-MM-DD, included, None for no limit
+	"""
+	return (since is None or day[:len(since)] >= since) and (until is None or day[:len(until)] <= until)
+
+
+def archives_in_range(since: Optional[str], until: Optional[str]) -> list:
+	"""
+	Find the archives that may have sessions in a range. Sessions still open at the end of a month are carried
+	over and archived with the next month, at the beginning and with their login date: an archive after the
+	range is needed too, if it starts with a day in range.
+
+	:param since: YYYY, YYYY-MM or YYYY-MM-DD, None for no limit
+	:param until: YYYY, YYYY-MM or YYYY-MM-DD, included, None for no limit
+	:return: sorted list of (YYYY-MM, path), like archive_files()
+	"""
+	archives = []
+	for month, path in archive_files():
+		if not month_in_range(month, since, None):
+			continue
+		if not month_in_range(month, None, until):
+			first_day = next((line_day(line) for line in read_archive_lines(path) if len(line) >= 47), None)
+			# Later archives start later
+			if first_day is None or first_day[:len(until)] > until:
+				break
+		archives.append((month, path))
+	return archives
+
+
+def month_in_range(month: str, since: Optional[str], until: Optional[str]) -> bool:
+	"""
+	Check if any day of a month is in a range
+
+	:param month: YYYY-MM
+	"""
+	return (since is None or month >= since[:7]) and (until is None or month <= until[:7])
+
+
+def date_argument(text: str) -> str:
+	"""
+	Parse a date from the command line
+
+	:param text: YYYY, YYYY-MM, YYYY-MM-DD or dd/mm/YYYY
+	:return: YYYY, YYYY-MM or YYYY-MM-DD
+	"""
+	if len(text) == 10 and text[2] == "/" and text[5] == "/":
+		text = f"{text[6:10]}-{text[3:5]}-{text[0:2]}"
+	parts = text.split("-")
+	if len(parts) > 3 or not all(part.isdigit() for part in parts) or [len(part) for part in parts] != [4, 2, 2][:len(parts)] \
+		or not all(1 <= int(part) <= limit for part, limit in zip(parts[1:], (12, 31))):
+		raise argparse.ArgumentTypeError(f"invalid date: {text} (use YYYY, YYYY-MM, YYYY-MM-DD or dd/mm/YYYY)")
+	return text
+
+
+def timestamp_argument(text: str) -> str:
+	"""
+	Parse a date and time from the command line
+
+	:param text: dd/mm/YYYY HH:MM
+	:return: the same, if it's valid
+	"""
+	from datetime import datetime
+	try:
+		datetime.strptime(text, "%d/%m/%Y %H:%M")
+	except ValueError:
+		raise argparse.ArgumentTypeError(f"invalid date and time: {text} (use \"dd/mm/YYYY HH:MM\")")
+	# strptime is fine with 1/2/2020 9:5, the log isn't
+	if len(text) != 16:
+		raise argparse.ArgumentTypeError(f"invalid date and time: {text} (use \"dd/mm/YYYY HH:MM\")")
+	return text
+
+
+def report(username: Optional[str], since: Optional[str], until: Optional[str], monthly: bool):
+	"""
+	Print time spent in lab by each user
+
+	:param username: only this user, None for everyone
+	:param since: YYYY, YYYY-MM or YYYY-MM-DD, None for no limit
+	:param until: YYYY, YYYY-MM or YYYY-MM-DD, included, None for no limit
+	:param monthly: one table per month instead of one for the whole period
+	"""
+	# YYYY-MM or "" -> username -> [minutes, sessions]
+	periods = {}
+	for day, users in storage().summaries(since, until):
+		total = periods.setdefault(day[:7] if monthly else "", {})
+		for user, (minutes, sessions) in users.items():
+			if username is None or user == username:
+				entry = total.setdefault(user, [0, 0])
+				entry[0] += minutes
+				entry[1] += sessions
+	if len(periods) == 0:
+		periods[""] = {}
+
+	print(f"Time spent in lab from {since or 'the beginning'} to {until or 'today'}:")
+	for period, users in sorted(periods.items()):
+		if monthly:
+			print(f"\n{period}:")
+		if len(users) == 0:
+			print(f"Nobody.")
+			continue
+		for user, (minutes, sessions) in sorted(users.items(), key=lambda item: item[1][0], reverse=True):
+			print(f"{user:<30} {time_conv(minutes):>12}  ({sessions} sessions)")
+		if len(users) > 1:
+			minutes = sum(entry[0] for entry in users.values())
+			sessions = sum(entry[1] for entry in users.values())
+			print(f"{'Total':<30} {time_conv(minutes):>12}  ({sessions} sessions)")
+
+
+def read_archive_bytes(path: str, since: Optional[str] = None, until: Optional[str] = None) -> bytes:
+	"""
+	Same as read_archive_lines(), but everything at once and not decoded
+	"""
+	if not path.endswith(".gz"):
+		with open(path, "rb") as archive_file:
+			return archive_file.read()
+
+	import zlib
+	members = None if since is None and until is None else archive_members(path, since, until)
+	with open(path, "rb") as archive_file:
+		if members is None:
+			import gzip
+			return gzip.decompress(archive_file.read())
+		chunks = []
+		for offset, length in members:
+			archive_file.seek(offset)
+			chunks.append(zlib.decompress(archive_file.read(length), 16 + zlib.MAX_WBITS))
+	return b"".join(chunks)
+
+
+def import_numpy():
+	"""
+	Import numpy, which is only needed for --occupancy
+
+	:return: numpy module, None if not installed
+	"""
+	try:
+		with startup_timer("import numpy"):
+			import numpy
+	except ImportError:
+		print(f"{COLOR_RED}--occupancy needs numpy, install it with pip install numpy{COLOR_NATIVE}")
+		return None
+	return numpy
+
+
+def timestamps_minutes(np, fields, offset: int) -> tuple:
+	"""
+	Same as timestamp_minutes(), for a whole column of log lines at once
+
+	:param np: numpy
+	:param fields: log lines as a matrix of digits (character - "0"), one row per line
+	:param offset: where the timestamp starts, dd/mm/YYYY HH:MM
+	:return: (minutes, valid) arrays, valid is False where the timestamp is broken
+	"""
+	digits = fields[:, [offset + i for i in (0, 1, 3, 4, 6, 7, 8, 9, 11, 12, 14, 15)]]
+	day, month, year, hour, minute = (
+		(digits[:, i:j] * 10 ** np.arange(j - i - 1, -1, -1)).sum(axis=1) for i, j in ((0, 2), (2, 4), (4, 8), (8, 10), (10, 12)))
+	valid = ((digits >= 0) & (digits <= 9)).all(axis=1) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= 31) \
+		& (hour < 24) & (minute < 60)
+	# Days since 1970-01-01 (http://howardhinnant.github.io/date_algorithms.html#days_from_civil), then the same
+	# ordinal as date.toordinal()
+	year = year - (month <= 2)
+	era = year // 400
+	year_of_era = year - era * 400
+	day_of_year = (153 * np.where(month > 2, month - 3, month + 9) + 2) // 5 + day - 1
+	day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+	ordinal = era * 146097 + day_of_era - 719468 + 719163
+	return ordinal * 1440 + hour * 60 + minute, valid
+
+
+def session_intervals(np, data: bytes, now: int) -> tuple:
+	"""
+	Find when each session started and ended, for every line at once. Sessions that are still open end now,
+	broken lines are skipped.
+
+	:param np: numpy
+	:param data: log lines, as in the log file
+	:param now: current time, as returned by timestamp_minutes()
+	:return: (logins, logouts, lines), minutes as numpy arrays and the line of each session
+	"""
+	lines = data.split(b"\n")
+	# Only the fixed width part: [login] [logout] [duration] <
+	raw = np.array(lines, dtype="S47").view(np.uint8).reshape(-1, 47)
+	fields = raw.astype(np.int64) - ord("0")
+	logins, valid_login = timestamps_minutes(np, fields, 1)
+	logouts, valid_logout = timestamps_minutes(np, fields, 20)
+	in_lab = (raw[:, 39:44] == np.frombuffer(b"INLAB", dtype=np.uint8)).all(axis=1)
+	logouts = np.where(in_lab, now, logouts)
+	# Not always in the same column: older versions wrote durations like [-22:00] for sessions past midnight
+	has_username = np.array([line.find(b"] <", 43) >= 0 for line in lines], dtype=bool)
+	valid = (raw[:, [0, 17, 19, 36, 38]] == np.frombuffer(b"[][][", dtype=np.uint8)).all(axis=1) \
+		& has_username & valid_login & (valid_logout | in_lab) & (logouts > logins)
+	selected = np.flatnonzero(valid)
+	return logins[selected], logouts[selected], np.array(lines, dtype=object)[selected]
+
+
+def date_range(since: Optional[str], until: Optional[str]) -> tuple:
+	"""
+	First and last day of a range, as in day_in_range()
+
+	:param since: YYYY, YYYY-MM or YYYY-MM-DD, None for no limit
+	:param until: YYYY, YYYY-MM or YYYY-MM-DD, included, None for no limit
+	:return: (first, last) as date, None where there's no limit
+	"""
+	from calendar import monthrange
+	from datetime import date
+	first = None
+	if since is not None:
+		year, month = int(since[:4]), int(since[5:7] or 1)
+		first = date(year, month, min(int(since[8:10] or 1), monthrange(year, month)[1]))
+	last = None
+	if until is not None:
+		year, month = int(until[:4]), int(until[5:7] or 12)
+		days = monthrange(year, month)[1]
+		last = date(year, month, min(int(until[8:10] or days), days))
+	return first, last
+
+
+def occupancy(since: Optional[str], until: Optional[str], csv_filename: Optional[str]) -> bool:
+	"""
+	Print how many people are in lab, on average and at most, for each weekday and hour, and the busiest days.
+	Computed with a sweep line over every login and logout: each one is a +1 or -1 step in the number of people,
+	sorted by time.
+
+	:param since: YYYY, YYYY-MM or YYYY-MM-DD, None for no limit
+	:param until: YYYY, YYYY-MM or YYYY-MM-DD, included, None for no limit
+	:param csv_filename: also write average and peak for each day and hour there, "-" for stdout
+	:return: True if everything went fine, False if numpy is missing
+	"""
+	from datetime import date, timedelta
+	np = import_numpy()
+	if np is None:
+		return False
+
+	first_day, last_day = date_range(since, until)
+	# Sessions that started the day before may end after midnight
+	read_since = None if first_day is None else (first_day - timedelta(days=1)).isoformat()
+	data = storage().log_bytes(read_since, until)
+	now = timestamp_minutes(strftime("%d/%m/%Y %H:%M"))
+	logins, logouts, lines = session_intervals(np, data, now)
+	if len(logins) == 0:
+		print("Nobody has ever been in lab.")
+		return True
+
+	# Whole days, from midnight to midnight
+	start = logins.min() // 1440 * 1440 if first_day is None else first_day.toordinal() * 1440
+	end = -(-logouts.max() // 1440) * 1440 if last_day is None else (last_day.toordinal() + 1) * 1440
+	logins = np.maximum(logins, start)
+	logouts = np.minimum(logouts, end)
+	selected = np.flatnonzero(logouts > logins)
+	logins, logouts, lines = logins[selected], logouts[selected], lines[selected]
+	if len(logins) == 0 or end <= start:
+		print(f"Nobody was in lab from {since or 'the beginning'} to {until or 'today'}.")
+		return True
+
+	# Logouts before logins at the same minute, or people that swap places would count twice
+	times = np.concatenate((logins, logouts))
+	steps = np.concatenate((np.ones(len(logins), dtype=np.int64), -np.ones(len(logouts), dtype=np.int64)))
+	order = np.lexsort((steps, times))
+	times = times[order]
+	people = np.cumsum(steps[order])
+	# Minutes spent in lab by everyone together, from the first login to each event
+	area = np.concatenate(([0], np.cumsum(people[:-1] * np.diff(times))))
+
+	days = (end - start) // 1440
+	edges = start + 60 * np.arange(days * 24 + 1)
+	before = np.searchsorted(times, edges, side="right") - 1
+	people_at_edges = np.where(before < 0, 0, people[np.maximum(before, 0)])
+	area_at_edges = np.where(before < 0, 0, area[np.maximum(before, 0)] + people_at_edges * (edges - times[np.maximum(before, 0)]))
+	average = (np.diff(area_at_edges) / 60).reshape(days, 24)
+	# Most people at once in each hour: at the beginning of the hour, or after any event in that hour
+	peak = people_at_edges[:-1].copy()
+	first = np.searchsorted(times, edges[:-1], side="left")
+	last = np.searchsorted(times, edges[1:], side="left")
+	busy = np.flatnonzero(last > first)
+	if len(busy) > 0:
+		peak[busy] = np.maximum(peak[busy], np.maximum.reduceat(people, first[busy]))
+	peak = peak.reshape(days, 24)
+
+	weekdays = (start // 1440 + np.arange(days) - 1) % 7
+	count = np.bincount(weekdays, minlength=7)
+	weekday_average = np.zeros((7, 24))
+	np.add.at(weekday_average, weekdays, average)
+	weekday_average /= np.maximum(count, 1)[:, None]
+	weekday_peak = np.zeros((7, 24), dtype=np.int64)
+	np.maximum.at(weekday_peak, weekdays, peak)
+
+	shades = " .:-=+*#%@"
+	top = weekday_average.max()
+	print(f"Average people in lab from {since or 'the beginning'} to {until or 'today'} (\"{shades[-1]}\" is {top:.1f}):")
+	print("    " + "".join(f"{hour:>3}" for hour in range(24)))
+	for weekday, name in enumerate(("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")):
+		levels = np.ceil(weekday_average[weekday] / top * (len(shades) - 1)).astype(int) if top > 0 else np.zeros(24, dtype=int)
+		print(f"{name} " + "".join(f" {shades[level] * 2}" for level in levels))
+	print("\nMost people in lab at once:")
+	print("    " + "".join(f"{hour:>3}" for hour in range(24)))
+	for weekday, name in enumerate(("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")):
+		print(f"{name} " + "".join(f"{value:>3}" if value > 0 else "  ." for value in weekday_peak[weekday]))
+
+	print("\nBusiest days:")
+	day_peak = peak.max(axis=1)
+	for day in np.argsort(-day_peak, kind="stable")[:5]:
+		if day_peak[day] == 0:
+			break
+		# When the peak happened, then who was there
+		day_start = start + day * 1440
+		a, b = np.searchsorted(times, (day_start, day_start + 1440), side="left")
+		moment = day_start if b == a or people[a:b].max() < day_peak[day] else times[a + np.argmax(people[a:b])]
+		present = np.flatnonzero((logins <= moment) & (logouts > moment))
+		names = sorted(line_username(line.decode()) for line in lines[present])
+		when = date.fromordinal(int(moment // 1440)).strftime("%d/%m/%Y")
+		print(f"{when} {moment % 1440 // 60:02d}:{moment % 60:02d}  {day_peak[day]} people: {', '.join(names)}")
+
+	if csv_filename is not None:
+		import csv
+		dates = [date.fromordinal(int(start // 1440) + day).isoformat() for day in range(days)]
+		rows = ((dates[day], hour, f"{average[day, hour]:.2f}", peak[day, hour]) for day in range(days) for hour in range(24))
+		with (open(csv_filename, "w", newline="") if csv_filename != "-" else nullcontext(sys.stdout)) as csv_file:
+			writer = csv.writer(csv_file)
+			writer.writerow(("date", "hour", "average", "peak"))
+			writer.writerows(rows)
+	return True
+
+
+def completion_names() -> list:
+	"""
+	Names that can be typed at the interactive login and logout: usernames from the log and nicknames from the
+	user cache
+
+	:return: sorted names
+	"""
+	names = set(storage().usernames())
+	for entry in load_user_cache().values():
+		names.update(entry["nicknames"])
+	return sorted(names)
+
+
+@contextmanager
+def name_completion(names: list):
+	"""
+	Complete names with tab in input(), inside this block
+
+	:param names: sorted
+	"""
+	import readline
+	from bisect import bisect_left
+
+	matches = []
+
+	def complete(text: str, state: int) -> Optional[str]:
+		if state == 0:
+			matches.clear()
+			for name in names[bisect_left(names, text):]:
+				if not name.startswith(text):
+					break
+				matches.append(name)
+		return matches[state] if state < len(matches) else None
+
+	previous_completer = readline.get_completer()
+	previous_delimiters = readline.get_completer_delims()
+	readline.set_completer(complete)
+	# Usernames have dots and dashes in them
+	readline.set_completer_delims(" \t\n")
+	if "libedit" in (readline.__doc__ or ""):
+		readline.parse_and_bind("bind ^I rl_complete")
+	else:
+		readline.parse_and_bind("tab: complete")
+	try:
+		yield
+	finally:
+		readline.set_completer(previous_completer)
+		readline.set_completer_delims(previous_delimiters)
+
+
 def interactive_log(in_: bool, use_ldap: bool):
+	# Allows using backspace and arrow keys in input
+	# noinspection PyUnresolvedReferences
+	import readline
+
+	names = completion_names()
 	retry = True
 	retry_username = None
 	while retry:
@@ -533,7 +3341,10 @@ def interactive_log(in_: bool, use_ldap: bool):
 				username = retry_username
 				retry_username = None
 			else:
-				username = input("Type your name.surname OR id (matricola) OR nickname OR swipe the card on the reader:\n")
+				if use_ldap:
+					ldap_connect_in_background()
+				with name_completion(names):
+					username = input("Type your name.surname OR id (matricola) OR nickname OR swipe the card on the reader:\n")
 				matricola_scan = read_from_card_reader(username)
 				if matricola_scan:  # Input with magnetic card
 					username = matricola_scan
@@ -568,65 +3379,690 @@ def interactive_log(in_: bool, use_ldap: bool):
 			return False
 
 
-def read_from_card_reader(text: str) -> Optional[str]:
-	old_format = False
-	direction = None
-	# matricola = None
-	if text[0] == "ò":
-		if text[-1] == "-":
-			direction = " from top to bottom"
-			old_format = True
-		elif text[-1] == "_":
-			direction = " from bottom to top"
-			old_format = True
-	elif text[0] == ";":
-		if text[-1] == "/":
-			direction = " from top to bottom"
-			old_format = True
-		elif text[-1] == "?":
-			direction = " from bottom to top"
-			old_format = True
+def kiosk(device: str, use_ldap: bool, message: Optional[str], window: float) -> bool:
+	"""
+	Stay there and log people in or out, depending on whether they are in lab, as they swipe their cards
+	(or type their username), one per line. Everything stays loaded between swipes: LDAP connection, users,
+	index of people in lab.
+
+	:param device: where swipes come from, e.g. a serial card reader, "-" for stdin
+	:param use_ldap: Connect to remote LDAP server or blindly trust the input
+	:param message: logout message, None to ask it on the terminal if swipes come from a device, or KIOSK_MESSAGE
+	:param window: seconds, the same card swiped again within this time is ignored (readers sometimes read twice)
+	:return: True when input ends
+	"""
+	global FIRST_IN_HAPPENED, LAST_OUT_HAPPENED, SIR_HAPPENED
+	ask = message is None and device != "-" and sys.stdin.isatty()
+	source = sys.stdin if device == "-" else open(device, "r", errors="replace")
+	# Hooks are never waited for
+	signal.signal(signal.SIGCHLD, reap_children)
+	if use_ldap:
+		try:
+			ldap_connection(verbose=False)
+		except LdapError:
+			# Maybe it will work later, users in cache can log in anyway
+			pass
+
+	# name or matricola -> when it was last swiped
+	last_swipe = {}
+	print(f"Swipe your card or type your name.surname OR id (matricola) OR nickname")
+	try:
+		for line in iter(source.readline, ""):
+			text = line.strip()
+			if len(text) == 0:
+				continue
+			username = read_from_card_reader(text) or text
+			now = monotonic()
+			last_swipe = {name: when for name, when in last_swipe.items() if now - when < window}
+			if username in last_swipe:
+				print(f"Already got that, wait a few seconds before swiping again")
+				continue
+			last_swipe[username] = now
+
+			try:
+				create_backup_if_necessary()
+				kiosk_swipe(username, use_ldap, message or (None if ask else KIOSK_MESSAGE))
+			except LdapError:
+				print(f"Hmmm... It seems the network or the LDAP server has some problems, try again later.")
+			except (UserNotFoundError, LockTimeoutError):
+				pass
+			show_sir_banner()
+			launch_hooks()
+			launch_replication()
+			FIRST_IN_HAPPENED = False
+			LAST_OUT_HAPPENED = False
+			SIR_HAPPENED = False
+			print(f"\nSwipe your card or type your name.surname OR id (matricola) OR nickname")
+			sys.stdout.flush()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if source is not sys.stdin:
+			source.close()
+	return True
+
+
+def kiosk_swipe(username: str, use_ldap: bool, message: Optional[str]):
+	"""
+	Log in or out someone that swiped the card, depending on whether they are in lab
+
+	:param username: username, nickname or matricola
+	:param message: logout message, None to ask
+	"""
+	if not is_logged_in(username):
+		# Matricola or nickname, but the log has usernames
+		if use_ldap:
+			user = get_user(username)
+		else:
+			user, _ = user_cache_lookup(username)
+		if user is None or not is_logged_in(user.username):
+			login(username, use_ldap)
+			return
+		username = user.username
+	logout(username, use_ldap, message)
+
+
+def read_from_card_reader(text: str) -> Optional[str]:
+	old_format = False
+	direction = None
+	# matricola = None
+	if text[0] == "ò":
+		if text[-1] == "-":
+			direction = " from top to bottom"
+			old_format = True
+		elif text[-1] == "_":
+			direction = " from bottom to top"
+			old_format = True
+	elif text[0] == ";":
+		if text[-1] == "/":
+			direction = " from top to bottom"
+			old_format = True
+		elif text[-1] == "?":
+			direction = " from bottom to top"
+			old_format = True
+
+	if old_format:
+		matricola = text[9:15]
+	else:
+		matricola = read_from_card_reader_o_accentata(text, "ò")
+		if not matricola:
+			matricola = read_from_card_reader_o_accentata(text, ";")
+
+	if matricola is not None:
+		print(f"Detected card scan{direction if direction else ''} with matricola {matricola}")
+		return matricola
+	return None
+
+
+def read_from_card_reader_o_accentata(text: str, delimiter: str):
+	try:
+		i = 0
+		while 1:
+			i = text.index(delimiter, i)
+			if text[i + 1:i + 5] == "0000" and len(text) > i + 15 + 1:
+				return text[i + 9:i + 15]
+	except ValueError:
+		return None
+
+
+def forwardable(args_dict) -> bool:
+	"""
+	Tell if the daemon can do this action: anything that doesn't need to ask questions on the terminal
+	"""
+	if args_dict.get('logout'):
+		return args_dict.get('message') is not None
+	if args_dict.get('log'):
+		# Filters and the like are not forwarded
+		return not any(args_dict.get(option) for option in LOG_VIEWER_ARGS)
+	return bool(args_dict.get('login') or args_dict.get('inlab'))
+
+
+def forward_to_daemon(args_dict) -> Optional[int]:
+	"""
+	Send the action to the daemon, if it's running, and print its output
+
+	:param args_dict: parsed arguments
+	:return: exit code, or None if there's no daemon and the action should be done here
+	"""
+	if not forwardable(args_dict) or not os.path.exists(SOCKET_PATH):
+		return None
+	import json
+	import socket
+
+	request = {key: args_dict.get(key) for key in FORWARDED_ARGS}
+	try:
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+			client.settimeout(DAEMON_TIMEOUT)
+			client.connect(SOCKET_PATH)
+			client.sendall(json.dumps(request).encode() + b"\n")
+			client.shutdown(socket.SHUT_WR)
+			response = b""
+			while True:
+				chunk = client.recv(65536)
+				if not chunk:
+					break
+				response += chunk
+	except (FileNotFoundError, ConnectionRefusedError):
+		# Stale socket, the daemon is not running
+		return None
+	except OSError as e:
+		# It may have done the action already, doing it again here would be wrong
+		print(f"Error talking to the weeelab daemon: {e}")
+		return 3
+
+	try:
+		response = json.loads(response)
+	except ValueError:
+		print(f"The weeelab daemon sent a garbled response, check if it's still alive")
+		return 3
+	sys.stdout.write(response["output"])
+	return response["exit_code"]
+
+
+def handle_request(request: dict) -> dict:
+	"""
+	Do an action for a client, in the daemon
+
+	:param request: some of the parsed arguments from the client
+	:return: what to send back to the client: its output and exit code
+	"""
+	import traceback
+
+	global FIRST_IN_HAPPENED, LAST_OUT_HAPPENED, SIR_HAPPENED
+	FIRST_IN_HAPPENED = False
+	LAST_OUT_HAPPENED = False
+	SIR_HAPPENED = False
+
+	args_dict = {key: request.get(key) for key in FORWARDED_ARGS}
+	output = io.StringIO()
+	exit_code = 0
+	with redirect_stdout(output):
+		try:
+			if not forwardable(args_dict):
+				print("The weeelab daemon can't do that")
+				exit_code = 2
+			else:
+				ensure_log_file()
+				create_backup_if_necessary()
+				result, _ = run_action(args_dict)
+				show_sir_banner()
+				launch_hooks()
+				launch_replication()
+				if not result:
+					exit_code = 3
+		except LockTimeoutError:
+			exit_code = 3
+		except SystemExit as e:
+			exit_code = e.code if isinstance(e.code, int) else 1
+		except Exception:
+			traceback.print_exc(file=output)
+			exit_code = 1
+	return {"output": output.getvalue(), "exit_code": exit_code}
+
+
+def serve():
+	"""
+	Run as a daemon: keep configuration, LDAP connection and everything else loaded, and do actions for clients
+	connecting to SOCKET_PATH. Requests are handled one at a time.
+	"""
+	import json
+	import socket
+	import socketserver
+
+	if os.path.exists(SOCKET_PATH):
+		try:
+			with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+				client.connect(SOCKET_PATH)
+			print(f"Another weeelab daemon is already listening on {SOCKET_PATH}")
+			secure_exit(1)
+		except ConnectionRefusedError:
+			# Left there by a daemon that crashed
+			os.remove(SOCKET_PATH)
+
+	class RequestHandler(socketserver.StreamRequestHandler):
+		def handle(self):
+			try:
+				request = json.loads(self.rfile.readline())
+			except ValueError:
+				return
+			response = handle_request(request)
+			self.wfile.write(json.dumps(response).encode())
+
+	ensure_log_file()
+	# Hooks are never waited for
+	signal.signal(signal.SIGCHLD, reap_children)
+	# Exit cleanly (i.e. remove the socket) on systemctl stop
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+	old_umask = os.umask(0o117)
+	server = socketserver.UnixStreamServer(SOCKET_PATH, RequestHandler)
+	os.umask(old_umask)
+	print(f"weeelab daemon listening on {SOCKET_PATH}")
+	sys.stdout.flush()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		os.remove(SOCKET_PATH)
+		print(f"weeelab daemon stopped")
+
+
+class LogModel:
+	"""
+	Sessions of this month in memory, for --http. When the log changes, only what changed is read again: lines
+	appended to log.txt, open sessions that were closed in place and new entries in the journal. The whole file
+	is read again only when it's replaced (new month, --merge-journal, admin mode...). With STORAGE=sqlite, this
+	month is queried again from the database when it changes.
+
+	Only one thread calls refresh(), any thread can read. Answers are computed once per version of the log.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		# Serializes reads from storage(), by refresh() and for older sessions
+		self.storage_lock = threading.Lock()
+		# Legacy format, with messages
+		self.lines = []
+		# Byte offset -> index in lines, of sessions still open
+		self.open = {}
+		self.journal = {}
+		self.inode = None
+		self.size = 0
+		self.journal_size = 0
+		self.signature = None
+		# First day that is in memory, YYYY-MM-DD: older sessions are in the archives
+		self.first_day = strftime("%Y-%m-01")
+		self.version = 0
+		self.cache = {}
+		self.stats = {"reloads": 0, "updates": 0, "bytes_read": 0}
+
+	def watched_files(self) -> list:
+		"""
+		:return: paths of the files that, when they change, mean that the log changed
+		"""
+		if isinstance(storage(), SqliteStorage):
+			return [SQLITE_FILENAME, SQLITE_FILENAME + "-wal"]
+		return [LOG_FILENAME, journal_filename()]
+
+	def read_signature(self) -> tuple:
+		signature = []
+		for path in (LOG_FILENAME, journal_filename()):
+			try:
+				stat = os.stat(path)
+				signature.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+			except FileNotFoundError:
+				signature.append(None)
+		return tuple(signature)
+
+	def refresh(self, force: bool = False) -> bool:
+		"""
+		Catch up with the log, if it changed since last time. Readers see the old sessions until it's done.
+
+		:param force: look for changes in the log file even if its size and modification time are the same,
+		which happens when a line is closed in place within the same clock tick
+		:return: True if something may have changed
+		"""
+		with self.storage_lock:
+			if isinstance(storage(), SqliteStorage):
+				# Changes whenever another connection commits something
+				signature = storage().db.execute("PRAGMA data_version").fetchone()[0]
+				if signature == self.signature:
+					return False
+				self.load_database()
+			else:
+				# Writes come with inotify events, waiting for the writer is the usual case here
+				with log_lock(exclusive=False, verbose=False):
+					signature = self.read_signature()
+					if signature == self.signature and not force:
+						return False
+					stat = os.stat(LOG_FILENAME)
+					if stat.st_ino != self.inode or stat.st_size < self.size:
+						self.load_file(stat)
+					else:
+						self.update_file(stat)
+			self.signature = signature
+		return True
+
+	def load_database(self):
+		lines = list(storage().lines(archives=False))
+		with self.lock:
+			self.lines = lines
+			self.first_day = strftime("%Y-%m-01")
+			self.new_version()
+			self.stats["reloads"] += 1
+
+	def load_file(self, stat):
+		"""
+		Read the whole log file. Caller holds the lock on the log.
+		"""
+		self.inode = stat.st_ino
+		self.journal_size = 0
+		journal = self.read_journal()
+		with open(LOG_FILENAME, "rb") as log_file:
+			data = log_file.read(stat.st_size)
+		month = log_month()
+		lines, open_sessions, size = self.parse(data, 0, journal)
+		with self.lock:
+			self.lines, self.open, self.journal = lines, open_sessions, journal
+			self.size = size
+			self.first_day = strftime("%Y-%m-01") if month is None else f"{month[:4]}-{month[4:]}-01"
+			self.new_version()
+			self.stats["reloads"] += 1
+			self.stats["bytes_read"] += len(data)
+
+	def update_file(self, stat):
+		"""
+		Read only what changed in the log file and journal. Caller holds the lock on the log.
+		"""
+		journal = self.read_journal()
+		closed = {}
+		with open(LOG_FILENAME, "rb") as log_file:
+			for offset in self.open:
+				log_file.seek(offset)
+				raw_line = log_file.readline()
+				self.stats["bytes_read"] += len(raw_line)
+				if raw_line[39:44] != b"INLAB":
+					closed[offset] = raw_line.decode()
+			log_file.seek(self.size)
+			data = log_file.read(stat.st_size - self.size)
+			self.stats["bytes_read"] += len(data)
+		with self.lock:
+			self.journal.update(journal)
+			for offset, line in closed.items():
+				self.lines[self.open.pop(offset)] = journal_merged_line(self.journal, offset, line)
+			lines, open_sessions, size = self.parse(data, self.size, self.journal)
+			for offset, index in open_sessions.items():
+				self.open[offset] = index + len(self.lines)
+			self.lines.extend(lines)
+			self.size += size
+			if journal or closed or lines:
+				self.new_version()
+				self.stats["updates"] += 1
+
+	@staticmethod
+	def parse(data: bytes, start: int, journal: dict) -> tuple:
+		"""
+		Split bytes read from the log file into lines. An incomplete line at the end is left for next time.
+
+		:param start: byte offset of data in the file
+		:return: (lines, offset -> index of open sessions, bytes used)
+		"""
+		lines = []
+		open_sessions = {}
+		offset = start
+		for raw_line in data[:data.rfind(b"\n")].split(b"\n") if b"\n" in data else []:
+			raw_line += b"\n"
+			if raw_line[39:44] == b"INLAB":
+				open_sessions[offset] = len(lines)
+			lines.append(journal_merged_line(journal, offset, raw_line.decode()))
+			offset += len(raw_line)
+		return lines, open_sessions, offset - start
+
+	def read_journal(self) -> dict:
+		"""
+		Read entries added to the journal since last time
+
+		:return: byte offset of the line -> (username, message)
+		"""
+		entries, end = read_journal_entries(self.inode, self.journal_size)
+		self.stats["bytes_read"] += max(0, end - self.journal_size)
+		self.journal_size = end
+		return entries
+
+	def new_version(self):
+		# Caller holds self.lock
+		self.version += 1
+		self.cache = {}
+
+	def cached(self, key, compute):
+		"""
+		Compute something from the sessions, or get it from last time if nothing changed
+
+		:param key: what it is, hashable
+		:param compute: function that computes it, called with the lock held
+		"""
+		with self.lock:
+			if key not in self.cache:
+				if len(self.cache) > 100:
+					self.cache = {}
+				self.cache[key] = compute()
+			return self.cache[key]
+
+
+def session_json(line: str) -> Optional[dict]:
+	"""
+	A line of the log, as --http shows it
+
+	:return: username, login, logout, duration and message, None if it's not a log line
+	"""
+	if len(line) < 47 or '<' not in line or '>' not in line:
+		return None
+	closed = not inlab_line(line)
+	return {
+		"username": line_username(line),
+		"login": SqliteStorage.iso_time(line[1:17]),
+		"logout": SqliteStorage.iso_time(line[20:36]) if closed else None,
+		"duration": line[39:44] if closed else None,
+		"message": line_message(line),
+	}
+
+
+def http_inlab(model: LogModel) -> dict:
+	people = [session_json(line) for line in model.lines if inlab_line(line)]
+	return {
+		"count": len(people),
+		"people": [{"username": person["username"], "login": person["login"]} for person in people],
+	}
 
-	if old_format:
-		matricola = text[9:15]
-	else:
-		matricola = read_from_card_reader_o_accentata(text, "ò")
-		if not matricola:
-			matricola = read_from_card_reader_o_accentata(text, ";")
 
-	if matricola is not None:
-		print(f"Detected card scan{direction if direction else ''} with matricola {matricola}")
-		return matricola
-	return None
+def http_log(model: LogModel, query: dict) -> dict:
+	"""
+	Sessions for /log, oldest first
 
+	:param query: since, until (YYYY[-MM[-DD]]), user and tail (last N sessions), all optional. Without since,
+	only this month.
+	"""
+	since = None if query.get("since") is None else date_argument(query["since"])
+	until = None if query.get("until") is None else date_argument(query["until"])
+	tail = None if query.get("tail") is None else int(query["tail"])
+	if tail is not None and tail < 0:
+		raise ValueError("tail must be positive")
+	matches = line_filter(query.get("user"), since, until, None)
+
+	def sessions(lines) -> dict:
+		found = [session_json(line) for line in lines if matches(line)]
+		return {"sessions": found if tail is None else found[max(0, len(found) - tail):]}
+
+	# YYYY -> YYYY-01-01, YYYY-MM -> YYYY-MM-01
+	if since is not None and (since + "-01-01")[:10] < model.first_day:
+		with model.storage_lock, log_lock(exclusive=False):
+			return sessions(storage().lines(since, until))
+	return model.cached(("log", since, until, query.get("user"), tail), lambda: sessions(model.lines))
+
+
+def http_stats(model: LogModel) -> dict:
+	today = strftime("%Y-%m-%d")
+
+	def totals(days: dict, prefix: str) -> dict:
+		people = set()
+		minutes = 0
+		sessions = 0
+		for day, users in days.items():
+			if day.startswith(prefix):
+				people.update(users)
+				minutes += sum(user[0] for user in users.values())
+				sessions += sum(user[1] for user in users.values())
+		return {"sessions": sessions, "people": len(people), "minutes": minutes}
+
+	def compute() -> dict:
+		days = summarize_lines(model.lines)
+		return {
+			"in_lab": sum(1 for line in model.lines if inlab_line(line)),
+			"today": totals(days, today),
+			"month": totals(days, today[:7]),
+			"lines": len(model.lines),
+			"version": model.version,
+		}
+	return dict(model.cached(("stats", today), compute), reads=dict(model.stats))
+
+
+def inotify_watch(paths: list) -> Optional[int]:
+	"""
+	Start watching the directories of some files for writes, creations, renames and deletions, with inotify(7)
 
-def read_from_card_reader_o_accentata(text: str, delimiter: str):
+	:return: file descriptor to read events from, None if inotify is not available
+	"""
 	try:
-		i = 0
-		while 1:
-			i = text.index(delimiter, i)
-			if text[i + 1:i + 5] == "0000" and len(text) > i + 15 + 1:
-				return text[i + 9:i + 15]
-	except ValueError:
+		import ctypes
+		libc = ctypes.CDLL(None, use_errno=True)
+		fd = libc.inotify_init1(os.O_CLOEXEC)
+	except (OSError, AttributeError):
 		return None
+	if fd < 0:
+		return None
+	# IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+	mask = 0x2 | 0x8 | 0x80 | 0x100 | 0x200
+	for directory in {os.path.dirname(os.path.abspath(path)) for path in paths}:
+		if libc.inotify_add_watch(fd, os.fsencode(directory), mask) < 0:
+			os.close(fd)
+			return None
+	return fd
 
 
-def main(args_dict):
-	# root execution check
-	if os.geteuid() == 0:
-		print("Error: can't execute " + PROGRAM_NAME + " as root.")
-		exit(42)
+def inotify_names(data: bytes) -> set:
+	"""
+	Names of the files in some inotify events
 
-	if args_dict.get('debug'):
-		global DEBUG_MODE
-		DEBUG_MODE = True
-		print(f"DEBUG_MODE enabled")
-		global LOG_FILENAME
-		LOG_FILENAME = "./debug/log.txt"
+	:param data: what was read from the inotify file descriptor
+	:return: file names, None among them if some events were lost
+	"""
+	import struct
+	names = set()
+	position = 0
+	while position + 16 <= len(data):
+		# struct inotify_event: wd, mask, cookie, len, then the name padded with NULs
+		_, mask, _, length = struct.unpack_from("iIII", data, position)
+		if mask & 0x4000:
+			# IN_Q_OVERFLOW
+			names.add(None)
+		names.add(os.fsdecode(data[position + 16:position + 16 + length].rstrip(b"\0")))
+		position += 16 + length
+	return names
+
+
+def watch_log(model: LogModel, fd: Optional[int]):
+	"""
+	Keep the model up to date, forever: refresh it when inotify says that the log changed, or every
+	HTTP_POLL_INTERVAL seconds without inotify
 
-	ensure_log_file()
-	create_backup_if_necessary()
+	:param fd: from inotify_watch(), None to poll
+	"""
+	from select import select
+
+	names = {os.path.basename(path) for path in model.watched_files()}
+	while True:
+		if fd is None:
+			sleep(HTTP_POLL_INTERVAL)
+		else:
+			# Check once in a while anyway, it's just a stat()
+			readable, _, _ = select([fd], [], [], 60)
+			if readable and not inotify_names(os.read(fd, 65536)) & (names | {None}):
+				continue
+		try:
+			model.refresh(force=fd is not None)
+		except (OSError, LockTimeoutError) as e:
+			print(f"Cannot read the log: {e}")
+			sys.stdout.flush()
+
+
+def http_server(address: str) -> bool:
+	"""
+	Serve who's in lab, the log and some numbers as JSON over HTTP, read-only: /inlab, /log and /stats.
+	Everything comes from a LogModel kept up to date in the background, so requests don't read anything.
+
+	:param address: HOST:PORT or PORT, an empty HOST is every interface
+	:return: False if it can't start
+	"""
+	import json
+	from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+	from urllib.parse import urlsplit, parse_qs
+
+	host, _, port = address.rpartition(":") if ":" in address else ("127.0.0.1", ":", address)
+	if not port.isdigit():
+		print(f"Invalid address: {address} (use HOST:PORT or PORT)")
+		return False
+
+	model = LogModel()
+	try:
+		model.refresh()
+	except LockTimeoutError:
+		return False
+	fd = inotify_watch(model.watched_files())
+	threading.Thread(target=watch_log, args=(model, fd), daemon=True).start()
+	routes = {
+		"/inlab": lambda query: model.cached("inlab", lambda: http_inlab(model)),
+		"/log": lambda query: http_log(model, query),
+		"/stats": lambda query: http_stats(model),
+	}
+
+	class RequestHandler(BaseHTTPRequestHandler):
+		server_version = f"weeelab/{VERSION}"
+
+		def do_GET(self):
+			url = urlsplit(self.path)
+			if url.path not in routes:
+				self.send_json(404, {"error": f"Not found, try {', '.join(routes)}"})
+				return
+			query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+			try:
+				self.send_json(200, routes[url.path](query))
+			except (argparse.ArgumentTypeError, ValueError) as e:
+				self.send_json(400, {"error": str(e)})
+
+		def send_json(self, status: int, body: dict):
+			data = json.dumps(body).encode()
+			self.send_response(status)
+			self.send_header("Content-Type", "application/json")
+			self.send_header("Content-Length", str(len(data)))
+			self.send_header("Cache-Control", "no-cache")
+			# Dashboards are web pages served from somewhere else
+			self.send_header("Access-Control-Allow-Origin", "*")
+			self.end_headers()
+			self.wfile.write(data)
+
+		def log_message(self, format, *args):
+			if DEBUG_MODE:
+				super().log_message(format, *args)
+
+	try:
+		server = ThreadingHTTPServer((host, int(port)), RequestHandler)
+	except OSError as e:
+		print(f"Cannot listen on {address}: {e}")
+		return False
+	server.daemon_threads = True
+	# Exit cleanly on systemctl stop
+	signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+	how = "watching the log with inotify" if fd is not None else f"checking the log every {HTTP_POLL_INTERVAL} s"
+	print(f"weeelab HTTP server listening on http://{host or '0.0.0.0'}:{port}, {how}")
+	sys.stdout.flush()
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+	return True
 
+
+def run_action(args_dict) -> tuple:
+	"""
+	Do what the command line asked for
+
+	:param args_dict: parsed arguments
+	:return: (success, interactive)
+	"""
 	result = True
 	interactive = False
 	try:
@@ -647,9 +4083,41 @@ def main(args_dict):
 		elif args_dict.get('inlab'):
 			inlab()
 		elif args_dict.get('log'):
-			logfile()
+			logfile(args_dict.get('user'), args_dict.get('since'), args_dict.get('until'), args_dict.get('grep'),
+				args_dict.get('tail'), args_dict.get('follow'), args_dict.get('archives'))
 		elif args_dict.get('admin'):
 			result = manual_logout()
+		elif args_dict.get('merge_journal'):
+			merge_journal()
+		elif args_dict.get('sync_directory'):
+			sync_directory(args_dict.get('full'))
+		elif args_dict.get('report'):
+			report(args_dict.get('user'), args_dict.get('since'), args_dict.get('until'), args_dict.get('monthly'))
+		elif args_dict.get('occupancy'):
+			result = occupancy(args_dict.get('since'), args_dict.get('until'), args_dict.get('csv'))
+		elif args_dict.get('kiosk'):
+			message = None if args_dict.get('message') is None else args_dict.get('message')[0]
+			result = kiosk(args_dict.get('kiosk'), args_dict.get('ldap'), message, args_dict.get('window'))
+		elif args_dict.get('close_lab') is not None:
+			message = None if args_dict.get('message') is None else args_dict.get('message')[0]
+			result = close_lab(args_dict.get('close_lab'), args_dict.get('at'), message, args_dict.get('dry_run'),
+				args_dict.get('last_out'))
+		elif args_dict.get('import_logs'):
+			import_logs()
+		elif args_dict.get('export_log'):
+			export_log(args_dict.get('export_log'), args_dict.get('since'), args_dict.get('until'))
+		elif args_dict.get('export'):
+			result = export_sessions(args_dict.get('export'), args_dict.get('format'), args_dict.get('user'),
+				args_dict.get('since'), args_dict.get('until'))
+		elif args_dict.get('trace_summary'):
+			trace_summary(args_dict.get('tail'))
+		elif args_dict.get('http'):
+			result = http_server(args_dict.get('http'))
+		elif args_dict.get('verify_replicas'):
+			result = verify_replicas()
+		elif args_dict.get('search'):
+			result = search(args_dict.get('search'), args_dict.get('user'), args_dict.get('since'), args_dict.get('until'),
+				args_dict.get('limit'))
 		else:
 			print("WTF?")
 			exit(69)
@@ -657,54 +4125,841 @@ def main(args_dict):
 		result = False
 	except UserNotFoundError:
 		result = False
-
-	auto_close = True
-
-	if SIR_HAPPENED:
-		red = "\033[41m\033[30m"
-		yellow = "\033[41m\033[97m"
-		border = "\033[103m"
-		bold = ""  # "\033[1m"
-		disagio = "\033[5m"
-		# underline = "\033[4m"
-		underline = "\033[97m"
-		reset = "\033[0m"
-		# print("\x1b[1;37;44m")
-		# print("\x1b[1;34;41m")
-		print(f"{red}{bold}")
-		print(f"                                                                          ")
-		print(f"                                                                          ")
-		print(f"                                 {border}                   {red}")
-		print(f"                                 {border}  {red}               {border}  {red}")
-		print(f"                                 {border}  {yellow}{disagio} SIGN THE SIR!{reset}{red} {border}  {red}")
-		print(f"                                 {border}  {red}               {border}  {red}")
-		print(f"                                 {border}                   {red}")
-		print(f"")
-		print(f" This is mandatory and very important, you have to make {underline}4 signatures{reset}{red} on a boring form.")
-		print(f"              Ask someone else in lab or on Telegram to provide you the form.")
-		print(f"")
-		# print("\x1b[1;37;44m")
-		print(reset)
-		auto_close = False
-
-	if FIRST_IN_HAPPENED:
-		if FIRST_IN:
-			if os.path.isfile(FIRST_IN):
-				print("I'm now launching the \"first in\" script, but you can close this window")
-				subprocess.Popen([FIRST_IN])
+	except LockTimeoutError:
+		result = False
+	return result, interactive
+
+
+def show_sir_banner():
+	if not SIR_HAPPENED:
+		return
+
+	red = "\033[41m\033[30m"
+	yellow = "\033[41m\033[97m"
+	border = "\033[103m"
+	bold = ""  # "\033[1m"
+	disagio = "\033[5m"
+	# underline = "\033[4m"
+	underline = "\033[97m"
+	reset = "\033[0m"
+	# print("\x1b[1;37;44m")
+	# print("\x1b[1;34;41m")
+	print(f"{red}{bold}")
+	print(f"                                                                          ")
+	print(f"                                                                          ")
+	print(f"                                 {border}                   {red}")
+	print(f"                                 {border}  {red}               {border}  {red}")
+	print(f"                                 {border}  {yellow}{disagio} SIGN THE SIR!{reset}{red} {border}  {red}")
+	print(f"                                 {border}  {red}               {border}  {red}")
+	print(f"                                 {border}                   {red}")
+	print(f"")
+	print(f" This is mandatory and very important, you have to make {underline}4 signatures{reset}{red} on a boring form.")
+	print(f"              Ask someone else in lab or on Telegram to provide you the form.")
+	print(f"")
+	# print("\x1b[1;37;44m")
+	print(reset)
+
+
+def launch_hooks():
+	"""
+	Queue the "first in" and "last out" scripts, if needed, and start a weeelab --run-hooks in the background
+	to run them. Never waits for them.
+	"""
+	if not FIRST_IN_HAPPENED and not LAST_OUT_HAPPENED:
+		return
+
+	events = []
+	for happened, event, script in ((FIRST_IN_HAPPENED, "first_in", FIRST_IN), (LAST_OUT_HAPPENED, "last_out", LAST_OUT)):
+		name = event.replace("_", " ")
+		if happened and script:
+			if os.path.isfile(script):
+				print(f"The \"{name}\" script will run in a moment, you can close this window")
+				events.append(event)
 			else:
-				print(f"The \"first in\" script \"{FIRST_IN}\" does not exist, notify an administrator")
+				print(f"The \"{name}\" script \"{script}\" does not exist, notify an administrator")
+	if len(events) == 0:
+		return
+
+	try:
+		for event in events:
+			queue_hook(event)
+	except OSError as e:
+		print(f"Cannot queue the script: {e}")
+		return
+	import subprocess
+	# In its own session, so it survives the terminal window being closed
+	subprocess.Popen([sys.executable, os.path.realpath(__file__), "--run-hooks"] + (["-d"] if DEBUG_MODE else []),
+		stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+
+def reap_children(signum, frame):
+	"""
+	SIGCHLD handler for weeelabs that keep running (daemon, kiosk): collect hooks and replications that have
+	exited. SIG_IGN would do the same, but it's inherited by them and then scripts can't get their own exit codes.
+	"""
+	try:
+		while os.waitpid(-1, os.WNOHANG)[0] != 0:
+			pass
+	except ChildProcessError:
+		pass
+
+
+def hook_queue_filename() -> str:
+	# log.txt -> log.txt.hooks, events whose script hasn't run yet
+	return LOG_FILENAME + ".hooks"
+
+
+def open_hook_queue():
+	"""
+	Open the queue and lock it. Closing the file releases the lock.
+
+	:return: file object, read and write
+	"""
+	queue_file = os.fdopen(os.open(hook_queue_filename(), os.O_RDWR | os.O_CREAT, 0o666), "r+")
+	fcntl.flock(queue_file.fileno(), fcntl.LOCK_EX)
+	return queue_file
+
+
+def read_hook_queue(queue_file) -> list:
+	"""
+	:return: list of (time, event)
+	"""
+	queue_file.seek(0)
+	events = []
+	for line in queue_file:
+		try:
+			when, event = line.split()
+			events.append((float(when), event))
+		except ValueError:
+			# Half-written by a weeelab that crashed
+			pass
+	return events
+
+
+def write_hook_queue(queue_file, events: list):
+	queue_file.seek(0)
+	queue_file.truncate()
+	queue_file.writelines(f"{when:.3f} {event}\n" for when, event in events)
+	queue_file.flush()
+	os.fsync(queue_file.fileno())
+
+
+def queue_hook(event: str):
+	"""
+	Add an event to the queue, to run its script later
+
+	:param event: first_in or last_out
+	"""
+	with open_hook_queue() as queue_file:
+		queue_file.seek(0, os.SEEK_END)
+		queue_file.write(f"{time():.3f} {event}\n")
+		queue_file.flush()
+		os.fsync(queue_file.fileno())
+
+
+def next_hook(events: list, now: float, window: float) -> tuple:
+	"""
+	Decide what to do with the queue. An event waits for window seconds: if the opposite one comes in the
+	meantime (e.g. someone logged in and out of an empty lab in a minute), neither script runs.
+
+	:param events: list of (time, event), oldest first
+	:param now: current time
+	:param window: seconds
+	:return: (events left, including the one to run, event to run or None, seconds to wait or None if the queue is empty)
+	"""
+	events = list(events)
+	while events:
+		when, event = events[0]
+		if len(events) > 1 and events[1][1] == event:
+			# Twice the same, e.g. after a crash: once is enough
+			del events[1]
+		elif len(events) > 1 and events[1][0] - when < window:
+			del events[:2]
+		elif now - when < window:
+			return events, None, when + window - now
+		else:
+			return events, events[0], 0
+	return events, None, None
+
+
+def run_hooks():
+	"""
+	Run scripts in the queue, one at a time, with output saved to log.txt.hooks.log. Exits when the queue
+	is empty. Started by launch_hooks(), if another one is already running this one exits immediately and the
+	other one runs its events.
+	"""
+	# Default handling, whatever was inherited, so that waiting for a script returns its real exit status
+	signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+	runner_fd = os.open(hook_queue_filename() + ".lock", os.O_RDWR | os.O_CREAT, 0o666)
+	try:
+		while True:
+			try:
+				fcntl.flock(runner_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				return
+			try:
+				run_hook_queue()
+			finally:
+				fcntl.flock(runner_fd, fcntl.LOCK_UN)
+			# Something may have been queued after the last look, when the other runner had already given up
+			with open_hook_queue() as queue_file:
+				if len(read_hook_queue(queue_file)) == 0:
+					return
+	finally:
+		os.close(runner_fd)
+
+
+def run_hook_queue():
+	"""
+	Run scripts in the queue until it's empty, waiting for each one to be HOOK_WINDOW seconds old. Caller must
+	be the only runner.
+	"""
+	while True:
+		with open_hook_queue() as queue_file:
+			events = read_hook_queue(queue_file)
+			remaining, hook, wait = next_hook(events, time(), HOOK_WINDOW)
+			if remaining != events:
+				write_hook_queue(queue_file, remaining)
+		if hook is not None:
+			run_hook(hook[1])
+			# Removed only now: if something goes wrong it will run again, rather than never
+			with open_hook_queue() as queue_file:
+				events = read_hook_queue(queue_file)
+				if hook in events:
+					events.remove(hook)
+					write_hook_queue(queue_file, events)
+		elif wait is None:
+			return
+		else:
+			sleep(wait)
+
+
+def run_hook(event: str):
+	"""
+	Run the script of an event, with a timeout, appending its output to log.txt.hooks.log
+
+	:param event: first_in or last_out
+	"""
+	import subprocess
+	script = FIRST_IN if event == "first_in" else LAST_OUT
+	output_filename = LOG_FILENAME + ".hooks.log"
+	try:
+		if os.path.getsize(output_filename) > HOOK_OUTPUT_MAX_SIZE:
+			os.replace(output_filename, output_filename + ".1")
+	except OSError:
+		pass
+	with open(output_filename, "ab") as output_file:
+		output_file.write(f"[{strftime('%d/%m/%Y %H:%M:%S')}] {event}: {script}\n".encode())
+		output_file.flush()
+		start = monotonic()
+		if not script:
+			status = "no script"
+		else:
+			try:
+				process = subprocess.run([script], stdin=subprocess.DEVNULL, stdout=output_file, stderr=subprocess.STDOUT,
+					timeout=HOOK_TIMEOUT)
+				status = f"exit code {process.returncode}"
+			except subprocess.TimeoutExpired:
+				status = f"killed after {HOOK_TIMEOUT} seconds"
+			except OSError as e:
+				status = f"cannot run it: {e}"
+		output_file.write(f"[{strftime('%d/%m/%Y %H:%M:%S')}] {event}: {status}, {monotonic() - start:.1f} s\n".encode())
+
+
+def launch_replication():
+	"""
+	Start a weeelab --replicate in the background if the log may have changed and there are replicas. It waits
+	REPLICA_DELAY seconds before copying anything, so a burst of logins and logouts is copied only once. Never waits.
+	"""
+	global LOG_WRITTEN
+	if not LOG_WRITTEN or not REPLICA_PATHS or DEBUG_MODE:
+		return
+	LOG_WRITTEN = False
+
+	import subprocess
+	output_filename = replica_checkpoints_filename() + ".log"
+	try:
+		if os.path.getsize(output_filename) > HOOK_OUTPUT_MAX_SIZE:
+			os.replace(output_filename, output_filename + ".1")
+	except OSError:
+		pass
+	try:
+		with open(output_filename, "ab") as output_file:
+			# In its own session, like the hooks, so it survives the terminal window being closed
+			subprocess.Popen([sys.executable, os.path.realpath(__file__), "--replicate", str(REPLICA_DELAY)],
+				stdin=subprocess.DEVNULL, stdout=output_file, stderr=subprocess.STDOUT, start_new_session=True)
+	except OSError as e:
+		print(f"Cannot start copying the log to replicas: {e}")
+
+
+def replica_checkpoints_filename() -> str:
+	# log.txt -> log.txt.replicas, what each replica contains
+	return LOG_FILENAME + ".replicas"
+
+
+def load_replica_checkpoints() -> dict:
+	"""
+	Read what each replica contains, as of the last replication. If the file is missing or was made with another
+	block size, replicas are compared with the source block by block and rewritten where they differ.
+
+	:return: replica directory -> file name -> checkpoint, see write_replica()
+	"""
+	import json
+	try:
+		with open(replica_checkpoints_filename(), "r") as checkpoints_file:
+			checkpoints = json.load(checkpoints_file)
+		if checkpoints.get("block_size") == REPLICA_BLOCK_SIZE:
+			return checkpoints["replicas"]
+	except (OSError, ValueError, AttributeError, KeyError):
+		pass
+	return {}
+
+
+def save_replica_checkpoints(replicas: dict):
+	import json
+	temporary_filename = replica_checkpoints_filename() + ".tmp"
+	with open(temporary_filename, "w") as checkpoints_file:
+		json.dump({"block_size": REPLICA_BLOCK_SIZE, "replicas": replicas}, checkpoints_file)
+		checkpoints_file.flush()
+		os.fsync(checkpoints_file.fileno())
+	os.replace(temporary_filename, replica_checkpoints_filename())
+
+
+def replica_sources() -> dict:
+	"""
+	Find the files that are mirrored to replicas: log.txt with its journal and month, which change, then the
+	archives and their indexes, which never change once written.
+
+	:return: file name -> path, live files first
+	"""
+	paths = [LOG_FILENAME, journal_filename(), log_month_filename()]
+	for _, path in archive_files():
+		paths += [path, path + ".idx"]
+	return {os.path.basename(path): path for path in paths if os.path.exists(path)}
+
+
+def replica_digest(block: bytes) -> str:
+	import hashlib
+	return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+
+def file_digests(path: str) -> tuple:
+	"""
+	:return: (size, checksum of each block)
+	"""
+	size = 0
+	digests = []
+	with open(path, "rb") as input_file:
+		while True:
+			block = input_file.read(REPLICA_BLOCK_SIZE)
+			if not block:
+				return size, digests
+			size += len(block)
+			digests.append(replica_digest(block))
+
+
+def checkpoint_matches(checkpoint: Optional[dict], stat: os.stat_result) -> bool:
+	"""
+	Tell if a file is still the one that was copied, from its inode, size and modification time
+	"""
+	return checkpoint is not None and (checkpoint["inode"], checkpoint["size"], checkpoint["mtime"]) == \
+		(stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def replica_reusable(checkpoint: Optional[dict], stat: os.stat_result, head: str) -> int:
+	"""
+	Find how much of a replica is surely still the same as its source, without reading it: the stable part
+	of the file when it was copied, unless the file was replaced or rewritten since then.
+
+	:param checkpoint: of the replica, None if it doesn't have the file
+	:param head: checksum of the first block of the source, which changes when it's rewritten in place
+	:return: bytes from the start
+	"""
+	if checkpoint is None or checkpoint["inode"] != stat.st_ino or checkpoint["size"] > stat.st_size:
+		return 0
+	if checkpoint_matches(checkpoint, stat):
+		return stat.st_size
+	if len(checkpoint["blocks"]) == 0 or checkpoint["blocks"][0] != head:
+		return 0
+	return checkpoint["stable"]
+
+
+def read_replica_source(path: str, checkpoints: list, live: bool, first_open: Optional[int] = None) -> Optional[tuple]:
+	"""
+	Read what replicas may be missing of a file: everything after the part that was already stable when the
+	least up to date of them was copied. Caller must hold the lock, for live files.
+
+	Stable means it can only be appended to. For an archive that's the whole file. For log.txt it ends at the
+	first INLAB line, since logouts are written in place, or at the last newline: a line without one is still
+	being written or was cut by a crash.
+
+	:param checkpoints: of the file, for each replica to update
+	:param live: log.txt, its journal or month
+	:param first_open: offset of the first INLAB line in log.txt, None if there are none or it's another file
+	:return: (os.stat_result, checksum of the first block, offset where data starts, data, stable bytes),
+	None if the file is gone
+	"""
+	try:
+		source = open(path, "rb")
+	except FileNotFoundError:
+		return None
+	with source:
+		stat = os.fstat(source.fileno())
+		head = replica_digest(source.read(REPLICA_BLOCK_SIZE))
+		start = min(replica_reusable(checkpoint, stat, head) for checkpoint in checkpoints)
+		start -= start % REPLICA_BLOCK_SIZE
+		source.seek(start)
+		data = source.read(stat.st_size - start)
+	stable = stat.st_size
+	if live:
+		stable = start + data.rfind(b"\n") + 1
+		if first_open is not None:
+			stable = min(stable, first_open)
+	return stat, head, start, data, stable
+
+
+def write_replica(target: str, snapshot: tuple, checkpoint: Optional[dict]) -> tuple:
+	"""
+	Update a replica of a file, writing only the blocks that differ from its checkpoint
+
+	A checkpoint is a dict with inode, size and mtime (in ns) of the source when it was copied, the stable
+	bytes at that moment and a checksum of each block of the replica.
+
+	:param snapshot: from read_replica_source()
+	:param checkpoint: of the replica, None if it doesn't have the file
+	:return: (new checkpoint, bytes written)
+	"""
+	stat, head, start, data, stable = snapshot
+	old_blocks = [] if checkpoint is None else checkpoint["blocks"]
+	unchanged = replica_reusable(checkpoint, stat, head)
+	blocks = old_blocks[:unchanged // REPLICA_BLOCK_SIZE]
+	written = 0
+	replica_fd = os.open(target, os.O_WRONLY | os.O_CREAT, 0o644)
+	try:
+		for offset in range(len(blocks) * REPLICA_BLOCK_SIZE, stat.st_size, REPLICA_BLOCK_SIZE):
+			block = data[offset - start:offset - start + REPLICA_BLOCK_SIZE]
+			digest = replica_digest(block)
+			if len(blocks) >= len(old_blocks) or old_blocks[len(blocks)] != digest:
+				# Usually only the end of the block was appended to
+				skip = max(0, unchanged - offset)
+				os.pwrite(replica_fd, block[skip:], offset + skip)
+				written += len(block) - skip
+			blocks.append(digest)
+		os.ftruncate(replica_fd, stat.st_size)
+		os.fsync(replica_fd)
+	finally:
+		os.close(replica_fd)
+	checkpoint = {"inode": stat.st_ino, "size": stat.st_size, "mtime": stat.st_mtime_ns, "stable": stable, "blocks": blocks}
+	return checkpoint, written
+
+
+def replicas_outdated(replicas: dict) -> bool:
+	"""
+	Tell if anything changed since it was copied, only from inodes, sizes and modification times
+
+	:param replicas: from load_replica_checkpoints()
+	"""
+	sources = replica_sources()
+	for replica in REPLICA_PATHS:
+		copied = replicas.get(replica, {})
+		if set(copied) != set(sources):
+			return True
+		for name, path in sources.items():
+			try:
+				if not checkpoint_matches(copied[name], os.stat(path)):
+					return True
+			except FileNotFoundError:
+				return True
+	return False
+
 
-	if LAST_OUT_HAPPENED:
-		if LAST_OUT:
-			if os.path.isfile(LAST_OUT):
-				print("I'm now launching the \"last out\" script, but you can close this window")
-				subprocess.Popen([LAST_OUT])
+def sync_replicas() -> bool:
+	"""
+	Bring every replica up to date. Live files are read together under the lock, so a replica never gets a
+	journal that doesn't belong to its log. Replicas are written without the lock: people can log in and out
+	in the meantime, it will be copied next time.
+
+	:return: False if some replica could not be updated
+	"""
+	replicas = load_replica_checkpoints()
+	ok = True
+	targets = []
+	for replica in REPLICA_PATHS:
+		if os.path.isdir(replica):
+			targets.append(replica)
+		else:
+			print(f"[{strftime('%d/%m/%Y %H:%M:%S')}] {replica} is not a directory (not mounted?), not copying there")
+			ok = False
+	if len(targets) == 0:
+		return False
+	# Checkpoints of files that replicas still have, a deleted replica file is copied again in full
+	previous = {replica: {name: checkpoint for name, checkpoint in replicas.get(replica, {}).items()
+		if os.path.exists(os.path.join(replica, name))} for replica in targets}
+
+	with log_lock(exclusive=False, verbose=False):
+		sources = replica_sources()
+		first_open = min(load_inlab_index().values(), default=None)
+		snapshots = {}
+		for path in (LOG_FILENAME, journal_filename(), log_month_filename()):
+			name = os.path.basename(path)
+			if name in sources:
+				checkpoints = [previous[replica].get(name) for replica in targets]
+				snapshots[name] = read_replica_source(path, checkpoints, True, first_open if path == LOG_FILENAME else None)
+
+	updates = {replica: {} for replica in targets}
+	removed = {replica: [name for name in replicas.get(replica, {}) if name not in sources] for replica in targets}
+	for name, path in sources.items():
+		try:
+			stat = snapshots[name][0] if name in snapshots else os.stat(path)
+		except FileNotFoundError:
+			continue
+		for replica in targets:
+			if not checkpoint_matches(previous[replica].get(name), stat):
+				updates[replica][name] = path
+	if not any(updates.values()) and not any(removed.values()):
+		return ok
+
+	# If copying is interrupted, replicas no longer contain what these checkpoints say
+	for replica in targets:
+		for name in list(updates[replica]) + removed[replica]:
+			replicas.setdefault(replica, {}).pop(name, None)
+	save_replica_checkpoints(replicas)
+
+	written = {replica: 0 for replica in targets}
+	for name, path in sources.items():
+		stale = [replica for replica in targets if name in updates[replica]]
+		if len(stale) == 0:
+			continue
+		snapshot = snapshots.get(name)
+		if name not in snapshots:
+			# Archives don't change, the lock is only needed while they're being made
+			with log_lock(exclusive=False, verbose=False):
+				snapshot = read_replica_source(path, [previous[replica].get(name) for replica in stale], False)
+		if snapshot is None:
+			continue
+		for replica in stale:
+			if replica not in written:
+				continue
+			try:
+				replicas[replica][name], size = write_replica(os.path.join(replica, name), snapshot, previous[replica].get(name))
+				written[replica] += size
+			except OSError as e:
+				print(f"[{strftime('%d/%m/%Y %H:%M:%S')}] Cannot copy {name} to {replica}: {e}")
+				# Try again next time, from scratch for this file
+				del written[replica]
+				ok = False
+	for replica in targets:
+		for name in removed[replica]:
+			try:
+				os.remove(os.path.join(replica, name))
+			except FileNotFoundError:
+				pass
+			except OSError as e:
+				print(f"[{strftime('%d/%m/%Y %H:%M:%S')}] Cannot remove {name} from {replica}: {e}")
+				ok = False
+	save_replica_checkpoints(replicas)
+
+	for replica in written:
+		if len(updates[replica]) == 0 and len(removed[replica]) == 0:
+			continue
+		print(f"[{strftime('%d/%m/%Y %H:%M:%S')}] {replica}: {len(updates[replica])} files updated, "
+			f"{len(removed[replica])} removed, {written[replica]} bytes written")
+	return ok
+
+
+def replicate(delay: float = 0) -> bool:
+	"""
+	Copy what changed in log.txt, its journal and the archives to every directory in REPLICA_PATHS. Started by
+	launch_replication() after every change, if another one is already running this one exits immediately and
+	the other one copies its changes too. Without a delay it waits for the other one instead.
+
+	:param delay: seconds to wait before copying, to collect more changes
+	:return: False if some replica could not be updated
+	"""
+	if not REPLICA_PATHS:
+		print("There are no replicas, set REPLICA_PATHS")
+		return False
+	runner_fd = os.open(replica_checkpoints_filename() + ".lock", os.O_RDWR | os.O_CREAT, 0o666)
+	try:
+		while True:
+			try:
+				fcntl.flock(runner_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except BlockingIOError:
+				if delay > 0:
+					return True
+				# Run by hand: when this returns, replicas should be up to date
+				print("Another weeelab is copying to replicas, waiting for it")
+				fcntl.flock(runner_fd, fcntl.LOCK_EX)
+			try:
+				sleep(delay)
+				ok = sync_replicas()
+			finally:
+				fcntl.flock(runner_fd, fcntl.LOCK_UN)
+			# Something may have changed while copying, when the other runner had already given up
+			if not ok or not replicas_outdated(load_replica_checkpoints()):
+				return ok
+	finally:
+		os.close(runner_fd)
+
+
+def verify_replicas() -> bool:
+	"""
+	Check every replica block by block: against the source for files that didn't change since they were copied,
+	against the checkpoint for the others. Broken files are forgotten, so the next replication copies them again.
+
+	:return: True if no replica is broken
+	"""
+	if not REPLICA_PATHS:
+		print("There are no replicas, set REPLICA_PATHS")
+		return False
+	replicas = load_replica_checkpoints()
+	sources = replica_sources()
+	ok = True
+	forgotten = False
+	for replica in REPLICA_PATHS:
+		if not os.path.isdir(replica):
+			print(f"{replica} is not a directory (not mounted?)")
+			ok = False
+			continue
+		copied = replicas.get(replica, {})
+		checked = 0
+		outdated = 0
+		broken = []
+		for name in sorted(set(sources) | set(copied)):
+			checkpoint = copied.get(name)
+			if checkpoint is None:
+				outdated += 1
+				continue
+			expected = checkpoint["size"], checkpoint["blocks"]
+			if name in sources:
+				with log_lock(exclusive=False, verbose=False):
+					try:
+						if checkpoint_matches(checkpoint, os.stat(sources[name])):
+							expected = file_digests(sources[name])
+						else:
+							outdated += 1
+					except FileNotFoundError:
+						outdated += 1
 			else:
-				print(f"The \"last out\" script \"{LAST_OUT}\" does not exist, notify an administrator")
+				outdated += 1
+			try:
+				actual = file_digests(os.path.join(replica, name))
+			except FileNotFoundError:
+				print(f"{replica}: {name} is missing")
+				broken.append(name)
+				continue
+			checked += actual[0]
+			if actual[0] != expected[0]:
+				print(f"{replica}: {name} is {actual[0]} bytes instead of {expected[0]}")
+				broken.append(name)
+				continue
+			differ = [block for block, digest in enumerate(actual[1]) if digest != expected[1][block]]
+			if differ:
+				print(f"{replica}: {name} is different in {len(differ)} of {len(actual[1])} blocks, from byte {differ[0] * REPLICA_BLOCK_SIZE}")
+				broken.append(name)
+		for name in broken:
+			del copied[name]
+			forgotten = True
+		print(f"{replica}: {len(copied) + len(broken)} files, {checked} bytes checked, {len(broken)} broken, "
+			f"{outdated} changed since the last replication")
+		ok = ok and len(broken) == 0
+	if forgotten:
+		save_replica_checkpoints(replicas)
+		print("Broken files will be copied again in full by the next weeelab --replicate")
+	return ok
+
+
+def print_startup_timing():
+	"""
+	Print how long each phase took, for --startup-timing. On stderr, to not mess with the output of -p & co.
+	"""
+	print(f"Startup timing (ms):", file=sys.stderr)
+	for phase, seconds in STARTUP_TIMES:
+		print(f"{seconds * 1000:9.2f}  {phase}", file=sys.stderr)
+	print(f"{(perf_counter() - STARTUP_CLOCK) * 1000:9.2f}  total, excluding interpreter startup", file=sys.stderr)
+
+
+def process_counters() -> dict:
+	"""
+	What the kernel knows about this process: how long the interpreter took to start, bytes read and written
+	(files, pipes, sockets, imports too). Linux only, empty elsewhere.
+
+	:return: interpreter_ms, read_bytes, written_bytes, if available
+	"""
+	counters = {}
+	try:
+		with open("/proc/self/io", "r") as io_file:
+			io_counters = dict(line.split(": ", 1) for line in io_file.read().splitlines())
+		counters["read_bytes"] = int(io_counters["rchar"])
+		counters["written_bytes"] = int(io_counters["wchar"])
+		with open("/proc/self/stat", "r") as stat_file:
+			# The command may contain spaces, the fields after it don't
+			started = int(stat_file.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+		with open("/proc/uptime", "r") as uptime_file:
+			uptime = float(uptime_file.read().split()[0])
+		counters["interpreter_ms"] = max(0.0, (uptime - started - (perf_counter() - STARTUP_CLOCK)) * 1000)
+	except (OSError, ValueError, KeyError, IndexError):
+		pass
+	return counters
+
+
+def write_trace():
+	"""
+	Append what this run did and how long each phase took to TRACE_FILENAME, as a JSON line.
+	Registered with atexit by main(), so it also sees hooks and the final wait.
+	"""
+	import json
+	phases = {}
+	for phase, seconds in STARTUP_TIMES:
+		phases[phase] = phases.get(phase, 0.0) + seconds * 1000
+	phases["ldap connect"] = LDAP_STATS["connect_time"] * 1000
+	phases["ldap search"] = LDAP_STATS["search_time"] * 1000
+	phases["lock wait"] = LOCK_STATS["wait"] * 1000
+	counters = process_counters()
+	if "interpreter_ms" in counters:
+		phases["interpreter"] = counters.pop("interpreter_ms")
+	record = {
+		"time": strftime("%Y-%m-%dT%H:%M:%S"),
+		"pid": os.getpid(),
+		"action": TRACE.get("action"),
+		"result": TRACE.get("result"),
+		"total_ms": round((perf_counter() - STARTUP_CLOCK) * 1000 + phases.get("interpreter", 0.0), 3),
+		"phases": {phase: round(ms, 3) for phase, ms in phases.items()},
+		"ldap_round_trips": LDAP_STATS["round_trips"],
+		"lock_acquired": LOCK_STATS["acquired"],
+		"lock_contended": LOCK_STATS["contended"],
+		**counters,
+	}
+	try:
+		if os.path.getsize(TRACE_FILENAME) > TRACE_MAX_SIZE:
+			os.replace(TRACE_FILENAME, TRACE_FILENAME + ".1")
+	except OSError:
+		pass
+	try:
+		# A single write in append mode, lines from different weeelabs don't get mixed
+		fd = os.open(TRACE_FILENAME, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+		try:
+			os.write(fd, (json.dumps(record) + "\n").encode())
+		finally:
+			os.close(fd)
+	except OSError as e:
+		print(f"Cannot write trace: {e}", file=sys.stderr)
+
+
+def trace_summary(runs: Optional[int]):
+	"""
+	Print how long each phase took in recent runs, from the trace file
+
+	:param runs: only the last runs, None for 1000
+	"""
+	import json
+	records = []
+	for filename in (TRACE_FILENAME + ".1", TRACE_FILENAME):
+		try:
+			with open(filename, "r") as trace_file:
+				for line in trace_file:
+					try:
+						records.append(json.loads(line))
+					except ValueError:
+						# Half-written by a weeelab that crashed
+						pass
+		except FileNotFoundError:
+			pass
+	records = records[-(runs or 1000):]
+	if len(records) == 0:
+		print(f"No traces in {TRACE_FILENAME}, run weeelab with --trace or WEEELAB_TRACE=1 first.")
+		return
+
+	# phase -> milliseconds of each run where it happened
+	phases = {}
+	for record in records:
+		phases.setdefault("total", []).append(record["total_ms"])
+		for phase, ms in record["phases"].items():
+			if ms > 0:
+				phases.setdefault(phase, []).append(ms)
+
+	def percentile(samples, fraction):
+		return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+	actions = sorted({record["action"] for record in records if record["action"]})
+	print(f"Last {len(records)} runs ({', '.join(actions)}), from {records[0]['time']} to {records[-1]['time']}, in ms:")
+	print(f"{'phase':<22} {'runs':>6} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+	for phase, samples in sorted(phases.items(), key=lambda item: -sorted(item[1])[len(item[1]) // 2]):
+		samples.sort()
+		print(f"{phase:<22} {len(samples):>6} {percentile(samples, .5):9.2f} {percentile(samples, .9):9.2f} "
+			f"{percentile(samples, .99):9.2f} {samples[-1]:9.2f}")
+	for counter in ("ldap_round_trips", "lock_contended", "read_bytes", "written_bytes"):
+		samples = sorted(record[counter] for record in records if counter in record)
+		if samples:
+			print(f"{counter.replace('_', ' '):<22} {len(samples):>6} {percentile(samples, .5):9} {percentile(samples, .9):9} "
+				f"{percentile(samples, .99):9} {samples[-1]:9}")
+
+
+def main(args_dict):
+	# root execution check
+	if os.geteuid() == 0:
+		print("Error: can't execute " + PROGRAM_NAME + " as root.")
+		exit(42)
+
+	if args_dict.get('debug'):
+		global DEBUG_MODE
+		DEBUG_MODE = True
+		print(f"DEBUG_MODE enabled")
+		# Nothing from production: database, caches and indexes are in there too
+		set_log_path("./debug", environment=False)
+
+	if args_dict.get('startup_timing'):
+		atexit.register(print_startup_timing)
+
+	if (args_dict.get('trace') or os.getenv("WEEELAB_TRACE", "0") not in ("", "0")) and not args_dict.get('trace_summary'):
+		global TRACE
+		TRACE = {"action": next((action for action in ACTIONS if args_dict.get(action) not in (None, False)), None)}
+		atexit.register(write_trace)
+
+	if args_dict.get('serve'):
+		serve()
+		return
+
+	if args_dict.get('run_hooks'):
+		run_hooks()
+		return
+
+	if args_dict.get('replicate') is not None:
+		if not replicate(args_dict.get('replicate')):
+			# Usually in the background, with output to a file: no colors to reset
+			sys.exit(3)
+		return
+
+	# Let the daemon do it, if there's one. The debug log is not its business.
+	if not DEBUG_MODE:
+		with startup_timer("forward to daemon"):
+			exit_code = forward_to_daemon(args_dict)
+		if exit_code is not None:
+			if exit_code != 0:
+				secure_exit(exit_code)
+			return
+
+	with startup_timer("log rotation check"):
+		ensure_log_file()
+		try:
+			create_backup_if_necessary()
+		except LockTimeoutError:
+			secure_exit(3)
+
+	with startup_timer("action"):
+		result, interactive = run_action(args_dict)
+	if TRACE is not None:
+		TRACE["result"] = result
+
+	auto_close = not SIR_HAPPENED
+	show_sir_banner()
+	with startup_timer("hooks"):
+		launch_hooks()
+		launch_replication()
 
 	if interactive:
 		if auto_close and result:
+			from select import select
 			print("Press enter to exit (or wait 10 seconds)")
 			# does not work on windows:
 			select([sys.stdin], [], [], 10)
@@ -728,7 +4983,7 @@ Since this is a free software, you are welcome
 to redistribute it under the terms of the GNU GPLv3.
 	""".format(VERSION))
 	# Add commands here, like any normal person instead of hand-coding a parser (or at least make it a LALR(1) parser)
-	parser.add_argument('-d', '--debug', action='store_true', help='enable debug mode (don\'t copy files to ownCloud)')
+	parser.add_argument('-d', '--debug', action='store_true', help='enable debug mode (everything in ./debug instead of LOG_PATH, don\'t copy files to replicas)')
 	group = parser.add_argument_group('Actions').add_mutually_exclusive_group(required=True)
 	group.add_argument('-i', '--login', type=str, nargs=1, metavar='USER', help='log in USER')
 	group.add_argument('-o', '--logout', type=str, nargs=1, metavar='USER', help='log out USER')
@@ -738,16 +4993,52 @@ to redistribute it under the terms of the GNU GPLv3.
 	group.add_argument('-p', '--inlab', action='store_true', help='show who\'s in lab (logged in)')
 	group.add_argument('-l', '--log', action='store_true', help='show log file')
 	group.add_argument('-a', '--admin', action='store_true', help='enter admin mode')
+	group.add_argument('--merge-journal', action='store_true', help='merge logout messages back into the log file')
+	group.add_argument('--serve', action='store_true', help='run as a daemon, other weeelabs will forward actions to it')
+	group.add_argument('--sync-directory', action='store_true', help='download users from LDAP, to look them up locally')
+	parser.add_argument('--full', action='store_true', help='with --sync-directory, download everything instead of changes only')
+	group.add_argument('--report', action='store_true', help='show time spent in lab by each user')
+	group.add_argument('--occupancy', action='store_true', help='show how many people are in lab, by weekday and hour')
+	parser.add_argument('--csv', type=str, metavar='FILE', help='with --occupancy, also write each day and hour to FILE (- for stdout)')
+	group.add_argument('--search', type=str, metavar='WORDS', help='search logout messages, best matches first')
+	parser.add_argument('--limit', type=int, default=20, metavar='N', help='with --search, at most N results (default 20)')
+	group.add_argument('--export', type=str, metavar='FILE', help='write sessions to FILE (- for stdout) as CSV or JSON Lines, gzipped if FILE ends with .gz')
+	parser.add_argument('--format', type=str, choices=('csv', 'jsonl'), help='with --export, default from the FILE extension or csv')
+	parser.add_argument('--user', type=str, metavar='USER', help='with --report, --search, --export or -l, only this user')
+	parser.add_argument('--since', type=date_argument, metavar='DATE', help='with --report, --occupancy, --search, --export, --export-log or -l, from this day, month or year (YYYY[-MM[-DD]] or dd/mm/YYYY)')
+	parser.add_argument('--until', type=date_argument, metavar='DATE', help='with --report, --occupancy, --search, --export, --export-log or -l, up to this day, month or year, included')
+	parser.add_argument('--grep', type=str, metavar='REGEX', help='with -l, only lines matching REGEX (case-insensitive)')
+	parser.add_argument('--tail', type=int, metavar='N', help='with -l, only the last N lines, with --trace-summary, only the last N runs')
+	parser.add_argument('--follow', action='store_true', help='with -l, keep showing sessions as they start and end')
+	parser.add_argument('--archives', action='store_true', help='with -l, look in logs of past months too')
+	parser.add_argument('--monthly', action='store_true', help='with --report, month by month')
+	parser.add_argument('--startup-timing', action='store_true', help='print how long each phase of startup took')
+	parser.add_argument('--trace', action='store_true', help='save how long each phase took to the trace file (or set WEEELAB_TRACE=1)')
+	group.add_argument('--kiosk', type=str, nargs='?', const='-', metavar='DEVICE', help='keep logging people in and out as they swipe their cards, from stdin or DEVICE')
+	parser.add_argument('--window', type=float, default=5, metavar='SECONDS', help='with --kiosk, ignore the same card swiped again within SECONDS (default 5)')
+	group.add_argument('--close-lab', type=str, nargs='*', metavar='USER', help='log out everyone still in lab, or only these users, with -m or a default message')
+	parser.add_argument('--at', type=timestamp_argument, metavar='"DD/MM/YYYY HH:MM"', help='with --close-lab, log out at this time instead of now')
+	parser.add_argument('--dry-run', action='store_true', help='with --close-lab, only show who would be logged out')
+	parser.add_argument('--last-out', action='store_true', help='with --close-lab, launch the "last out" script if the lab is empty afterwards')
+	group.add_argument('--import-logs', action='store_true', help='copy log.txt and archives to the SQLite database, for STORAGE=sqlite')
+	group.add_argument('--export-log', type=str, metavar='FILE', help='write sessions to FILE (- for stdout) in the log.txt format, with --since and --until')
+	group.add_argument('--http', type=str, nargs='?', const=HTTP_ADDRESS, metavar='[HOST:]PORT', help=f'serve who\'s in lab, the log and stats as JSON over HTTP (default {HTTP_ADDRESS})')
+	group.add_argument('--replicate', type=float, nargs='?', const=0, metavar='SECONDS', help='copy changes to the log and archives to REPLICA_PATHS, after waiting SECONDS for more (done automatically)')
+	group.add_argument('--verify-replicas', action='store_true', help='check that replicas in REPLICA_PATHS are the same as the log and archives')
+	group.add_argument('--run-hooks', action='store_true', help='run "first in" and "last out" scripts that are waiting (done automatically)')
+	group.add_argument('--trace-summary', action='store_true', help='show how long each phase took in recent runs, with --trace')
 	ldap_group_argparse_thing = parser.add_mutually_exclusive_group(required=False)
 	ldap_group_argparse_thing.add_argument('--ldap', dest='ldap', action='store_true')
 	ldap_group_argparse_thing.add_argument('--no-ldap', dest='ldap', action='store_false')
 	ldap_group_argparse_thing.set_defaults(ldap=True)
 	args = parser.parse_args()
-	if args.message is not None and args.logout is None:
+	if args.message is not None and args.logout is None and args.close_lab is None and args.kiosk is None:
 		parser.error("You can't set a logout message alone or for other commands other than logout.\n"
-					 "You can use -m or its equivalent --message only if you also use the -o or --logout parameter.")
+					 "You can use -m or its equivalent --message only if you also use the -o or --logout, --close-lab or --kiosk parameter.")
 	return args
 
 
 if __name__ == '__main__':
-	main(vars(argparse_this()))
+	with startup_timer("argparse"):
+		parsed_args = vars(argparse_this())
+	main(parsed_args)